@@ -2,32 +2,1225 @@
 RESPONSE_EXPIRATION_TIME = 300  # 5 minutes in seconds
 # Rate limiting has been removed as per user request
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
-from queue import Queue
-from threading import Lock
+from concurrent.futures import FIRST_COMPLETED, Future, TimeoutError as FutureTimeoutError, as_completed, wait as wait_futures
+from collections import Counter, OrderedDict, deque
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
 import time
 import uuid
 
+from capture import TrafficCapture
+from journal import Journal
+from logs import RequestLogger, install as install_logging, parse_rates, stats as logging_stats
+from metrics import Exposition, Histogram, RouteMetrics
+from scheduler import ANONYMOUS_FLOW, LaneConfig, key_flow, parse_weights
+from storage import EXPIRED_REASON, MemoryStore, SQLiteStore, later_deadline
+from tracing import SpanExporter, build_spans, fork_trace, new_trace, stage_durations, trace_attrs, traceparent
+
+# How long an OpenAI-compatible completion waits for the browser to answer (seconds)
+COMPLETION_TIMEOUT = float(os.environ.get('COMPLETION_TIMEOUT', 120))
+# Upper bound for a per-request 'timeout' (seconds); larger values are capped to it
+MAX_TIMEOUT = float(os.environ.get('MAX_TIMEOUT', 3600))
+# Response cache for repeated prompts: entry lifetime (0 disables the cache), size
+# bounds for the in-memory tier, and an optional SQLite file that survives restarts
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH')
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_DISK_MAX_ENTRIES', 100000))
+# Upper bound for the ?wait= long-poll parameter on the worker dequeue endpoints (seconds)
+MAX_DEQUEUE_WAIT = 30
+# Most messages a worker can lease with one ?max= dequeue, or hold at once from its push stream
+MAX_FETCH = 50
+# How often an idle push stream sends a keep-alive, and how long before the
+# worker is asked to reconnect (seconds); see asgi.push_work
+PUSH_KEEPALIVE = 15
+PUSH_STREAM_LIFETIME = 300
+# Most messages per /api/v1/chat/batch call, and most IDs per bulk results call
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+# Upper bound for the wait of a bulk results call (seconds)
+MAX_BATCH_WAIT = 300
+# How long /api/v1/chat rejects a repeated message, and how many fingerprints are kept
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', RESPONSE_EXPIRATION_TIME))
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 10000))
+# How often the background sweeper expires dedup entries and buffered responses (seconds)
+SWEEP_INTERVAL = 30
+# How long a worker may hold a dequeued message before it is redelivered (seconds).
+# Partial uploads renew the lease, so this only needs to cover silent stretches.
+LEASE_TIMEOUT = float(os.environ.get('LEASE_TIMEOUT', 90))
+# How often expired leases are checked for redelivery (seconds)
+LEASE_CHECK_INTERVAL = 1
+# Deliveries after which a message is given up on and its caller is failed
+MAX_DELIVERIES = int(os.environ.get('MAX_DELIVERIES', 3))
+# Workers not heard from for this long are considered gone: they get no new
+# messages and their leases are redelivered without waiting for LEASE_TIMEOUT
+WORKER_TIMEOUT = 30
+# Heartbeat period advertised to workers on registration (seconds)
+HEARTBEAT_INTERVAL = 10
+# Gone workers with nothing in flight are dropped from the registry after this long
+WORKER_FORGET_AFTER = 600
+# Number of recent turnaround times kept per worker
+LATENCY_WINDOW = 20
+# Optional write-ahead journal of queued messages, leases and buffered responses,
+# replayed on startup so a restart does not drop them. Rewritten from the live
+# state once it grows past JOURNAL_COMPACT_BYTES.
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH')
+JOURNAL_COMPACT_BYTES = int(os.environ.get('JOURNAL_COMPACT_BYTES', 64 * 1024 * 1024))
+# Where the queue, leases, responses and dedup index live: 'memory' for this
+# process only, or 'sqlite:///path/to/state.db' for a file that several server
+# processes share. JOURNAL_PATH only applies to the memory store.
+STORE_URL = os.environ.get('STORE_URL', 'memory')
+# How often a process sharing the store looks for answers posted to other
+# processes and for newly queued messages (seconds)
+STORE_POLL_INTERVAL = float(os.environ.get('STORE_POLL_INTERVAL', 0.05))
+# How many answers are buffered for retrieval before the oldest are evicted
+MAX_RESPONSES = int(os.environ.get('MAX_RESPONSES', 1000))
+# Queued messages beyond which new ones are turned away with 429 (0 for no limit)
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 1000))
+# Completions counted when estimating how fast workers drain the queue (seconds)
+DRAIN_WINDOW = 60
+# Retry-After bounds for a full queue, and the value used before any drain rate is known
+MAX_RETRY_AFTER = 300
+DEFAULT_RETRY_AFTER = 30
+# Priority lanes, highest first, chosen per request with a 'priority' field or
+# X-Priority header. Within a lane, clients (API key or client ID) share workers
+# in proportion to their weight, given as 'client=weight,...' (default weight 1).
+PRIORITY_LANES = os.environ.get('PRIORITY_LANES', 'high,normal,low').split(',')
+DEFAULT_PRIORITY = os.environ.get('DEFAULT_PRIORITY', 'normal')
+CLIENT_WEIGHTS = parse_weights(os.environ.get('CLIENT_WEIGHTS', ''))
+# How long a request's lifecycle timeline is kept after its last event (seconds),
+# and how many timelines the in-memory store holds
+TIMELINE_TTL = float(os.environ.get('TIMELINE_TTL', 3600))
+TIMELINE_MAX_REQUESTS = int(os.environ.get('TIMELINE_MAX_REQUESTS', 10000))
+# Where finished requests are exported as OTLP/JSON spans: a JSONL file, or an
+# OTLP/HTTP collector URL such as http://localhost:4318/v1/traces. Unset: no export.
+TRACE_EXPORT = os.environ.get('TRACE_EXPORT')
+# /health reports degraded once messages are queued and no worker has taken one for this long (seconds)
+STALL_TIMEOUT = float(os.environ.get('STALL_TIMEOUT', 60))
+# Logs are written as JSON lines by a background thread, to LOG_PATH or stderr.
+# Requests are logged with their payload cut to LOG_PAYLOAD_MAX characters, for
+# the share of requests given by LOG_SAMPLE_RATE or, per route pattern, by
+# LOG_SAMPLE_RATES ('/v1/chat/completions=0.1,...'). LOG_FULL_BODIES logs whole
+# payloads; it can also be switched at runtime through /api/v1/debug/logging
+# when DEBUG_ENDPOINTS is set.
+LOG_PATH = os.environ.get('LOG_PATH')
+LOG_PAYLOAD_MAX = int(os.environ.get('LOG_PAYLOAD_MAX', 1024))
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+LOG_SAMPLE_RATES = parse_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+LOG_FULL_BODIES = os.environ.get('LOG_FULL_BODIES', '').lower() in ('1', 'true', 'yes')
+# /api/v1/debug/logging can switch on full payload logging for anyone who can reach
+# the server, so it only answers under --debug or with DEBUG_ENDPOINTS set.
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', '').lower() in ('1', 'true', 'yes')
+# Multi-turn conversations are pinned to the worker tab whose Grok thread holds
+# them, which is then sent only the new turn. Sessions are forgotten after
+# SESSION_TTL idle seconds, oldest first beyond SESSION_MAX_ENTRIES.
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 3600))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+# Opt-in capture of every incoming call to a JSONL file, for replay.py. Unset: no capture.
+CAPTURE_PATH = os.environ.get('CAPTURE_PATH')
+
 app = Flask(__name__)
 # Apply CORS to all routes including OpenAI-compatible endpoints
 CORS(app)
+log_handler = install_logging(app.logger, LOG_PATH, LOG_PAYLOAD_MAX)
+request_log = RequestLogger(app.logger, LOG_SAMPLE_RATE, LOG_SAMPLE_RATES, LOG_FULL_BODIES)
 
-# Message queue and response storage
-message_queue = Queue()
-response_storage = {
-    'responses': [],
-    'max_responses': 10,
-    'timestamp': time.time(),
-    'last_retrieved_index': -1  # Track the index of last retrieved response instead of storing all responses
-}
-processed_messages = set()
-response_lock = Lock()
-processed_lock = Lock()
+# Message queue, leases, response buffer and dedup index; see storage.py
+lanes = LaneConfig(PRIORITY_LANES, DEFAULT_PRIORITY, CLIENT_WEIGHTS)
+if STORE_URL == 'memory':
+    store = MemoryStore(
+        MAX_RESPONSES, RESPONSE_EXPIRATION_TIME, DEDUP_TTL, DEDUP_MAX_ENTRIES, lanes,
+        Journal(JOURNAL_PATH, MAX_RESPONSES, RESPONSE_EXPIRATION_TIME, JOURNAL_COMPACT_BYTES)
+        if JOURNAL_PATH else None,
+        TIMELINE_TTL, TIMELINE_MAX_REQUESTS)
+elif STORE_URL.startswith('sqlite:///'):
+    store = SQLiteStore(
+        STORE_URL[len('sqlite:///'):], MAX_RESPONSES, RESPONSE_EXPIRATION_TIME, DEDUP_TTL, DEDUP_MAX_ENTRIES,
+        lanes, TIMELINE_TTL)
+else:
+    raise ValueError(f'Unsupported STORE_URL: {STORE_URL}')
+# Callers blocked on a specific request ID, resolved by store_response. Each
+# entry lists its waiters and the latest partial text. A waiter holds a Future
+# for the final answer and, for streaming callers, a Queue of (text, is_final)
+# updates fed by partial uploads from the worker.
+pending_requests = {}
+pending_lock = Lock()
+# Work items that identical concurrent requests attach to instead of queueing
+# duplicates: request key -> request ID, and the reverse. Guarded by pending_lock.
+flights = {}
+flight_keys = {}
+flight_stats = {'coalesced': 0}
+# Flights that some caller submitted to fetch later, so they are not cancelled
+# when every waiting caller gives up. Guarded by pending_lock.
+detached_flights = set()
+# Requests withdrawn with DELETE /api/v1/requests/<id> or because their caller
+# went away, by how and by where they were. Guarded by cancel_lock.
+cancel_stats = {'requested': 0, 'abandoned': 0, 'queued': 0, 'leased': 0}
+cancel_lock = Lock()
+# Partial text uploaded so far per leased message, which uploads with an
+# 'offset' extend. Dropped when the lease ends, and oldest first beyond
+# PARTIAL_MAX_ENTRIES; a worker whose text was dropped resends all of it.
+PARTIAL_MAX_ENTRIES = 10000
+partial_texts = OrderedDict()
+partial_lock = Lock()
+# Completion times of leased messages within DRAIN_WINDOW, for Retry-After,
+# and counts of turned away and expired messages. Guarded by admission_lock.
+drain_times = deque()
+admission_stats = {'rejected': 0, 'expired': 0}
+admission_lock = Lock()
+# Latency of each pipeline stage and per-route request metrics, for /metrics
+queue_wait_seconds = Histogram()  # enqueue -> first dispatch to a worker
+answer_seconds = Histogram()  # dispatch -> answer stored
+retrieval_delay_seconds = Histogram()  # answer stored -> fetched by polling
+route_metrics = RouteMetrics()
+process_started = time.time()
+# Spans of finished requests; see tracing.py
+span_exporter = SpanExporter(TRACE_EXPORT)
+traffic_capture = TrafficCapture(CAPTURE_PATH)
+# Browser workers seen by this process, keyed by worker ID
+workers = {}
+worker_lock = Lock()
+# Dequeue calls wait on this condition; enqueues notify it. waiting_workers
+# counts the dequeue calls currently held open per worker ID, and
+# waiting_slots holds the slot limit of each one's latest call (None: no
+# limit). dispatch_state counts the wakeups, so a dequeue call that leased
+# nothing outside the condition can tell whether it missed one.
+dispatch_cond = Condition()
+waiting_workers = {}
+waiting_slots = {}
+dispatch_state = {'wakeups': 0}
+# Conversation sessions: session key -> {'worker', 'updated'}, least recently
+# used first. A key is 'conversation:<id>' for callers that name their
+# conversation, otherwise a hash of the conversation up to the last answer.
+sessions = OrderedDict()
+session_stats = {'continued': 0, 'replayed': 0}
+session_lock = Lock()
+
+
+class DeliveryFailed(Exception):
+    """Raised to a waiting caller when its message could not be delivered to a worker"""
+
+
+class QueueFull(Exception):
+    """Raised when a new message would grow the queue past MAX_QUEUE_DEPTH"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Queue is full, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class InvalidTimeout(Exception):
+    """Raised when a request's 'timeout' is not a positive number of seconds"""
+
+    def __init__(self, value):
+        super().__init__(f'timeout must be a positive number of seconds, got {value!r}')
+
+
+class InvalidRequest(Exception):
+    """Raised for a malformed request body; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """Finished answers keyed by model plus normalized messages.
+
+    The in-memory tier is an LRU bounded by max_entries and max_bytes. When
+    path is set, entries are also written to a SQLite file which is consulted
+    on memory misses, so the cache survives restarts.
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes, path=None, disk_max_entries=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()  # key -> (value, time stored), least recently used first
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, stored REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS response_cache_stored ON response_cache (stored)')
+            self._db.commit()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def key(model, messages):
+        """Stable key for a conversation, ignoring whitespace differences"""
+        normalized = [
+            [str(msg.get('role', '')), ' '.join(str(msg.get('content', '')).split())]
+            for msg in messages
+        ]
+        payload = json.dumps([model, normalized], separators=(',', ':'))
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value.encode('utf-8'))
+
+    def _store(self, key, value, stored):
+        """Insert into the memory tier, evicting LRU entries. Caller must hold _lock."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(key, old[0])
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, stored)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            old_key, (old_value, _) = self._entries.popitem(last=False)
+            self._bytes -= self._size(old_key, old_value)
+            self.evictions += 1
+
+    def get(self, key):
+        """Return the cached answer for key, or None"""
+        now = time.time()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value, stored FROM response_cache WHERE key = ? AND stored > ?',
+                    (key, now - self.ttl)).fetchone()
+                if row is not None:
+                    self._store(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._store(key, value, now)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO response_cache (key, value, stored) VALUES (?, ?, ?)',
+                    (key, value, now))
+                self._db.commit()
+
+    def sweep(self):
+        """Drop expired entries from both tiers and trim the disk tier to size"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [key for key, (_, stored) in self._entries.items() if stored <= cutoff]
+            for key in expired:
+                value, _ = self._entries.pop(key)
+                self._bytes -= self._size(key, value)
+            if self._db is not None:
+                self._db.execute('DELETE FROM response_cache WHERE stored <= ?', (cutoff,))
+                self._db.execute(
+                    'DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache '
+                    'ORDER BY stored DESC LIMIT -1 OFFSET ?)', (self.disk_max_entries,))
+                self._db.commit()
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            stats = {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'persistent': self._db is not None
+            }
+            if self._db is not None:
+                stats['disk_entries'] = self._db.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+            return stats
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_PATH, RESPONSE_CACHE_DISK_MAX_ENTRIES)
+
+
+def new_request_id():
+    """Generate an ID that travels with a message from the queue to its response"""
+    return f'chatcmpl-{uuid.uuid4().hex}'
+
+def enqueue_message(message, wait=False, stream=False, cache_key=None, key=None, make_partials=Queue,
+                    deadline=None, lane=None, flow=None, trace=None, session=None):
+    """Queue a message for the browser worker.
+
+    When key is given and an identical request is already in flight, the
+    caller is attached to that work item instead of queueing a duplicate.
+    When cache_key is given, the answer is stored in response_cache under it.
+    A message still queued at its deadline (epoch seconds) is dropped
+    instead of being dispatched. lane and flow place the message in the
+    scheduler (see scheduler.py), and trace (from tracing.new_trace) starts
+    its timeline. session (from start_session) continues a conversation.
+    Raises QueueFull if the queue is at MAX_QUEUE_DEPTH.
+
+    Returns (request_id, waiter, coalesced). The waiter is None unless wait
+    is True; its Future is resolved with the assistant content once the
+    worker posts it back.
+    """
+    with pending_lock:
+        request_id = flights.get(key) if key else None
+        coalesced = request_id is not None
+        if coalesced:
+            flight_stats['coalesced'] += 1
+        else:
+            check_admission()
+            request_id = new_request_id()
+            if key:
+                flights[key] = request_id
+                flight_keys[request_id] = key
+        if key and not wait:
+            detached_flights.add(request_id)
+        waiter = None
+        if wait:
+            waiter = {
+                'future': Future(),
+                'partials': make_partials() if stream else None
+            }
+            entry = pending_requests.setdefault(request_id, {'waiters': [], 'text': ''})
+            entry['waiters'].append(waiter)
+            # A streaming caller that joins late starts from the text generated so far
+            if stream and entry['text']:
+                waiter['partials'].put((entry['text'], False))
+    if coalesced:
+        # The shared item must stay queued for as long as its latest caller waits
+        store.extend_deadline(request_id, deadline)
+        store.record_events([(request_id, 'coalesced', time.time(), None)])
+    else:
+        item = {
+            'id': request_id,
+            'message': message,
+            'deadline': deadline,
+            'lane': lanes.lane_for(lane),
+            'flow': flow or ANONYMOUS_FLOW,
+            'enqueued_at': time.time()
+        }
+        if cache_key:
+            item['cache_key'] = cache_key
+        if session:
+            item.update(session)
+        store.record_events(enqueue_events(item, trace))
+        store.push(item)
+        notify_workers()
+    return request_id, waiter, coalesced
+
+def enqueue_events(item, trace):
+    """Timeline events of a newly queued item"""
+    events = [(item['id'], 'enqueued', item['enqueued_at'], {'lane': item['lane'], 'flow': item['flow']})]
+    if trace is not None:
+        events.insert(0, (item['id'], 'received', trace['received'], trace_attrs(trace)))
+    return events
+
+def cached_events(request_id, trace):
+    """Timeline events of a request answered from the response cache"""
+    return [
+        (request_id, 'received', trace['received'], trace_attrs(trace)),
+        (request_id, 'response_stored', time.time(), {'cached': True})
+    ]
+
+def enqueue_batch(entries):
+    """Queue many messages with a single store write.
+
+    Each entry is a dict with 'message', 'key', 'cache_key', 'deadline',
+    'lane', 'flow' and 'trace', and is handled like its own /api/v1/chat call: it
+    joins an identical message in flight (including an earlier entry of
+    the batch), is refused if it was processed recently, and is rejected
+    once the queue reaches MAX_QUEUE_DEPTH. Returns one dict per entry
+    with its 'status' ('queued', 'coalesced', 'duplicate' or 'rejected')
+    and, unless refused, its 'id'. Rejected entries carry 'retry_after'.
+    """
+    room = MAX_QUEUE_DEPTH - store.queue_depth() if MAX_QUEUE_DEPTH else len(entries)
+    results = []
+    items = {}  # request ID -> item, in batch order
+    events = []
+    rejected = 0
+    now = time.time()
+    for entry in entries:
+        key = entry['key']
+        if find_flight(key) is None:
+            if room <= 0:
+                rejected += 1
+                results.append({'status': 'rejected'})
+                continue
+            if store.check_and_add(entry['message']):
+                results.append({'status': 'duplicate'})
+                continue
+        with pending_lock:
+            request_id = flights.get(key)
+            coalesced = request_id is not None
+            if coalesced:
+                flight_stats['coalesced'] += 1
+            else:
+                request_id = new_request_id()
+                flights[key] = request_id
+                flight_keys[request_id] = key
+            detached_flights.add(request_id)
+        if coalesced:
+            if request_id in items:
+                items[request_id]['deadline'] = later_deadline(items[request_id]['deadline'], entry['deadline'])
+            else:
+                store.extend_deadline(request_id, entry['deadline'])
+            events.append((request_id, 'coalesced', now, None))
+            results.append({'id': request_id, 'status': 'coalesced'})
+            continue
+        room -= 1
+        item = items[request_id] = {
+            'id': request_id,
+            'message': entry['message'],
+            'deadline': entry['deadline'],
+            'lane': lanes.lane_for(entry['lane']),
+            'flow': entry['flow'] or ANONYMOUS_FLOW,
+            'enqueued_at': now
+        }
+        if entry['cache_key']:
+            item['cache_key'] = entry['cache_key']
+        events.extend(enqueue_events(item, entry['trace']))
+        results.append({'id': request_id, 'status': 'queued'})
+    if events:
+        store.record_events(events)
+    if items:
+        store.push_many(list(items.values()))
+        notify_workers()
+    if rejected:
+        with admission_lock:
+            admission_stats['rejected'] += rejected
+        wait = retry_after(rejected)
+        for result in results:
+            if result['status'] == 'rejected':
+                result['retry_after'] = wait
+    return results
+
+def record_drain():
+    """Note that a dispatched message was answered"""
+    now = time.time()
+    with admission_lock:
+        drain_times.append(now)
+        while drain_times and drain_times[0] <= now - DRAIN_WINDOW:
+            drain_times.popleft()
+
+def drain_rate():
+    """Answers per second over the last DRAIN_WINDOW, or None before any were seen"""
+    now = time.time()
+    with admission_lock:
+        while drain_times and drain_times[0] <= now - DRAIN_WINDOW:
+            drain_times.popleft()
+        if not drain_times:
+            return None
+        return len(drain_times) / DRAIN_WINDOW
+
+def retry_after(excess):
+    """Seconds for the workers to drain excess messages, for Retry-After"""
+    rate = drain_rate()
+    if rate is None:
+        return DEFAULT_RETRY_AFTER
+    return min(max(math.ceil(excess / rate), 1), MAX_RETRY_AFTER)
+
+def check_admission():
+    """Raise QueueFull if the queue has no room for another message"""
+    if not MAX_QUEUE_DEPTH:
+        return
+    depth = store.queue_depth()
+    if depth < MAX_QUEUE_DEPTH:
+        return
+    with admission_lock:
+        admission_stats['rejected'] += 1
+    # Time to make room for one more
+    raise QueueFull(retry_after(depth - MAX_QUEUE_DEPTH + 1))
+
+def queue_full_body(error):
+    return {
+        'error': {
+            'message': str(error),
+            'type': 'rate_limit_error'
+        }
+    }
+
+def client_flow(data, headers):
+    """Who a request is scheduled for: its API key, else its client ID or OpenAI 'user' field"""
+    authorization = headers.get('Authorization', '')
+    if authorization.startswith('Bearer ') and authorization[7:].strip():
+        return key_flow(authorization[7:].strip())
+    return headers.get('X-Client-ID') or data.get('user') or ANONYMOUS_FLOW
+
+def request_timeout(value, default=None):
+    """A request's 'timeout' in seconds, capped at MAX_TIMEOUT, or default if it has none.
+
+    Raises InvalidTimeout unless value is a positive, finite number.
+    """
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        raise InvalidTimeout(value)
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise InvalidTimeout(value) from None
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise InvalidTimeout(value)
+    return min(timeout, MAX_TIMEOUT)
+
+def timestamp(value):
+    """A Unix timestamp sent by a client, or None if value is missing or not a finite number"""
+    if not value or isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+def request_lane(data, headers):
+    """Priority lane from the 'priority' field or X-Priority header; unknown names get the default"""
+    return lanes.lane_for(data.get('priority') or headers.get('X-Priority'))
+
+def request_key(data, messages):
+    """Identity of a request for coalescing and caching: model plus normalized messages"""
+    return ResponseCache.key(data.get('model'), messages)
+
+def flight_key(key, data, headers, lane, flow):
+    """Key under which identical requests in flight share one work item.
+
+    Besides the request key, requests must agree on the lane and client
+    flow that schedule the item, so a low-priority caller does not ride on
+    a high-priority one, and on the conversation it continues, whose
+    session is filed for the item's caller only.
+    """
+    return key, lane, flow, data.get('conversation_id') or headers.get('X-Conversation-ID')
+
+def cache_key_for(data, key, headers):
+    """Response cache key for a request, or None if caching is disabled or opted out of"""
+    if not response_cache.enabled or data.get('cache') is False:
+        return None
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    return key
+
+def resolved_waiter(content, partials=None):
+    """A waiter that is already answered, e.g. from the response cache"""
+    waiter = {'future': Future(), 'partials': partials}
+    waiter['future'].set_result(content)
+    if partials is not None:
+        partials.put((content, True))
+    return waiter
+
+def notify_workers():
+    """Wake the workers waiting for a message"""
+    with dispatch_cond:
+        dispatch_state['wakeups'] += 1
+        dispatch_cond.notify_all()
+
+def release_request(request_id, waiter, cancel=False):
+    """Stop tracking a waiting caller, e.g. after it timed out or disconnected.
+
+    With cancel, the request is cancelled if that was the last caller
+    waiting for it and nobody submitted it to fetch the answer later.
+    """
+    with pending_lock:
+        entry = pending_requests.get(request_id)
+        if entry is None:
+            return
+        entry['waiters'] = [other for other in entry['waiters'] if other is not waiter]
+        if entry['waiters']:
+            return
+        del pending_requests[request_id]
+        abandoned = cancel and not waiter['future'].done() and request_id not in detached_flights
+    if abandoned:
+        cancel_request(request_id, 'The caller stopped waiting for the answer', requested=False)
+
+def wait_for_response(request_id, waiter, timeout):
+    """Block until the response for request_id arrives, or return None on timeout"""
+    try:
+        return waiter['future'].result(timeout=timeout)
+    except FutureTimeoutError:
+        return None
+    finally:
+        release_request(request_id, waiter, cancel=True)
+
+def publish_partial(request_id, text):
+    """Forward the text generated so far to the streaming callers, if any"""
+    with pending_lock:
+        entry = pending_requests.get(request_id)
+        if entry is None:
+            return False
+        entry['text'] = text
+        streams = [waiter['partials'] for waiter in entry['waiters'] if waiter['partials'] is not None]
+    for partials in streams:
+        partials.put((text, False))
+    return bool(streams)
+
+def append_partial(request_id, text, offset=None):
+    """Text generated so far once text is written at offset (None: text is all of it).
+
+    Returns None if the server holds fewer than offset characters.
+    """
+    with partial_lock:
+        if offset is not None:
+            held = partial_texts.get(request_id, '')
+            if offset > len(held):
+                return None
+            text = held[:offset] + text
+        partial_texts[request_id] = text
+        partial_texts.move_to_end(request_id)
+        while len(partial_texts) > PARTIAL_MAX_ENTRIES:
+            partial_texts.popitem(last=False)
+    return text
+
+def finish_flight(request_id):
+    """Stop coalescing onto request_id and return its waiters. Caller must hold pending_lock."""
+    key = flight_keys.pop(request_id, None)
+    if key is not None and flights.get(key) == request_id:
+        del flights[key]
+    detached_flights.discard(request_id)
+    entry = pending_requests.pop(request_id, None)
+    return entry['waiters'] if entry is not None else []
+
+def resolve_request(request_id, content):
+    """Hand a worker-produced answer to every caller waiting on request_id"""
+    with pending_lock:
+        waiters = finish_flight(request_id)
+    for waiter in waiters:
+        if waiter['future'].done():
+            continue
+        if waiter['partials'] is not None:
+            waiter['partials'].put((content, True))
+        waiter['future'].set_result(content)
+    if waiters:
+        mark_delivered(request_id, 'waiter')
+    return bool(waiters)
+
+def mark_delivered(request_id, via):
+    """Record the first hand-over of an answer to its caller and export the request's trace"""
+    if store.record_once(request_id, 'delivered', time.time(), {'via': via}):
+        export_trace(request_id)
+
+def mark_given_up(request_id, stage, reason):
+    """Record that a message was dropped ('expired'), failed or cancelled, and export its trace"""
+    if store.record_once(request_id, stage, time.time(), {'reason': reason}):
+        export_trace(request_id)
+
+def export_trace(request_id):
+    if span_exporter.enabled:
+        span_exporter.export(build_spans(request_id, store.timeline(request_id)))
+
+def fail_request(request_id, reason):
+    """Wake every caller waiting on request_id with a DeliveryFailed error"""
+    with pending_lock:
+        waiters = finish_flight(request_id)
+    for waiter in waiters:
+        if waiter['future'].done():
+            continue
+        if waiter['partials'] is not None:
+            waiter['partials'].put((None, True))
+        waiter['future'].set_exception(DeliveryFailed(reason))
+    return bool(waiters)
+
+def cancel_request(request_id, reason, requested=True):
+    """Withdraw a request nobody wants the answer to any more.
+
+    A queued message is dropped before any worker sees it. A leased one is
+    taken back from its worker, which learns to abandon it from the reply
+    to its next upload. Callers still waiting get a DeliveryFailed error.
+    Returns 'queued', 'leased', or None if the request was neither.
+    """
+    state, lease = store.cancel(request_id, reason)
+    if state is None:
+        return None
+    if lease is not None:
+        end_lease(lease, completed=False, cancelled=True)
+    with cancel_lock:
+        cancel_stats['requested' if requested else 'abandoned'] += 1
+        cancel_stats[state] += 1
+    mark_given_up(request_id, 'cancelled', reason)
+    fail_request(request_id, reason)
+    return state
+
+def find_flight(key):
+    """Request ID of the in-flight work item for key, if any"""
+    with pending_lock:
+        return flights.get(key)
+
+def watch_requests(request_ids):
+    """Attach a waiter to each request ID, including ones queued without a waiter.
+
+    Returns {request_id: waiter}; release each with release_request.
+    """
+    waiters = {}
+    with pending_lock:
+        for request_id in request_ids:
+            waiter = {'future': Future(), 'partials': None}
+            pending_requests.setdefault(request_id, {'waiters': [], 'text': ''})['waiters'].append(waiter)
+            waiters[request_id] = waiter
+    return waiters
+
+def batch_result(request_id, waiter):
+    """Result entry for a watched request, or None while it is still pending"""
+    future = waiter['future']
+    failed = future.done() and future.exception() is not None
+    if not failed:
+        # Answers posted before the waiter was attached are only in the store
+        sequence, stored = store.get_response(request_id)
+        if stored is not None:
+            retrieval_delay_seconds.observe(time.time() - stored['timestamp'])
+            mark_delivered(request_id, 'poll')
+            return {
+                'id': request_id,
+                'status': 'ready',
+                'response': stored['response'],
+                'timestamp': stored['timestamp'],
+                'response_index': sequence
+            }
+        if future.done():
+            # Answered, but already evicted from the response buffer
+            return {'id': request_id, 'status': 'ready', 'response': future.result(), 'timestamp': time.time()}
+    # Requests given up on before the waiter was attached never resolve it
+    failure = store.failure(request_id)
+    if failure is not None:
+        return failure_result(request_id, *failure)
+    if failed:
+        return {'id': request_id, 'status': 'failed', 'error': str(future.exception())}
+    return None
+
+def failure_result(request_id, status, reason):
+    """Result entry for a request given up on: 'failed', 'expired' or 'cancelled'"""
+    if status == 'cancelled':
+        return {'id': request_id, 'status': status}
+    return {'id': request_id, 'status': status, 'error': reason}
+
+def ready_results(waiters):
+    """Result entries of the watched requests that are no longer pending"""
+    return [result for result in (batch_result(request_id, waiter) for request_id, waiter in waiters.items())
+            if result is not None]
+
+def pending_ids(request_ids, results):
+    """The request IDs without a result, in order"""
+    done = {result['id'] for result in results}
+    return [request_id for request_id in request_ids if request_id not in done]
+
+def results_request(data):
+    """(request IDs, stream flag, wait) of a bulk results call; raises InvalidRequest"""
+    request_ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(request_ids, list) or not request_ids:
+        raise InvalidRequest('Request IDs are required')
+    if len(request_ids) > MAX_BATCH_SIZE:
+        raise InvalidRequest(f'At most {MAX_BATCH_SIZE} IDs per call', 413)
+    stream_mode = bool(data.get('stream', False))
+    try:
+        wait = float(data.get('wait', COMPLETION_TIMEOUT if stream_mode else 0))
+    except (TypeError, ValueError):
+        raise InvalidRequest('wait must be a number of seconds') from None
+    # NaN fails both comparisons and ends up as 0
+    wait = min(wait, MAX_BATCH_WAIT) if wait > 0 else 0
+    return list(dict.fromkeys(str(request_id) for request_id in request_ids)), stream_mode, wait
+
+def poll_results(request_ids, wait):
+    """Results for the requests answered so far, long-polling up to wait seconds for the first.
+
+    Returns (results, pending IDs).
+    """
+    waiters = watch_requests(request_ids)
+    try:
+        results = ready_results(waiters)
+        if not results and wait > 0:
+            wait_futures([waiter['future'] for waiter in waiters.values()], timeout=wait,
+                         return_when=FIRST_COMPLETED)
+            results = ready_results(waiters)
+    finally:
+        for request_id, waiter in waiters.items():
+            release_request(request_id, waiter)
+    return results, pending_ids(waiters, results)
+
+def stream_results(request_ids, wait):
+    """Yield an NDJSON line per request as it completes, for up to wait seconds.
+
+    Requests still unanswered at the end get a line with status 'pending'.
+    """
+    waiters = watch_requests(request_ids)
+    try:
+        remaining = {}
+        for request_id, waiter in waiters.items():
+            result = batch_result(request_id, waiter)
+            if result is None:
+                remaining[waiter['future']] = request_id
+            else:
+                yield json.dumps(result) + '\n'
+        try:
+            for future in as_completed(list(remaining), timeout=wait):
+                request_id = remaining.pop(future)
+                yield json.dumps(batch_result(request_id, waiters[request_id])) + '\n'
+        except FutureTimeoutError:
+            pass
+        for request_id in remaining.values():
+            yield json.dumps({'id': request_id, 'status': 'pending'}) + '\n'
+    finally:
+        for request_id, waiter in waiters.items():
+            release_request(request_id, waiter)
+
+def sse_event(payload):
+    """Format a payload as a server-sent event"""
+    return f'data: {json.dumps(payload)}\n\n'
+
+def completion_chunk(request_id, created, model, delta, finish_reason=None):
+    """One chat.completion.chunk payload of a streamed answer"""
+    return {
+        'id': request_id,
+        'object': 'chat.completion.chunk',
+        'created': created,
+        'model': model,
+        'choices': [
+            {
+                'index': 0,
+                'delta': delta,
+                'finish_reason': finish_reason
+            }
+        ]
+    }
+
+def stream_completion(request_id, waiter, model, timeout):
+    """Yield OpenAI-style chat.completion.chunk events as the worker uploads text"""
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None):
+        return sse_event(completion_chunk(request_id, created, model, delta, finish_reason))
+
+    deadline = time.time() + timeout
+    sent = ''
+    try:
+        yield chunk({'role': 'assistant'})
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                yield sse_event(timeout_error_body(request_id, timeout))
+                break
+            try:
+                text, is_final = waiter['partials'].get(timeout=remaining)
+            except Empty:
+                continue
+            if text is None:
+                yield sse_event({
+                    'error': {
+                        'message': str(waiter['future'].exception()),
+                        'type': 'delivery_error',
+                        'request_id': request_id
+                    }
+                })
+                break
+            # Partials carry the full text so far; only the unseen suffix is sent.
+            # If the worker's view of the text was rewritten we cannot retract
+            # what was already streamed, so wait for it to catch up again.
+            if text.startswith(sent) and len(text) > len(sent):
+                yield chunk({'content': text[len(sent):]})
+                sent = text
+            if is_final:
+                yield chunk({}, finish_reason='stop')
+                break
+        yield 'data: [DONE]\n\n'
+    finally:
+        release_request(request_id, waiter, cancel=True)
+
+
+def sweep_expired():
+    """Background loop that keeps the dedup index and response buffer bounded in time"""
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            store.sweep()
+            response_cache.sweep()
+            forget_gone_workers()
+            sweep_sessions()
+        except Exception as e:
+            app.logger.error(f'Error in sweeper: {str(e)}')
+
+
+def touch_worker(worker_id, info=None):
+    """Record that worker_id is alive, registering it on first contact"""
+    now = time.time()
+    with worker_lock:
+        worker = workers.get(worker_id)
+        if worker is None:
+            worker = workers[worker_id] = {
+                'id': worker_id,
+                'registered_at': now,
+                'inflight': 0,
+                'completed': 0,
+                'expired': 0,
+                'cancelled': 0,
+                'latencies': deque(maxlen=LATENCY_WINDOW),
+                'session': None,  # conversation the worker's Grok thread holds, if any
+                'info': {}
+            }
+        worker['last_seen'] = now
+        if info:
+            worker['info'].update(info)
+    return worker
+
+def worker_is_healthy(worker, now):
+    return now - worker['last_seen'] < WORKER_TIMEOUT
+
+def worker_load(worker_id):
+    """Sort key for dispatch: fewer messages in flight first, then faster turnaround.
+
+    Caller must hold worker_lock.
+    """
+    worker = workers.get(worker_id)
+    if worker is None:
+        return (0, 0.0)
+    latencies = worker['latencies']
+    return (worker['inflight'], sum(latencies) / len(latencies) if latencies else 0.0)
+
+def is_preferred_worker(worker_id):
+    """Whether worker_id should take the next message ahead of the other waiting workers.
+
+    Caller must hold dispatch_cond. Anonymous workers are always eligible,
+    and workers waiting with all their slots taken don't compete.
+    """
+    if worker_id is None:
+        return True
+    with worker_lock:
+        load = worker_load(worker_id)
+        return all(load <= worker_load(other) for other in waiting_workers
+                   if other is not None and other != worker_id and has_free_slot(other))
+
+def has_free_slot(worker_id):
+    """Whether a waiting worker could take a message now. Caller must hold dispatch_cond and worker_lock."""
+    slots = waiting_slots.get(worker_id)
+    return slots is None or worker_load(worker_id)[0] < slots
+
+def worker_summary(worker, now):
+    latencies = worker['latencies']
+    return {
+        'id': worker['id'],
+        'healthy': worker_is_healthy(worker, now),
+        'inflight': worker['inflight'],
+        'completed': worker['completed'],
+        'expired': worker['expired'],
+        'cancelled': worker['cancelled'],
+        'avg_turnaround': sum(latencies) / len(latencies) if latencies else None,
+        'last_turnaround': latencies[-1] if latencies else None,
+        'last_seen': worker['last_seen'],
+        'seconds_since_seen': now - worker['last_seen'],
+        'registered_at': worker['registered_at'],
+        'waiting': waiting_workers.get(worker['id'], 0),
+        'info': worker['info']
+    }
+
+def forget_gone_workers():
+    """Drop workers that have been silent for WORKER_FORGET_AFTER with nothing in flight"""
+    cutoff = time.time() - WORKER_FORGET_AFTER
+    with worker_lock:
+        gone = [worker_id for worker_id, worker in workers.items()
+                if worker['last_seen'] < cutoff and worker['inflight'] == 0]
+        for worker_id in gone:
+            del workers[worker_id]
+    return len(gone)
+
+def lease_message(worker_id=None, limit=1):
+    """Lease up to limit queued messages to worker_id; returns the leases, if any"""
+    leases, expired = store.lease_next(worker_id, LEASE_TIMEOUT, limit)
+    for request_id in expired:
+        # Nobody is waiting for these any more; let coalesced lookups start afresh
+        mark_given_up(request_id, 'expired', EXPIRED_REASON)
+        fail_request(request_id, EXPIRED_REASON)
+    if expired:
+        with admission_lock:
+            admission_stats['expired'] += len(expired)
+    for lease in leases:
+        item = lease['item']
+        if item['deliveries'] == 1 and 'enqueued_at' in item:
+            queue_wait_seconds.observe(lease['leased_at'] - item['enqueued_at'])
+    if leases:
+        store.record_events([
+            (lease['item']['id'], 'dequeued', lease['leased_at'],
+             {'worker': worker_id, 'delivery': lease['item']['deliveries']})
+            for lease in leases
+        ])
+        with worker_lock:
+            if worker_id in workers:
+                workers[worker_id]['inflight'] += len(leases)
+    return leases
+
+def end_lease(lease, completed, cancelled=False):
+    """Update the counters of the worker that held an ended lease"""
+    with partial_lock:
+        partial_texts.pop(lease['item']['id'], None)
+    with worker_lock:
+        worker = workers.get(lease['worker'])
+        # With a shared store the lease may have been handed out by another process
+        if worker is None or not worker['inflight']:
+            return
+        worker['inflight'] -= 1
+        if completed:
+            worker['completed'] += 1
+            worker['latencies'].append(time.time() - lease['leased_at'])
+        elif cancelled:
+            worker['cancelled'] += 1
+        else:
+            worker['expired'] += 1
+    # A worker waiting on its push stream for a free slot can take the next message
+    if lease['worker'] in waiting_workers:
+        notify_workers()
+
+def acknowledge(request_id, lease_id=None, worker_id=None):
+    """Release the lease for request_id so it is not redelivered.
+
+    When lease_id is given it must match the current lease, otherwise
+    worker_id (if given) must hold it; an ack for a lease that already
+    expired and was handed to another worker is ignored.
+    Returns the ended lease, or None.
+    """
+    lease = store.acknowledge(request_id, lease_id, worker_id)
+    if lease is not None:
+        end_lease(lease, completed=True)
+    return lease
+
+def renew_lease(request_id):
+    """Push back the expiry of a lease whose worker is still making progress"""
+    return store.renew_lease(request_id, time.time() + LEASE_TIMEOUT)
+
+def expire_lease(request_id, lease_id=None):
+    """Let the reaper redeliver request_id right away, e.g. when its worker gives up"""
+    return store.expire_lease(request_id, lease_id)
+
+def requeue_expired_leases():
+    """Put messages whose lease expired, or whose worker went silent, back on the queue"""
+    now = time.time()
+    with worker_lock:
+        gone = {worker_id for worker_id, worker in workers.items() if not worker_is_healthy(worker, now)}
+    requeued = 0
+    # Conversations waiting for a worker that went away are replayed by another one.
+    # With a shared store, workers unknown here may be polling another process.
+    with worker_lock:
+        stranded = [worker_id for worker_id in store.pinned_workers()
+                    if worker_id in gone or (worker_id not in workers and not store.shared)]
+    if stranded:
+        requeued += store.unpin(stranded)
+    for lease in store.take_expired_leases(now, gone):
+        end_lease(lease, completed=False)
+        item = lease['item']
+        # The worker may not come back, so the message is open to any worker from now on
+        item['affinity'] = None
+        if store.is_answered(item['id']):
+            continue
+        if item['deliveries'] >= MAX_DELIVERIES:
+            app.logger.warning(f"Giving up on {item['id']} after {item['deliveries']} deliveries")
+            reason = f"Message was not answered after {item['deliveries']} delivery attempts"
+            store.fail(item, reason)
+            mark_given_up(item['id'], 'failed', reason)
+            fail_request(item['id'], reason)
+            continue
+        store.record_events([(item['id'], 'requeued', now, {'worker': lease['worker']})])
+        store.requeue(item)
+        requeued += 1
+    if requeued:
+        notify_workers()
+    return requeued
+
+def reap_leases():
+    """Background loop that redelivers messages whose worker went away"""
+    while True:
+        time.sleep(LEASE_CHECK_INTERVAL)
+        try:
+            requeue_expired_leases()
+        except Exception as e:
+            app.logger.error(f'Error in lease reaper: {str(e)}')
+
+background_threads = []
+
+def relay_shared_updates():
+    """Background loop that hands answers posted to other processes to the callers waiting here"""
+    while True:
+        time.sleep(STORE_POLL_INTERVAL)
+        try:
+            with pending_lock:
+                known = {request_id: entry['text'] for request_id, entry in pending_requests.items()}
+            if not known:
+                continue
+            answers, partials, failures = store.poll(list(known))
+            for request_id, text in partials.items():
+                if request_id not in answers and text != known[request_id]:
+                    publish_partial(request_id, text)
+            for request_id, text in answers.items():
+                resolve_request(request_id, text)
+            for request_id, reason in failures.items():
+                fail_request(request_id, reason)
+        except Exception as e:
+            app.logger.error(f'Error in store relay: {str(e)}')
+
+def start_background_threads():
+    """Load the store and start the background loops, once per process"""
+    if background_threads:
+        return
+    restored = store.start()
+    if restored:
+        app.logger.info(f"Store has {restored['queued']} queued, {restored['leased']} leased "
+                        f"and {restored['responses']} buffered responses")
+    loops = [(sweep_expired, 'sweeper'), (reap_leases, 'lease-reaper')]
+    if store.shared:
+        loops.append((relay_shared_updates, 'store-relay'))
+    for target, name in loops:
+        thread = Thread(target=target, name=name, daemon=True)
+        thread.start()
+        background_threads.append(thread)
 
 
 # Rate limiting function has been removed
 
+@app.before_request
+def record_worker_contact():
+    """Any request carrying X-Worker-ID counts as a heartbeat from that worker"""
+    g.request_started = time.perf_counter()
+    worker_id = request.headers.get('X-Worker-ID')
+    if worker_id:
+        touch_worker(worker_id)
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and its time to response headers under its route pattern"""
+    started = g.get('request_started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route_metrics.observe(request.url_rule.rule if request.url_rule else None, response.status_code, elapsed)
+        if traffic_capture.enabled:
+            traffic_capture.record(time.time() - elapsed, request.method, request.path,
+                                   request.query_string.decode('latin-1'), request.headers,
+                                   request.get_data(cache=True), response.status_code, elapsed)
+    # Lets the caller link its own span to this request's trace
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers['traceparent'] = traceparent(trace)
+    return response
+
 @app.route('/api/v1/chat', methods=['POST'])
 def chat():
     try:
@@ -37,28 +1230,63 @@ def chat():
 
         data = request.get_json()
         message = data.get('message')
+        g.trace = trace = new_trace(request.headers)
         
         if not message:
             return jsonify({
                 'error': 'Message is required'
             }), 400
+        timeout = request_timeout(data.get('timeout'))
         
-        # Check if message was already processed
-        with processed_lock:
-            if message in processed_messages:
+        # Repeated prompts are answered from the cache, ready at /api/v1/responses/<id>
+        key = request_key(data, [{'role': 'user', 'content': message}])
+        cache_key = cache_key_for(data, key, request.headers)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            request_id = new_request_id()
+            store.add_response(request_id, cached)
+            store.record_events(cached_events(request_id, trace))
+            return jsonify({
+                'success': True,
+                'id': request_id,
+                'cached': True,
+                'message': 'Message answered from cache'
+            })
+        
+        # An identical message still being answered is shared rather than rejected
+        lane = request_lane(data, request.headers)
+        flow = client_flow(data, request.headers)
+        key = flight_key(key, data, request.headers, lane, flow)
+        request_id = find_flight(key)
+        if request_id is None:
+            # Turn the message away before it is remembered as processed
+            check_admission()
+            # Check if message was already processed recently, marking it processed otherwise
+            if store.check_and_add(message):
                 return jsonify({
                     'error': 'Message already processed'
                 }), 400
         
-        # Add message to queue and mark as processed
-        message_queue.put(message)
-        with processed_lock:
-            processed_messages.add(message)
+        # Add message to queue, or join the identical one that is in flight.
+        # With a timeout, it is dropped if no worker picks it up in time.
+        deadline = time.time() + timeout if timeout is not None else None
+        request_id, _, coalesced = enqueue_message(
+            message, cache_key=cache_key, key=key, deadline=deadline, lane=lane, flow=flow, trace=trace)
         
         return jsonify({
             'success': True,
+            'id': request_id,
+            'coalesced': coalesced,
             'message': 'Message queued successfully'
         })
+    except InvalidTimeout as e:
+        return jsonify({
+            'error': str(e)
+        }), 400
+    except QueueFull as e:
+        return jsonify({
+            'error': str(e)
+        }), 429, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         app.logger.error(f'Error in chat endpoint: {str(e)}')
         return jsonify({
@@ -67,58 +1295,45 @@ def chat():
 
 @app.route('/api/v1/response/latest', methods=['GET'])
 def get_last_response():
+    """Return the next response this client has not retrieved yet.
+
+    Each client keeps its own cursor, identified by the X-Client-ID header or
+    the client_id query parameter, so concurrent pollers don't steal each
+    other's answers. Clients that know their request ID should prefer
+    /api/v1/responses/<id>.
+    """
     try:
-        # Improved response retrieval logic
-        current_time = time.time()
+        client_id = request.headers.get('X-Client-ID') or request.args.get('client_id', 'default')
         
-        with response_lock:
-            if not response_storage['responses']:
-                # Return 202 Accepted instead of 404 to indicate the request is valid but processing
-                # This avoids flooding logs with 404 errors during normal polling
-                return jsonify({
-                    'status': 'pending',
-                    'message': 'The response is being processed. Please try again in a moment.'
-                }), 202
-            
-            # Get the next newest response that hasn't been retrieved yet
-            # Check if there are any new responses since the last retrieval
-            current_response_count = len(response_storage['responses'])
-            last_retrieved = response_storage['last_retrieved_index']
-            
-            # If there's a newer response available, send it
-            if current_response_count > 0 and last_retrieved < current_response_count - 1:
-                # Get the next response in sequence
-                next_index = last_retrieved + 1
-                next_response = response_storage['responses'][next_index]
-                
-                # Update the last retrieved index
-                response_storage['last_retrieved_index'] = next_index
-                
-                # Return the response
-                return jsonify({
-                    'status': 'ready',
-                    'response': next_response['response'],
-                    'timestamp': next_response['timestamp'],
-                    'response_index': next_index,
-                    'total_responses': current_response_count
-                })
-            
-            # If we've already sent all available responses
-            if response_storage['responses']:
-                # Just indicate there's nothing new, but don't resend old content
-                return jsonify({
-                    'status': 'no_new_responses',
-                    'message': 'All available responses have been retrieved',
-                    'last_retrieved_index': last_retrieved,
-                    'total_responses': current_response_count
-                }), 204  # 204 No Content is more appropriate here
-            
-            # No responses at all
+        sequence, next_response, current_response_count, last_retrieved = store.next_response(client_id)
+        if not current_response_count:
+            # Return 202 Accepted instead of 404 to indicate the request is valid but processing
+            # This avoids flooding logs with 404 errors during normal polling
             return jsonify({
-                'status': 'empty',
-                'error': 'No responses available',
-                'message': 'No responses have been generated yet.'
-            }), 404
+                'status': 'pending',
+                'message': 'The response is being processed. Please try again in a moment.'
+            }), 202
+        
+        # If there's a newer response available, send it
+        if next_response is not None:
+            retrieval_delay_seconds.observe(time.time() - next_response['timestamp'])
+            mark_delivered(next_response['id'], 'poll')
+            return jsonify({
+                'status': 'ready',
+                'id': next_response['id'],
+                'response': next_response['response'],
+                'timestamp': next_response['timestamp'],
+                'response_index': sequence,
+                'total_responses': current_response_count
+            })
+        
+        # Just indicate there's nothing new, but don't resend old content
+        return jsonify({
+            'status': 'no_new_responses',
+            'message': 'All available responses have been retrieved',
+            'last_retrieved_index': last_retrieved,
+            'total_responses': current_response_count
+        }), 204  # 204 No Content is more appropriate here
             
     except Exception as e:
         app.logger.error(f'Error in get_last_response endpoint: {str(e)}')
@@ -128,65 +1343,353 @@ def get_last_response():
             'message': 'An error occurred while retrieving the response'
         }), 500
 
-@app.route('/api/v1/messages/pending', methods=['GET'])
-def get_pending_message():
+@app.route('/api/v1/responses/<request_id>', methods=['GET'])
+def get_response_by_id(request_id):
+    """Return the response for a specific request ID"""
     try:
-        # Rate limiting has been removed
-        if not message_queue.empty():
-            message = message_queue.get()
+        sequence, stored = store.get_response(request_id)
+        failure = store.failure(request_id) if stored is None else None
+        
+        if failure is not None and failure[0] == 'cancelled':
             return jsonify({
-                'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
-                'object': 'chat.completion',
-                'created': int(time.time()),
-                'model': '1',
-                'choices': [
-                    {
-                        'index': 0,
-                        'message': {
-                            'role': 'user',
-                            'content': message
-                        },
-                        'finish_reason': None
-                    }
-                ]
+                'status': 'cancelled',
+                'id': request_id,
+                'message': 'The request was cancelled before it was answered.'
+            }), 410
+        
+        if failure is not None:
+            # Failed all its deliveries, or expired in the queue; it will never be answered
+            return jsonify(dict(failure_result(request_id, *failure),
+                                message='The request was given up on before it was answered.')), 410
+        
+        if stored is None:
+            # Either still being processed or already evicted; the caller polls again either way
+            return jsonify({
+                'status': 'pending',
+                'id': request_id,
+                'message': 'The response is being processed. Please try again in a moment.'
+            }), 202
+        
+        retrieval_delay_seconds.observe(time.time() - stored['timestamp'])
+        mark_delivered(request_id, 'poll')
+        return jsonify({
+            'status': 'ready',
+            'id': request_id,
+            'response': stored['response'],
+            'timestamp': stored['timestamp'],
+            'response_index': sequence
+        })
+    except Exception as e:
+        app.logger.error(f'Error in get_response_by_id endpoint: {str(e)}')
+        return jsonify({
+            'status': 'error',
+            'error': str(e),
+            'message': 'An error occurred while retrieving the response'
+        }), 500
+
+@app.route('/api/v1/chat/batch', methods=['POST'])
+def chat_batch():
+    """Queue many messages in one call, each handled like its own /api/v1/chat request.
+
+    Accepts {'messages': [...]} where each entry is a message string or an
+    object with 'message' and optional 'priority', 'timeout', 'cache' and
+    'model'. The same fields at the top level apply to every entry that
+    does not set its own. Returns one result per entry, in order.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({'error': 'Content-Type must be application/json'}), 415
+
+        data = request.get_json()
+        messages = data.get('messages')
+        if not isinstance(messages, list) or not messages:
+            return jsonify({
+                'error': 'Messages are required'
+            }), 400
+        if len(messages) > MAX_BATCH_SIZE:
+            return jsonify({
+                'error': f'At most {MAX_BATCH_SIZE} messages per batch'
+            }), 413
+
+        flow = client_flow(data, request.headers)
+        # Every entry is its own request in the caller's trace
+        trace = new_trace(request.headers)
+        results = [None] * len(messages)
+        cached = []  # (index, request ID, answer)
+        entries = []
+        for index, entry in enumerate(messages):
+            if not isinstance(entry, dict):
+                entry = {'message': entry}
+            options = dict(data, **entry)
+            message = entry.get('message')
+            if not message or not isinstance(message, str):
+                results[index] = {'index': index, 'status': 'invalid', 'error': 'Message is required'}
+                continue
+            try:
+                timeout = request_timeout(options.get('timeout'))
+            except InvalidTimeout as e:
+                results[index] = {'index': index, 'status': 'invalid', 'error': str(e)}
+                continue
+            key = request_key(options, [{'role': 'user', 'content': message}])
+            cache_key = cache_key_for(options, key, request.headers)
+            answer = response_cache.get(cache_key) if cache_key else None
+            if answer is not None:
+                cached.append((index, new_request_id(), answer, fork_trace(trace)))
+                continue
+            lane = request_lane(options, request.headers)
+            entries.append({
+                'index': index,
+                'message': message,
+                'key': flight_key(key, options, request.headers, lane, flow),
+                'cache_key': cache_key,
+                'deadline': time.time() + timeout if timeout is not None else None,
+                'lane': lane,
+                'flow': flow,
+                'trace': fork_trace(trace)
             })
+
+        # Cache hits are ready at /api/v1/responses/<id> right away
+        store.add_responses([(request_id, answer) for _, request_id, answer, _ in cached])
+        store.record_events([event for _, request_id, _, entry_trace in cached
+                             for event in cached_events(request_id, entry_trace)])
+        for index, request_id, _, _ in cached:
+            results[index] = {'index': index, 'id': request_id, 'status': 'cached'}
+        for entry, result in zip(entries, enqueue_batch(entries)):
+            results[entry['index']] = dict(result, index=entry['index'])
+
+        counts = Counter(result['status'] for result in results)
+        body = {
+            'success': counts['rejected'] < len(results),
+            'object': 'list',
+            'data': results,
+            'counts': dict(counts)
+        }
+        if not counts['rejected']:
+            return jsonify(body)
+        wait = max(result.get('retry_after', 0) for result in results)
+        # Nothing was accepted: the whole batch is turned away like a single message
+        status = 429 if counts['rejected'] == len(results) else 200
+        return jsonify(body), status, {'Retry-After': str(wait)}
+    except Exception as e:
+        app.logger.error(f'Error in chat_batch endpoint: {str(e)}')
         return jsonify({
-            'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
-            'object': 'chat.completion',
-            'created': int(time.time()),
-            'model': '1',
-            'choices': []
+            'error': str(e)
+        }), 500
+
+@app.route('/api/v1/responses/batch', methods=['POST'])
+def get_responses_batch():
+    """Collect the answers for many request IDs in one call.
+
+    Accepts {'ids': [...], 'wait': seconds}. Returns every answer that is
+    ready; if none is, long-polls up to wait seconds (default 0) for the
+    first. With 'stream': true the answers are sent as NDJSON instead, one
+    line per request as it completes, for up to wait seconds (default
+    COMPLETION_TIMEOUT). Both are capped at MAX_BATCH_WAIT. Under server.py
+    this route is served by asgi.py, which waits without holding a thread.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({'error': 'Content-Type must be application/json'}), 415
+
+        request_ids, stream_mode, wait = results_request(request.get_json())
+
+        if stream_mode:
+            return Response(
+                stream_with_context(stream_results(request_ids, wait)),
+                mimetype='application/x-ndjson',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
+        results, pending = poll_results(request_ids, wait)
+        return jsonify({
+            'object': 'list',
+            'data': results,
+            'pending': pending
         })
+    except InvalidRequest as e:
+        return jsonify({
+            'error': str(e)
+        }), e.status
     except Exception as e:
+        app.logger.error(f'Error in get_responses_batch endpoint: {str(e)}')
         return jsonify({
-            'error': {
-                'message': str(e),
-                'type': 'server_error'
-            }
+            'error': str(e)
         }), 500
 
-@app.route('/api/v1/chat/completions/latest', methods=['GET'])
-def get_latest_completion():
+@app.route('/api/v1/requests/<request_id>/timeline', methods=['GET'])
+def get_request_timeline(request_id):
+    """When a request reached each stage, and how long it spent between them"""
+    try:
+        events = store.timeline(request_id)
+        if not events:
+            return jsonify({
+                'error': 'No timeline for this request ID',
+                'id': request_id
+            }), 404
+        received = next((event for event in events if event['stage'] == 'received'), {})
+        return jsonify({
+            'id': request_id,
+            'trace_id': received.get('trace_id'),
+            'events': events,
+            'durations': stage_durations(events)
+        })
+    except Exception as e:
+        app.logger.error(f'Error in get_request_timeline endpoint: {str(e)}')
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+@app.route('/api/v1/requests/<request_id>', methods=['DELETE'])
+def cancel_request_by_id(request_id):
+    """Cancel a queued or in-flight request"""
+    try:
+        state = cancel_request(request_id, 'The request was cancelled')
+        if state is None:
+            return jsonify({
+                'error': 'Request is not queued or being answered',
+                'id': request_id
+            }), 404
+        return jsonify({
+            'id': request_id,
+            'status': 'cancelled',
+            # 'leased': a worker had it, and stops at its next upload
+            'was': state
+        })
+    except Exception as e:
+        app.logger.error(f'Error in cancel_request_by_id endpoint: {str(e)}')
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+def free_slots(worker_id, slots):
+    """How many more messages worker_id may hold when it holds at most slots at once"""
+    # Acks for a shared store may reach another process, so its count is the one to trust
+    if store.shared:
+        return slots - store.held_by(worker_id)
+    with worker_lock:
+        worker = workers.get(worker_id)
+        return slots - (worker['inflight'] if worker else 0)
+
+def dequeue_message(wait=0, worker_id=None, limit=1, slots=None):
+    """Lease up to limit queued messages, blocking up to wait seconds for the first to arrive.
+
+    When several workers are waiting, the least loaded one is handed the
+    messages first; a message pinned to a worker goes to it regardless.
+    With slots, worker_id is only handed messages while it holds fewer
+    than that many leases. Returns the leases, empty if nothing arrived in
+    time.
+    """
+    deadline = time.time() + wait
+    with dispatch_cond:
+        waiting_workers[worker_id] = waiting_workers.get(worker_id, 0) + 1
+        waiting_slots[worker_id] = slots
+        wakeups = dispatch_state['wakeups']
+    try:
+        while True:
+            # The store is only called outside the condition, so enqueues never
+            # wait on its locks (or on SQLite's write lock) to notify workers
+            available = limit if slots is None else min(limit, free_slots(worker_id, slots))
+            if available > 0:
+                with dispatch_cond:
+                    preferred = is_preferred_worker(worker_id)
+                if not preferred:
+                    # Nobody else can take a message pinned to this worker, which the store hands out first
+                    available = 1 if worker_id in store.pinned_workers() else 0
+            if available > 0:
+                leases = lease_message(worker_id, available)
+                if leases:
+                    return leases
+            with dispatch_cond:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                # Woken up by notify_workers, or when another waiting worker leaves.
+                # Messages queued by other processes sharing the store are polled for.
+                if dispatch_state['wakeups'] == wakeups:
+                    dispatch_cond.wait(min(remaining, STORE_POLL_INTERVAL) if store.shared else remaining)
+                wakeups = dispatch_state['wakeups']
+    finally:
+        with dispatch_cond:
+            waiting_workers[worker_id] -= 1
+            if not waiting_workers[worker_id]:
+                del waiting_workers[worker_id]
+                del waiting_slots[worker_id]
+            dispatch_state['wakeups'] += 1
+            dispatch_cond.notify_all()
+
+def work_item(lease):
+    """chat.completion-shaped payload handing a leased message to a worker.
+
+    For a conversation, 'thread' tells the worker to type the new turn into
+    the thread it shows ('continue', with the full conversation as 'context'
+    in case the tab moved on) or to start a new thread with the whole
+    conversation ('new'). 'session' names the conversation either way.
+    """
+    item = lease['item']
+    content = item['message']
+    session = {}
+    if 'history' in item:
+        continuing = item.get('affinity') is not None and item['affinity'] == lease['worker']
+        session = {'session': item['session'], 'thread': 'continue' if continuing else 'new'}
+        if continuing:
+            session['context'] = transcript(item['history'])
+        else:
+            content = transcript(item['history'])
+        with session_lock:
+            session_stats['continued' if continuing else 'replayed'] += 1
+    return dict(session, **{
+        'id': item['id'],
+        'lease_id': lease['lease_id'],
+        'lease_expires': lease['expires'],
+        'delivery': item['deliveries'],
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': '1',
+        'choices': [
+            {
+                'index': 0,
+                'message': {
+                    'role': 'user',
+                    'content': content
+                },
+                'finish_reason': None
+            }
+        ]
+    })
+
+def dequeue_for_worker():
+    """Shared handler for the worker dequeue endpoints.
+
+    Honours an optional ?wait=<seconds> long-poll parameter, capped at
+    MAX_DEQUEUE_WAIT, and returns an empty choices list if nothing arrived.
+    The message is leased to the worker (X-Worker-ID header or worker_id
+    parameter) and redelivered if it is not acknowledged before the lease expires.
+    With ?max=<n> (capped at MAX_FETCH) up to n messages are leased at once
+    and returned as a list of such items.
+    """
     try:
         # Rate limiting has been removed
-        if not message_queue.empty():
-            message = message_queue.get()
+        wait = request.args.get('wait', 0, type=float)
+        if not math.isfinite(wait):
             return jsonify({
-                'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
-                'object': 'chat.completion',
-                'created': int(time.time()),
-                'model': '1',
-                'choices': [
-                    {
-                        'index': 0,
-                        'message': {
-                            'role': 'user',
-                            'content': message
-                        },
-                        'finish_reason': None
-                    }
-                ]
+                'error': {
+                    'message': f"wait must be a finite number of seconds, got {request.args['wait']!r}",
+                    'type': 'invalid_request_error'
+                }
+            }), 400
+        wait = min(max(wait, 0), MAX_DEQUEUE_WAIT)
+        worker_id = request.headers.get('X-Worker-ID') or request.args.get('worker_id')
+        if worker_id:
+            touch_worker(worker_id)
+        limit = request.args.get('max', type=int)
+        leases = dequeue_message(wait, worker_id, min(max(limit or 1, 1), MAX_FETCH))
+        if limit is not None:
+            return jsonify({
+                'object': 'list',
+                'data': [work_item(lease) for lease in leases]
             })
+        if leases:
+            return jsonify(work_item(leases[0]))
         return jsonify({
             'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
             'object': 'chat.completion',
@@ -202,6 +1705,14 @@ def get_latest_completion():
             }
         }), 500
 
+@app.route('/api/v1/messages/pending', methods=['GET'])
+def get_pending_message():
+    return dequeue_for_worker()
+
+@app.route('/api/v1/chat/completions/latest', methods=['GET'])
+def get_latest_completion():
+    return dequeue_for_worker()
+
 # Standard OpenAI compatibility endpoints
 @app.route('/v1/models', methods=['GET'])
 def list_models():
@@ -225,74 +1736,226 @@ def list_models():
         ]
     })
 
+def conversation_history(messages):
+    """The system, user and assistant turns of a request as role/content dicts"""
+    return [{'role': msg['role'], 'content': str(msg.get('content', ''))}
+            for msg in messages if msg.get('role') in ('system', 'user', 'assistant')]
+
+def transcript(history):
+    """A whole conversation as one prompt, for a worker starting a new Grok thread"""
+    if len(history) == 1:
+        return history[0]['content']
+    turns = '\n\n'.join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in history)
+    return f'{turns}\n\nContinue this conversation by replying to the last user message.'
+
+def next_session_key(item, answer):
+    """Key under which the conversation of an answered item continues"""
+    if item.get('conversation'):
+        return item['session']
+    return ResponseCache.key(None, item['history'] + [{'role': 'assistant', 'content': answer}])
+
+def start_session(data, headers):
+    """Session fields for a queue item, or None for a single-turn request.
+
+    A request continues a conversation when it names one ('conversation_id'
+    or an X-Conversation-ID header) or carries earlier turns. If the worker
+    that answered the previous turn still shows that conversation, the item
+    is pinned to it, unless that worker is busy with another message (which
+    moves its thread on anyway); otherwise whichever worker takes it
+    replays the whole conversation in a new thread.
+    """
+    history = conversation_history(data['messages'])
+    conversation = data.get('conversation_id') or headers.get('X-Conversation-ID')
+    if conversation:
+        key = f'conversation:{conversation}'
+    elif len(history) > 1 and history[-1]['role'] == 'user':
+        key = ResponseCache.key(None, history[:-1])
+    else:
+        return None
+    now = time.time()
+    with session_lock:
+        entry = sessions.get(key)
+        if entry is not None and now - entry['updated'] > SESSION_TTL:
+            del sessions[key]
+            entry = None
+    affinity = None
+    if entry is not None:
+        with worker_lock:
+            worker = workers.get(entry['worker'])
+            if (worker is not None and worker_is_healthy(worker, now) and worker.get('session') == key
+                    and not worker['inflight']):
+                affinity = entry['worker']
+    return {'session': key, 'conversation': bool(conversation), 'history': history, 'affinity': affinity}
+
+def file_session(lease, answer):
+    """Remember which worker's thread holds a conversation after it answered a turn.
+
+    Returns the session key the worker's thread now stands at, or None.
+    """
+    item = lease['item']
+    worker_id = lease['worker']
+    key = next_session_key(item, answer) if 'history' in item else None
+    if key is not None:
+        with session_lock:
+            sessions[key] = {'worker': worker_id, 'updated': time.time()}
+            sessions.move_to_end(key)
+            while len(sessions) > SESSION_MAX_ENTRIES:
+                sessions.popitem(last=False)
+    with worker_lock:
+        # A turn outside any session is typed into the tab's thread too, which leaves it off-session
+        if worker_id in workers:
+            workers[worker_id]['session'] = key
+    return key
+
+def sweep_sessions():
+    cutoff = time.time() - SESSION_TTL
+    with session_lock:
+        stale = [key for key, entry in sessions.items() if entry['updated'] < cutoff]
+        for key in stale:
+            del sessions[key]
+    return len(stale)
+
+def start_completion(data, headers, make_partials=Queue):
+    """Queue an OpenAI-style request, or answer it from the cache.
+
+    Shared by the Flask view and the asyncio server. make_partials builds
+    the object that receives (text, is_final) updates for streaming callers.
+    Returns None if the request has no user message, otherwise a dict with
+    the request ID, waiter, model, timeout, stream flag, cache status and
+    trace context.
+    Raises InvalidTimeout for a bad 'timeout' and QueueFull if the message
+    cannot be queued.
+    """
+    if 'messages' not in data:
+        return None
+    # Extract the last user message
+    user_messages = [msg for msg in data['messages'] if msg.get('role') == 'user']
+    if not user_messages:
+        return None
+    last_message = user_messages[-1]['content']
+    stream_mode = bool(data.get('stream', False))
+    timeout = request_timeout(data.get('timeout'), COMPLETION_TIMEOUT)
+    trace = new_trace(headers)
+    
+    # Repeated prompts are answered from the cache without a browser round trip
+    key = request_key(data, data['messages'])
+    cache_key = cache_key_for(data, key, headers)
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        request_id = new_request_id()
+        waiter = resolved_waiter(cached, make_partials() if stream_mode else None)
+        store.record_events(cached_events(request_id, trace))
+        mark_delivered(request_id, 'cache')
+    else:
+        # Queue the message, or join an identical one already in flight,
+        # and wait for the worker to post the answer back
+        lane = request_lane(data, headers)
+        flow = client_flow(data, headers)
+        request_id, waiter, coalesced = enqueue_message(
+            last_message, wait=True, stream=stream_mode, cache_key=cache_key,
+            key=flight_key(key, data, headers, lane, flow), make_partials=make_partials,
+            deadline=time.time() + timeout, lane=lane, flow=flow, trace=trace,
+            session=start_session(data, headers))
+        if not coalesced:
+            store.mark_processed(last_message)
+    
+    return {
+        'id': request_id,
+        'waiter': waiter,
+        'model': data.get('model', 'gpt-3.5-turbo'),
+        'timeout': timeout,
+        'stream': stream_mode,
+        'cache_status': 'HIT' if cached is not None else ('MISS' if cache_key else 'BYPASS'),
+        'trace': trace
+    }
+
+def completion_body(request_id, model, content):
+    """Non-streaming chat.completion payload"""
+    return {
+        'id': request_id,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [
+            {
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': content
+                },
+                'finish_reason': 'stop'
+            }
+        ]
+    }
+
+def timeout_error_body(request_id, timeout):
+    return {
+        'error': {
+            'message': f'No response received within {timeout:g} seconds',
+            'type': 'timeout_error',
+            'request_id': request_id
+        }
+    }
+
+def invalid_request_body(error):
+    return {
+        'error': {
+            'message': str(error),
+            'type': 'invalid_request_error'
+        }
+    }
+
+INVALID_REQUEST_BODY = {
+    'error': {
+        'message': 'Invalid request format',
+        'type': 'invalid_request_error'
+    }
+}
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def openai_chat_completions(from_api_route=False):
     """OpenAI-compatible chat completions endpoint"""
     try:
         if request.is_json:
             data = request.get_json()
-            # Log incoming request data for debugging
-            app.logger.info(f"Received OpenAI-compatible request with data: {data}")
-            stream_mode = data.get('stream', False)
+            request_log.log(request.url_rule.rule, data, 'Received OpenAI-compatible request')
             
-            # Check if this is a typical OpenAI request with messages
-            if 'messages' in data:
-                # Extract the last user message
-                user_messages = [msg for msg in data['messages'] if msg.get('role') == 'user']
-                if user_messages:
-                    last_message = user_messages[-1]['content']
-                    # Queue the message
-                    message_queue.put(last_message)
-                    with processed_lock:
-                        processed_messages.add(last_message)
-                    
-                    # Handle streaming mode differently if requested
-                    if stream_mode:
-                        # For simplicity, we're not implementing true streaming
-                        # Just return a compatible format
-                        response_id = f'chatcmpl-{str(uuid.uuid4())[:8]}'
-                        return jsonify({
-                            'id': response_id,
-                            'object': 'chat.completion.chunk',
-                            'created': int(time.time()),
-                            'model': data.get('model', 'gpt-3.5-turbo'),
-                            'choices': [
-                                {
-                                    'index': 0,
-                                    'delta': {
-                                        'role': 'assistant',
-                                        'content': 'Message received and queued for processing'
-                                    },
-                                    'finish_reason': 'stop'
-                                }
-                            ]
-                        })
-                    else:
-                        # Return a compatible response format for non-streaming
-                        return jsonify({
-                            'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
-                            'object': 'chat.completion',
-                            'created': int(time.time()),
-                            'model': data.get('model', 'gpt-3.5-turbo'),
-                            'choices': [
-                                {
-                                    'index': 0,
-                                    'message': {
-                                        'role': 'assistant',
-                                        'content': 'Message received and queued for processing'
-                                    },
-                                    'finish_reason': 'stop'
-                                }
-                            ]
-                        })
+            completion = start_completion(data, request.headers)
+            if completion is not None:
+                request_id = completion['id']
+                g.trace = completion['trace']
+                cache_status = completion['cache_status']
+                
+                # Stream deltas as the worker uploads partial text
+                if completion['stream']:
+                    return Response(
+                        stream_with_context(stream_completion(
+                            request_id, completion['waiter'], completion['model'], completion['timeout'])),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                                 'X-Cache': cache_status}
+                    )
+                
+                content = wait_for_response(request_id, completion['waiter'], completion['timeout'])
+                if content is None:
+                    return jsonify(timeout_error_body(request_id, completion['timeout'])), 504
+                
+                # Return a compatible response format for non-streaming
+                return jsonify(completion_body(request_id, completion['model'], content)), {'X-Cache': cache_status}
         
         # If we get here, the request wasn't in the expected format
+        return jsonify(INVALID_REQUEST_BODY), 400
+    except InvalidTimeout as e:
+        return jsonify(invalid_request_body(e)), 400
+    except QueueFull as e:
+        return jsonify(queue_full_body(e)), 429, {'Retry-After': str(e.retry_after)}
+    except DeliveryFailed as e:
         return jsonify({
             'error': {
-                'message': 'Invalid request format',
-                'type': 'invalid_request_error'
+                'message': str(e),
+                'type': 'delivery_error'
             }
-        }), 400
+        }), 502
     except Exception as e:
         app.logger.error(f'Error in openai_chat_completions endpoint: {str(e)}')
         return jsonify({
@@ -328,22 +1991,39 @@ def store_response():
                 }
             }), 400
         
-        current_time = time.time()
-        with response_lock:
-            # Add new response with timestamp
-            new_response = {
-                'response': data['response'],
-                'timestamp': current_time
-            }
-            response_storage['responses'].append(new_response)
-            response_storage['timestamp'] = current_time
-            
-            # Keep only the last N responses
-            if len(response_storage['responses']) > response_storage['max_responses']:
-                response_storage['responses'] = response_storage['responses'][-response_storage['max_responses']:]
+        # Responses from older workers that don't echo the ID get a fresh one.
+        # The answer is buffered before the lease is released, so a crash in
+        # between redelivers the message rather than losing it.
+        request_id = data.get('id') or new_request_id()
+        # When the worker typed the prompt into Grok, by the browser's clock. It only
+        # annotates the timeline, so a malformed value is dropped, never the answer.
+        sent_at = timestamp(data.get('sent_at'))
+        store.add_response(request_id, data['response'])
+        events = [(request_id, 'response_stored', time.time(), None)]
+        if sent_at is not None:
+            events.insert(0, (request_id, 'worker_sent', sent_at, None))
+        store.record_events(events)
+        
+        # Wake up the OpenAI-compatible caller waiting on this request, if any
+        session = None
+        if data.get('id'):
+            # Only the worker holding the lease is credited; a late answer under an
+            # expired lease still reaches the caller but leaves the new lease alone
+            lease = acknowledge(request_id, data.get('lease_id'), request.headers.get('X-Worker-ID'))
+            if lease is None:
+                app.logger.info(f'Answer for {request_id} does not hold its current lease; not acknowledged')
+            else:
+                record_drain()
+                answer_seconds.observe(time.time() - lease['leased_at'])
+                if lease['item'].get('cache_key'):
+                    response_cache.put(lease['item']['cache_key'], data['response'])
+                session = file_session(lease, data['response'])
+            resolve_request(request_id, data['response'])
         
         return jsonify({
-            'id': f'chatcmpl-{str(uuid.uuid4())[:8]}',
+            'id': request_id,
+            # The conversation the worker's thread now holds, checked against the next 'continue'
+            'session': session,
             'object': 'chat.completion',
             'created': int(time.time()),
             'model': '1',
@@ -367,22 +2047,102 @@ def store_response():
             }
         }), 500
 
+@app.route('/api/v1/chat/completions/partial', methods=['POST'])
+def store_partial_response():
+    """Accept the text generated so far for a request that is still being answered.
+
+    With an 'offset', 'response' replaces the text from that character on,
+    so a worker only uploads what changed since its last upload. A reply
+    with 'cancelled': true tells the worker to abandon the request.
+    """
+    try:
+        if not request.is_json:
+            return jsonify({'error': {'message': 'Content-Type must be application/json', 'type': 'invalid_request_error'}}), 415
+
+        data = request.get_json()
+        if not data or not data.get('id') or 'response' not in data:
+            return jsonify({
+                'error': {
+                    'message': 'Request ID and response are required',
+                    'type': 'invalid_request_error'
+                }
+            }), 400
+
+        offset = data.get('offset')
+        if offset is not None and (not isinstance(offset, int) or isinstance(offset, bool) or offset < 0):
+            return jsonify({
+                'error': {
+                    'message': 'offset must be a non-negative integer',
+                    'type': 'invalid_request_error'
+                }
+            }), 400
+
+        # The caller went away: tell the worker to stop rather than keep the answer coming
+        if store.is_cancelled(data['id']):
+            return jsonify({
+                'success': False,
+                'id': data['id'],
+                'cancelled': True
+            })
+
+        # Progress from the worker keeps its lease alive
+        renew_lease(data['id'])
+        text = append_partial(data['id'], data['response'], offset)
+        if text is None:
+            # Earlier uploads went to another process or were dropped; the worker resends everything
+            return jsonify({
+                'error': {
+                    'message': 'offset is past the text received so far; resend it from offset 0',
+                    'type': 'invalid_request_error'
+                }
+            }), 409
+        delivered = publish_partial(data['id'], text)
+        # Callers waiting in other processes pick the text up from the store
+        if store.shared:
+            store.put_partial(data['id'], text)
+        return jsonify({
+            'success': True,
+            'id': data['id'],
+            'length': len(text),
+            'streaming': delivered
+        })
+    except Exception as e:
+        app.logger.error(f'Error in store_partial_response endpoint: {str(e)}')
+        return jsonify({
+            'error': {
+                'message': str(e),
+                'type': 'server_error'
+            }
+        }), 500
+
 @app.route('/api/v1/messages/mark-processed', methods=['POST'])
 def mark_messages_processed():
-    """Endpoint to mark messages as processed to avoid duplicates"""
+    """Endpoint to acknowledge a leased message so it is not redelivered.
+
+    Accepts {'id': request_id, 'lease_id': ...}. With 'release': true the
+    worker gives the message back instead, and it is redelivered right away.
+    """
     try:
         # Accept any JSON payload or even empty requests
         # This makes the endpoint more compatible with different client implementations
+        data = {}
         if request.is_json:
-            data = request.get_json()
-            app.logger.info(f"Received mark-processed request with data: {data}")
+            data = request.get_json() or {}
+        request_log.log(request.url_rule.rule, data, 'Received mark-processed request')
+        
+        request_id = data.get('id')
+        if request_id and data.get('release'):
+            acknowledged = expire_lease(request_id, data.get('lease_id'))
+        elif request_id:
+            acknowledged = acknowledge(request_id, data.get('lease_id'), request.headers.get('X-Worker-ID')) is not None
         else:
-            app.logger.info("Received mark-processed request with no JSON data")
+            # Legacy payloads without an ID carry nothing to acknowledge
+            acknowledged = False
             
-        # Always return success - we just need to acknowledge the client
-        # No validation required for this simple implementation
+        # Always return success - the lease may already have been acknowledged by store_response
         return jsonify({
             'success': True,
+            'acknowledged': acknowledged,
             'message': 'Message acknowledged'
         })
     except Exception as e:
@@ -391,19 +2151,220 @@ def mark_messages_processed():
             'error': str(e)
         }), 500
 
+@app.route('/api/v1/workers/register', methods=['POST'])
+def register_worker():
+    """Register a browser worker, assigning an ID if it did not bring one"""
+    try:
+        data = request.get_json(silent=True) or {}
+        worker_id = data.get('worker_id') or request.headers.get('X-Worker-ID') or uuid.uuid4().hex
+        touch_worker(worker_id, data.get('info'))
+        return jsonify({
+            'success': True,
+            'worker_id': worker_id,
+            'heartbeat_interval': HEARTBEAT_INTERVAL,
+            'worker_timeout': WORKER_TIMEOUT
+        })
+    except Exception as e:
+        app.logger.error(f'Error in register_worker endpoint: {str(e)}')
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+@app.route('/api/v1/workers/<worker_id>/heartbeat', methods=['POST'])
+def worker_heartbeat(worker_id):
+    """Keep a worker marked as healthy between requests"""
+    try:
+        touch_worker(worker_id)
+        return jsonify({
+            'success': True,
+            'worker_id': worker_id
+        })
+    except Exception as e:
+        app.logger.error(f'Error in worker_heartbeat endpoint: {str(e)}')
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+@app.route('/api/v1/workers', methods=['GET'])
+def list_workers():
+    """Known workers with their load, recent turnaround and last contact"""
+    now = time.time()
+    with dispatch_cond:
+        with worker_lock:
+            summaries = [worker_summary(worker, now) for worker in workers.values()]
+    return jsonify({
+        'object': 'list',
+        'data': summaries,
+        'healthy': sum(1 for worker in summaries if worker['healthy'])
+    })
+
+@app.route('/api/v1/stats', methods=['GET'])
+def get_stats():
+    """Sizing counters for the store, caches and coalescing"""
+    stats = store.stats()
+    with pending_lock:
+        stats['coalescing'] = {'flights': len(flights), 'coalesced': flight_stats['coalesced']}
+    stats['cache'] = response_cache.stats()
+    rate = drain_rate()
+    with admission_lock:
+        stats['admission'] = dict(admission_stats, max_queue_depth=MAX_QUEUE_DEPTH, drain_rate=rate)
+    with cancel_lock:
+        stats['cancellation'] = dict(cancel_stats)
+    stats['tracing'] = span_exporter.stats()
+    stats['logging'] = logging_stats(log_handler, request_log)
+    stats['capture'] = traffic_capture.stats()
+    with session_lock:
+        stats['sessions'] = dict(session_stats, active=len(sessions))
+    return jsonify(stats)
+
+@app.route('/api/v1/debug/logging', methods=['GET', 'POST'])
+def debug_logging():
+    """Show or change request log sampling and full body capture at runtime.
+
+    Accepts any of {'full_bodies': bool, 'sample_rate': float,
+    'sample_rates': {route: rate}}; sample_rates replaces the per-route rates.
+    Only served under --debug or with DEBUG_ENDPOINTS set.
+    """
+    if not (DEBUG_ENDPOINTS or app.debug):
+        return jsonify({
+            'error': 'Debug endpoints are disabled; set DEBUG_ENDPOINTS=1 to enable them'
+        }), 404
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return jsonify({
+                    'error': 'Expected a JSON object'
+                }), 400
+            rates = data.get('sample_rates')
+            if rates is not None and not isinstance(rates, dict):
+                return jsonify({
+                    'error': 'sample_rates must be an object of route: rate'
+                }), 400
+            request_log.configure(data.get('full_bodies'), data.get('sample_rate'), rates)
+            app.logger.warning('Request logging changed', extra={'fields': request_log.settings()})
+        return jsonify(logging_stats(log_handler, request_log))
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        app.logger.error(f'Error in debug_logging endpoint: {str(e)}')
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+def render_metrics():
+    """Prometheus text exposition of the queue, pipeline latencies and routes"""
+    now = time.time()
+    stats = store.stats()
+    last_dispatch = store.last_dispatch()
+    out = Exposition()
+    out.gauge('grok_queue_depth', 'Messages waiting for a worker', stats['queue']['depth'])
+    out.gauge('grok_queue_inflight', 'Messages leased to a worker and not yet answered', stats['queue']['inflight'])
+    ages = [lane['oldest_age'] for lane in stats['lanes'].values() if lane['oldest_age'] is not None]
+    out.gauge('grok_queue_oldest_age_seconds', 'How long the oldest queued message has waited', max(ages, default=0.0))
+    out.family('grok_lane_depth', 'gauge', 'Messages waiting per priority lane')
+    for name, lane in stats['lanes'].items():
+        out.sample('grok_lane_depth', lane['depth'], lane=name)
+    out.gauge('grok_last_dispatch_age_seconds', 'Time since a worker was last handed a message',
+              now - last_dispatch if last_dispatch is not None else None)
+    out.gauge('grok_dedup_entries', 'Message fingerprints held for deduplication', stats['dedup']['entries'])
+    out.gauge('grok_responses_buffered', 'Answers buffered for retrieval', stats['responses']['buffered'])
+    out.gauge('grok_responses_oldest_age_seconds', 'Age of the oldest buffered answer',
+              stats['responses']['oldest_age'] or 0.0)
+    with pending_lock:
+        waiting, coalesced = len(pending_requests), flight_stats['coalesced']
+    out.gauge('grok_waiting_requests', 'Requests with callers waiting on this process', waiting)
+    out.counter('grok_coalesced_total', 'Requests attached to an identical one in flight', coalesced)
+    cache = response_cache.stats()
+    out.counter('grok_cache_hits_total', 'Response cache hits', cache['hits'] + cache['disk_hits'])
+    out.counter('grok_cache_misses_total', 'Response cache misses', cache['misses'])
+    with admission_lock:
+        rejected, expired = admission_stats['rejected'], admission_stats['expired']
+    out.counter('grok_rejected_total', 'Messages turned away because the queue was full', rejected)
+    out.counter('grok_expired_total', 'Messages dropped because their deadline passed while queued', expired)
+    with cancel_lock:
+        cancelled = {state: cancel_stats[state] for state in ('queued', 'leased')}
+    out.family('grok_cancelled_total', 'counter', 'Requests cancelled, by whether they were queued or leased')
+    for state, count in cancelled.items():
+        out.sample('grok_cancelled_total', count, state=state)
+    with dispatch_cond:
+        polling = sum(waiting_workers.values())
+    with worker_lock:
+        healthy = sum(1 for worker in workers.values() if worker_is_healthy(worker, now))
+    out.gauge('grok_workers_healthy', 'Workers heard from within WORKER_TIMEOUT', healthy)
+    out.gauge('grok_workers_polling', 'Dequeue long-polls currently held open', polling)
+
+    for name, histogram, help_text in (
+            ('grok_queue_wait_seconds', queue_wait_seconds, 'Time from enqueue to first dispatch'),
+            ('grok_answer_seconds', answer_seconds, 'Time from dispatch to the stored answer'),
+            ('grok_retrieval_delay_seconds', retrieval_delay_seconds,
+             'Time from the stored answer to its retrieval by polling')):
+        out.family(name, 'histogram', help_text)
+        out.histogram(name, histogram)
+
+    routes = route_metrics.items()
+    out.family('grok_http_requests_total', 'counter', 'HTTP requests by route and status class')
+    for route, route_stats in routes:
+        for status_class, count in enumerate(list(route_stats.statuses)):
+            if count:
+                out.sample('grok_http_requests_total', count, route=route, status=f'{status_class}xx')
+    out.family('grok_http_request_errors_total', 'counter', 'HTTP 5xx responses by route')
+    for route, route_stats in routes:
+        out.sample('grok_http_request_errors_total', route_stats.errors, route=route)
+    out.family('grok_http_request_duration_seconds', 'histogram', 'Time to response headers by route')
+    for route, route_stats in routes:
+        out.histogram('grok_http_request_duration_seconds', route_stats.latency, route=route)
+    return out.render()
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    try:
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        app.logger.error(f'Error in get_metrics endpoint: {str(e)}')
+        return Response(f'# error: {str(e)}\n', status=500, mimetype='text/plain')
+
 # Add basic health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Basic health check endpoint"""
+    """Basic health check endpoint.
+
+    Reports 'degraded' while messages are queued and no worker has taken
+    one for STALL_TIMEOUT, e.g. because every browser tab is gone or stuck.
+    """
+    depth = store.queue_depth()
+    last_dispatch = store.last_dispatch()
+    idle = time.time() - max(last_dispatch or 0.0, process_started)
+    if depth and idle >= STALL_TIMEOUT:
+        return jsonify({
+            'status': 'degraded',
+            'version': '1.0.0',
+            'message': f'{depth} queued messages and no dispatch for {int(idle)} seconds',
+            'queue_depth': depth,
+            'seconds_since_dispatch': idle
+        })
     return jsonify({
         'status': 'ok',
         'version': '1.0.0',
-        'message': 'server is running'
+        'message': 'server is running',
+        'queue_depth': depth
     })
 
 if __name__ == '__main__':
-    print("Starting server on http://localhost:5001")
-    print("OpenAI-compatible endpoints available at:")
-    print("  - http://localhost:5001/v1/models")
-    print("  - http://localhost:5001/v1/chat/completions")
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    if '--debug' in sys.argv:
+        # Flask's development server, one thread per waiting client
+        start_background_threads()
+        print("Starting debug server on http://localhost:5001")
+        print("OpenAI-compatible endpoints available at:")
+        print("  - http://localhost:5001/v1/models")
+        print("  - http://localhost:5001/v1/chat/completions")
+        app.run(host='0.0.0.0', port=5001, debug=True)
+    else:
+        # server.py imports this file as the 'app' module, which owns all state
+        from server import main
+        main()
+else:
+    start_background_threads()
\ No newline at end of file
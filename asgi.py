@@ -0,0 +1,465 @@
+"""
+ASGI entry point that serves OpenAI-compatible completions on asyncio.
+
+A completion spends almost all of its life waiting for the browser worker,
+so /v1/chat/completions (and the OpenAI-format variant of
+/api/v1/chat/completions) is handled natively here: the caller awaits its
+request's Future instead of pinning a thread, which lets one process hold
+thousands of pending completions. Bulk result long-polls
+(/api/v1/responses/batch) wait the same way. Workers' push streams
+(/api/v1/workers/<id>/stream) are served here too, so a worker that goes
+away is noticed at once. Every other route, with the same JSON shapes, is
+served by the Flask app in app.py through a WSGI thread pool.
+
+Run it with server.py, or any ASGI server: uvicorn asgi:application
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import Headers
+
+import app as api
+
+# Threads available to the Flask routes, including worker long-polls
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 64))
+
+# Threads that wait for messages on behalf of connected push streams, one per idle worker
+PUSH_THREADS = int(os.environ.get('PUSH_THREADS', 64))
+
+COMPLETION_PATHS = ('/v1/chat/completions', '/api/v1/chat/completions')
+RESULTS_PATH = '/api/v1/responses/batch'
+PUSH_PATH = re.compile(r'^/api/v1/workers/([^/]+)/stream$')
+
+flask_application = WSGIMiddleware(api.app, workers=WSGI_THREADS)
+push_pool = ThreadPoolExecutor(max_workers=PUSH_THREADS, thread_name_prefix='push-dispatch')
+
+
+class AsyncPartials:
+    """Stands in for a streaming waiter's Queue of (text, is_final) updates.
+
+    put() may be called from any thread; the updates are consumed on the loop.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, update):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, update)
+
+    async def get(self):
+        return await self._queue.get()
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def replay_body(body, receive):
+    """A receive callable that hands an already-read body to another application"""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+    return replay
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+def response_headers(content_type, extra=None):
+    # Mirror flask_cors, which adds this header to every Flask response
+    headers = [(b'content-type', content_type), (b'access-control-allow-origin', b'*')]
+    for name, value in (extra or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    return headers
+
+
+async def send_json(send, status, payload, extra_headers=None):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': response_headers(b'application/json', extra_headers)
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(payload).encode('utf-8')})
+
+
+async def send_event(send, payload):
+    await send({'type': 'http.response.body', 'body': payload.encode('utf-8'), 'more_body': True})
+
+
+def release(request_id, waiter):
+    """Stop waiting on request_id, cancelling it if nobody else wants the answer.
+
+    Cancelling touches the store, so it runs off the loop.
+    """
+    asyncio.get_running_loop().run_in_executor(None, api.release_request, request_id, waiter, True)
+
+
+async def respond(completion, receive, send):
+    """Wait for a non-streaming answer without holding a thread"""
+    request_id = completion['id']
+    waiter = completion['waiter']
+    trace_header = {'traceparent': api.traceparent(completion['trace'])}
+    answer = asyncio.wrap_future(waiter['future'])
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({answer, disconnect}, timeout=completion['timeout'],
+                           return_when=asyncio.FIRST_COMPLETED)
+        client_gone = disconnect.done()
+    finally:
+        disconnect.cancel()
+        release(request_id, waiter)
+
+    if not answer.done():
+        if not client_gone:
+            await send_json(send, 504, api.timeout_error_body(request_id, completion['timeout']), trace_header)
+        return
+    if answer.exception() is not None:
+        await send_json(send, 502, {
+            'error': {
+                'message': str(answer.exception()),
+                'type': 'delivery_error'
+            }
+        }, trace_header)
+        return
+    await send_json(send, 200, api.completion_body(request_id, completion['model'], answer.result()),
+                    dict(trace_header, **{'X-Cache': completion['cache_status']}))
+
+
+async def stream(completion, receive, send):
+    """Stream chat.completion.chunk events as the worker uploads partial text"""
+    request_id = completion['id']
+    waiter = completion['waiter']
+    model = completion['model']
+    created = int(time.time())
+    deadline = time.monotonic() + completion['timeout']
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    sent = ''
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': response_headers(b'text/event-stream; charset=utf-8', {
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no',
+                'X-Cache': completion['cache_status'],
+                'traceparent': api.traceparent(completion['trace'])
+            })
+        })
+        await send_event(send, api.sse_event(api.completion_chunk(request_id, created, model, {'role': 'assistant'})))
+        while True:
+            update = asyncio.ensure_future(waiter['partials'].get())
+            await asyncio.wait({update, disconnect}, timeout=deadline - time.monotonic(),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if disconnect.done():
+                update.cancel()
+                return
+            if not update.done():
+                update.cancel()
+                await send_event(send, api.sse_event(api.timeout_error_body(request_id, completion['timeout'])))
+                break
+            text, is_final = update.result()
+            if text is None:
+                await send_event(send, api.sse_event({
+                    'error': {
+                        'message': str(waiter['future'].exception()),
+                        'type': 'delivery_error',
+                        'request_id': request_id
+                    }
+                }))
+                break
+            # Same rule as app.stream_completion: only the unseen suffix is sent
+            if text.startswith(sent) and len(text) > len(sent):
+                await send_event(send, api.sse_event(api.completion_chunk(
+                    request_id, created, model, {'content': text[len(sent):]})))
+                sent = text
+            if is_final:
+                await send_event(send, api.sse_event(api.completion_chunk(request_id, created, model, {}, 'stop')))
+                break
+        await send_event(send, 'data: [DONE]\n\n')
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+        release(request_id, waiter)
+
+
+def recording(send, scope, headers, body, started, route=None):
+    """Wrap send to count the response in the route metrics and capture it, like the Flask routes"""
+    async def record(message):
+        if message['type'] == 'http.response.start':
+            elapsed = time.perf_counter() - started
+            api.route_metrics.observe(route or scope['path'], message['status'], elapsed)
+            if api.traffic_capture.enabled:
+                api.traffic_capture.record(time.time() - elapsed, scope['method'], scope['path'],
+                                           scope['query_string'].decode('latin-1'), headers, body,
+                                           message['status'], elapsed)
+        await send(message)
+    return record
+
+
+async def chat_completions(scope, receive, send):
+    started = time.perf_counter()
+    body = await read_body(receive)
+    if body is None:
+        return
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    try:
+        data = json.loads(body) if 'json' in headers.get('Content-Type', '') else None
+    except ValueError:
+        data = None
+
+    # Worker uploads to /api/v1/chat/completions are not completions; let Flask store them
+    if scope['path'] != '/v1/chat/completions' and not (isinstance(data, dict) and 'messages' in data):
+        await flask_application(scope, replay_body(body, receive), send)
+        return
+
+    send = recording(send, scope, headers, body, started)
+    if not isinstance(data, dict):
+        await send_json(send, 400, api.INVALID_REQUEST_BODY)
+        return
+    api.request_log.log(scope['path'], data, 'Received OpenAI-compatible request')
+
+    loop = asyncio.get_running_loop()
+    try:
+        # Cache lookups may touch SQLite, so keep them off the event loop
+        completion = await loop.run_in_executor(
+            None, api.start_completion, data, headers, lambda: AsyncPartials(loop))
+    except api.InvalidTimeout as e:
+        await send_json(send, 400, api.invalid_request_body(e))
+        return
+    except api.QueueFull as e:
+        await send_json(send, 429, api.queue_full_body(e), {'Retry-After': str(e.retry_after)})
+        return
+    except Exception as e:
+        api.app.logger.error(f'Error in openai_chat_completions endpoint: {str(e)}')
+        await send_json(send, 500, {'error': {'message': str(e), 'type': 'server_error'}})
+        return
+    if completion is None:
+        await send_json(send, 400, api.INVALID_REQUEST_BODY)
+        return
+
+    if completion['stream']:
+        await stream(completion, receive, send)
+    else:
+        await respond(completion, receive, send)
+
+
+def notify_done(waiters, done):
+    """Put each request ID on done, an asyncio.Queue, once its waiter's Future is resolved"""
+    loop = asyncio.get_running_loop()
+    for request_id, waiter in waiters.items():
+        waiter['future'].add_done_callback(
+            lambda _, request_id=request_id: loop.call_soon_threadsafe(done.put_nowait, request_id))
+
+
+async def poll_results(waiters, wait, receive, send):
+    """Send the answers ready so far, waiting up to wait seconds for the first"""
+    loop = asyncio.get_running_loop()
+    # Results may be read from the store, so off the loop
+    results = await loop.run_in_executor(None, api.ready_results, waiters)
+    if not results and wait > 0:
+        done = asyncio.Queue()
+        notify_done(waiters, done)
+        first = asyncio.ensure_future(done.get())
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({first, disconnect}, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if disconnect.done():
+                return
+        finally:
+            first.cancel()
+            disconnect.cancel()
+        results = await loop.run_in_executor(None, api.ready_results, waiters)
+    await send_json(send, 200, {
+        'object': 'list',
+        'data': results,
+        'pending': api.pending_ids(waiters, results)
+    })
+
+
+async def stream_results(waiters, wait, receive, send):
+    """Send an NDJSON line per request as it completes, for up to wait seconds"""
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + wait
+    done = asyncio.Queue()
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': response_headers(b'application/x-ndjson', {
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+        })
+        results = await loop.run_in_executor(None, api.ready_results, waiters)
+        remaining = {request_id: waiters[request_id] for request_id in api.pending_ids(waiters, results)}
+        for result in results:
+            await send_event(send, json.dumps(result) + '\n')
+        notify_done(remaining, done)
+        while remaining:
+            update = asyncio.ensure_future(done.get())
+            await asyncio.wait({update, disconnect}, timeout=deadline - time.monotonic(),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if disconnect.done():
+                update.cancel()
+                return
+            if not update.done():
+                update.cancel()
+                break
+            request_id = update.result()
+            result = await loop.run_in_executor(None, api.batch_result, request_id, remaining.pop(request_id))
+            await send_event(send, json.dumps(result) + '\n')
+        for request_id in remaining:
+            await send_event(send, json.dumps({'id': request_id, 'status': 'pending'}) + '\n')
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+
+
+async def responses_batch(scope, receive, send):
+    """Bulk results (see app.get_responses_batch), waiting without holding a thread"""
+    started = time.perf_counter()
+    body = await read_body(receive)
+    if body is None:
+        return
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    send = recording(send, scope, headers, body, started)
+    if 'json' not in headers.get('Content-Type', ''):
+        await send_json(send, 415, {'error': 'Content-Type must be application/json'})
+        return
+    try:
+        request_ids, stream_mode, wait = api.results_request(json.loads(body))
+    except ValueError:
+        await send_json(send, 400, {'error': 'Request body is not valid JSON'})
+        return
+    except api.InvalidRequest as e:
+        await send_json(send, e.status, {'error': str(e)})
+        return
+
+    waiters = api.watch_requests(request_ids)
+    try:
+        if stream_mode:
+            await stream_results(waiters, wait, receive, send)
+        else:
+            await poll_results(waiters, wait, receive, send)
+    finally:
+        for request_id, waiter in waiters.items():
+            api.release_request(request_id, waiter)
+
+
+def push_slots(scope):
+    """How many messages a push stream's worker takes at once, from ?slots= (default 1)"""
+    try:
+        slots = int(parse_qs(scope['query_string'].decode('latin-1')).get('slots', ['1'])[0])
+    except ValueError:
+        slots = 1
+    return min(max(slots, 1), api.MAX_FETCH)
+
+
+def release_leases(leases):
+    for lease in leases:
+        api.expire_lease(lease['item']['id'], lease['lease_id'])
+
+
+async def push_work(scope, receive, send, worker_id):
+    """Push messages to a worker as server-sent events the moment they are queued.
+
+    The worker holds at most ?slots= leases at once and is sent the next
+    message as soon as it answers or releases one. It answers over HTTP as
+    usual; storing the answer acknowledges the lease. Leases handed out
+    while the worker was disconnecting are released for redelivery.
+    """
+    started = time.perf_counter()
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    send = recording(send, scope, headers, b'', started, '/api/v1/workers/<worker_id>/stream')
+    slots = push_slots(scope)
+    api.touch_worker(worker_id)
+    loop = asyncio.get_running_loop()
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    ends = time.monotonic() + api.PUSH_STREAM_LIFETIME
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': response_headers(b'text/event-stream; charset=utf-8', {
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+        })
+        await send_event(send, 'event: hello\ndata: ' + json.dumps({
+            'worker_id': worker_id,
+            'slots': slots,
+            'heartbeat_interval': api.HEARTBEAT_INTERVAL,
+            'lease_timeout': api.LEASE_TIMEOUT
+        }) + '\n\n')
+        while time.monotonic() < ends:
+            dispatch = loop.run_in_executor(
+                push_pool, api.dequeue_message, api.PUSH_KEEPALIVE, worker_id, slots, slots)
+            await asyncio.wait({dispatch, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            # The dispatch thread gives up within PUSH_KEEPALIVE; whatever it leased must not be lost
+            leases = await dispatch
+            if disconnect.done():
+                release_leases(leases)
+                return
+            # An open stream counts as contact, like a heartbeat
+            api.touch_worker(worker_id)
+            if not leases:
+                await send_event(send, ': keep-alive\n\n')
+            for index, lease in enumerate(leases):
+                try:
+                    await send_event(send, 'event: work\ndata: ' + json.dumps(api.work_item(lease)) + '\n\n')
+                except Exception:
+                    release_leases(leases[index:])
+                    raise
+        # Bounded streams keep the worker's buffered response text small; it reconnects right away
+        await send_event(send, 'event: reconnect\ndata: {}\n\n')
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            api.start_background_threads()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in COMPLETION_PATHS:
+        await chat_completions(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == RESULTS_PATH:
+        await responses_batch(scope, receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'GET' and PUSH_PATH.match(scope['path']):
+        await push_work(scope, receive, send, PUSH_PATH.match(scope['path']).group(1))
+    else:
+        await flask_application(scope, receive, send)
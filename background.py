@@ -0,0 +1,86 @@
+"""
+Hand-off from request threads to a background writer thread.
+
+Traffic capture, span export and logging all write from their own
+BackgroundWriter. put() never blocks: once queue_size items are waiting,
+new ones are dropped and counted, so a slow disk or collector never holds
+up a request. The thread starts with the first item and passes whatever
+has piled up, up to batch items, to the write function in one call. A
+batch that raises is counted as failed and its error is kept for stats.
+"""
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+# Items waiting for the writer beyond which new ones are dropped
+QUEUE_SIZE = 10000
+
+
+class BackgroundWriter:
+    """A bounded queue drained in batches by one lazily started daemon thread.
+
+    write(items) receives a list of queued items. count(item) says how many
+    units (calls, spans, records) an item stands for in the counters.
+    """
+
+    def __init__(self, write, name, queue_size=QUEUE_SIZE, batch=500, count=None):
+        self.write = write
+        self.name = name
+        self.batch = batch
+        self.count = count or (lambda item: 1)
+        self._queue = Queue(queue_size)
+        self._lock = Lock()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_error = None
+
+    def put(self, item):
+        """Queue item without blocking; returns False if it was dropped"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            with self._lock:
+                self.dropped += self.count(item)
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            units = sum(self.count(item) for item in items)
+            try:
+                self.write(items)
+                with self._lock:
+                    self.written += units
+            except Exception as e:
+                with self._lock:
+                    self.failed += units
+                    self.last_error = str(e)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far has been written (or has failed)"""
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'queued': self._queue.qsize(),
+                'last_error': self.last_error
+            }
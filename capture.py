@@ -0,0 +1,95 @@
+"""
+Opt-in capture of incoming API calls, for replay.py.
+
+Each call is appended to a JSONL file with its arrival time (and offset from
+the first captured call, which gives the inter-arrival timing), method,
+path, query string, the headers that steer scheduling, its body, size,
+response status and time to response headers. Credentials are never
+written: an API key is kept only as its hashed flow, 'key-<hash>'. The
+hot path only hands a tuple to a BackgroundWriter, which serializes and
+writes in batches.
+"""
+from threading import Lock
+import json
+
+from background import BackgroundWriter
+from scheduler import key_flow
+
+# Most calls written per flush
+CAPTURE_BATCH = 500
+# Request headers kept with each call
+CAPTURED_HEADERS = ('Content-Type', 'X-Client-ID', 'X-Priority', 'X-Worker-ID')
+# Headers carrying an API key, kept as 'credentials' with the key replaced by its flow
+CREDENTIAL_HEADERS = ('Authorization', 'X-API-Key')
+# Calls made by browser workers rather than API clients; replay skips them
+WORKER_PATHS = (
+    '/api/v1/messages/pending',
+    '/api/v1/messages/mark-processed',
+    '/api/v1/chat/completions/latest',
+    '/api/v1/chat/completions/partial',
+    '/api/v1/workers'
+)
+
+
+def is_worker_call(path, headers):
+    return 'X-Worker-ID' in headers or path.startswith(WORKER_PATHS)
+
+
+def redact(value):
+    """A credential header value with its key replaced by key_flow(key); an auth scheme is kept"""
+    scheme, _, key = value.strip().rpartition(' ')
+    return f'{scheme} {key_flow(key)}'.lstrip()
+
+
+class TrafficCapture:
+    """Appends captured calls to a JSONL file from a background thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = BackgroundWriter(self._write, 'traffic-capture', batch=CAPTURE_BATCH)
+        self._lock = Lock()
+        self._first = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def record(self, at, method, path, query, headers, body, status, duration):
+        """Queue one call without blocking. headers: any mapping; body: bytes"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._first is None:
+                self._first = at
+        kept = {name: headers[name] for name in CAPTURED_HEADERS if headers.get(name)}
+        credentials = {name: redact(headers[name]) for name in CREDENTIAL_HEADERS if headers.get(name)}
+        self._writer.put((at, method, path, query, kept, credentials, body, status, duration))
+
+    def _entry(self, at, method, path, query, headers, credentials, body, status, duration):
+        entry = {
+            'at': at,
+            'offset': round(at - self._first, 6),
+            'method': method,
+            'path': path,
+            'query': query,
+            'headers': headers,
+            'credentials': credentials,
+            'size': len(body),
+            'status': status,
+            'duration': round(duration, 6),
+            'role': 'worker' if is_worker_call(path, headers) else 'client'
+        }
+        try:
+            entry['json'] = json.loads(body) if body else None
+        except ValueError:
+            entry['body'] = body.decode('utf-8', 'replace')
+        return json.dumps(entry, separators=(',', ':'))
+
+    def _write(self, calls):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(self._entry(*call) + '\n' for call in calls))
+
+    def stats(self):
+        stats = self._writer.stats()
+        stats['captured'] = stats.pop('written')
+        return dict(stats, enabled=self.enabled, path=self.path)
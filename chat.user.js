@@ -12,9 +12,22 @@
     'use strict';
 
     const API_BASE = 'http://localhost:5001/api/v1';
-    const RETRY_DELAY = 5000;
-    const MAX_RETRIES = 10;
+    // Give up on an answer when the page shows no progress for this long
+    const RESPONSE_IDLE_TIMEOUT = 50000;
+    const PARTIAL_INTERVAL = 500;
+    const DEQUEUE_WAIT = 25;
+    const ERROR_BACKOFF = 2000;
+    const DEFAULT_HEARTBEAT_INTERVAL = 10000;
+    // How long to poll over HTTP before trying the push stream again after it failed
+    const PUSH_RETRY_DELAY = 30000;
+    // Identifies this tab to the server, which leases each dequeued message to one worker
+    const WORKER_ID = crypto.randomUUID();
+    const NEW_THREAD_TIMEOUT = 10000;
+    // What followResponse resolves with when the server says nobody wants the answer any more
+    const CANCELLED = Symbol('cancelled');
     let lastProcessedMessage = null;
+    // Conversation the open Grok thread holds, as named by the server; null for none
+    let currentSession = null;
 
     function getChatElements() {
         const textarea = document.querySelector('textarea');
@@ -31,7 +44,8 @@
                 headers: {
                     'Content-Type': 'application/json',
                     'Origin': 'https://grok.example.com',
-                    'Accept': 'application/json'
+                    'Accept': 'application/json',
+                    'X-Worker-ID': WORKER_ID
                 },
                 anonymous: true,
                 onload: function(response) {
@@ -92,66 +106,301 @@
         return true;
     }
 
-    async function getLastResponse(retries = 0) {
-        try {
-            const messages = document.querySelectorAll('.message-bubble');
-            
-            if (messages.length > 0) {
-                const lastMessage = messages[messages.length - 1];
-                const paragraphs = lastMessage.querySelectorAll('p');
-                
-                const parentDiv = lastMessage.closest('.relative.group');
-                const isGenerating = parentDiv?.querySelector('.animate-spin') || 
-                                    parentDiv?.querySelector('.typing-indicator') || 
-                                    !parentDiv?.querySelector('button[aria-label="Share conversation"]');
-                
-                if (!isGenerating && paragraphs.length > 0) {
-                    const messageText = Array.from(paragraphs)
-                        .map(p => p.textContent.trim())
-                        .filter(text => text.length > 0)
-                        .join('\n');
-                    
+    async function startNewThread() {
+        // Resolves true once an empty thread is open
+        const newChat = document.querySelector('a[aria-label="New chat"], button[aria-label="New chat"], a[href="/"]');
+        if (!newChat) {
+            console.error('New chat control not found');
+            return false;
+        }
+        newChat.click();
+        const deadline = Date.now() + NEW_THREAD_TIMEOUT;
+        while (Date.now() < deadline) {
+            if (document.querySelectorAll('.message-bubble').length === 0 && getChatElements().textarea) {
+                return true;
+            }
+            await new Promise(resolve => setTimeout(resolve, PARTIAL_INTERVAL));
+        }
+        return false;
+    }
+
+    function extractMessageText(message) {
+        return Array.from(message.querySelectorAll('p'))
+            .map(p => p.textContent.trim())
+            .filter(text => text.length > 0)
+            .join('\n');
+    }
+
+    function isGenerating(message) {
+        const parentDiv = message.closest('.relative.group');
+        return parentDiv?.querySelector('.animate-spin') ||
+               parentDiv?.querySelector('.typing-indicator') ||
+               !parentDiv?.querySelector('button[aria-label="Share conversation"]');
+    }
+
+    function commonPrefixLength(a, b) {
+        let i = 0;
+        while (i < a.length && i < b.length && a[i] === b[i]) {
+            i++;
+        }
+        return i;
+    }
+
+    function stopGenerating() {
+        document.querySelector('button[aria-label="Stop"], button[aria-label="Stop generating"]')?.click();
+    }
+
+    function followResponse(requestId, prompt) {
+        // Resolves with the answer as soon as Grok finishes it, null if the page stalls,
+        // or CANCELLED if the request was cancelled while Grok was still writing.
+        // Text is read again only when the DOM around the answer changes, and uploaded
+        // as partials carrying just what the server does not have yet.
+        return new Promise(resolve => {
+            let bubble = null;
+            let text = '';
+            let uploadedText = '';
+            let uploading = false;
+            let uploadTimer = null;
+            let idleTimer = null;
+            let checkQueued = false;
+            let done = false;
+
+            const finish = value => {
+                done = true;
+                observer.disconnect();
+                clearTimeout(idleTimer);
+                clearTimeout(uploadTimer);
+                resolve(value);
+            };
+            const resetIdle = () => {
+                clearTimeout(idleTimer);
+                idleTimer = setTimeout(() => finish(null), RESPONSE_IDLE_TIMEOUT);
+            };
+            const upload = () => {
+                uploadTimer = null;
+                if (done || uploading || text === uploadedText) {
+                    return;
+                }
+                uploading = true;
+                const snapshot = text;
+                // Grok may re-render earlier text, so resend from the first character that changed
+                const offset = commonPrefixLength(uploadedText, snapshot);
+                makeRequest('/chat/completions/partial', 'POST', {
+                    id: requestId,
+                    offset,
+                    response: snapshot.slice(offset)
+                })
+                    .then(reply => {
+                        if (reply.cancelled) {
+                            finish(CANCELLED);
+                        } else {
+                            uploadedText = snapshot;
+                        }
+                    })
+                    .catch(error => {
+                        // The server may have lost the earlier text; the next upload sends all of it
+                        uploadedText = '';
+                        console.error('Error sending partial response:', error);
+                    })
+                    .finally(() => {
+                        uploading = false;
+                        scheduleUpload();
+                    });
+            };
+            const scheduleUpload = () => {
+                if (!done && !uploadTimer && text !== uploadedText) {
+                    uploadTimer = setTimeout(upload, PARTIAL_INTERVAL);
+                }
+            };
+            const check = () => {
+                checkQueued = false;
+                if (done) {
+                    return;
+                }
+                const messages = document.querySelectorAll('.message-bubble');
+                if (messages.length === 0) {
+                    return;
+                }
+                bubble = messages[messages.length - 1];
+                const messageText = extractMessageText(bubble);
+                if (!isGenerating(bubble)) {
                     if (messageText.length > 0 && messageText !== lastProcessedMessage) {
                         lastProcessedMessage = messageText;
-                        return messageText;
+                        finish(messageText);
                     }
+                } else if (messageText.length > 0 && messageText !== prompt &&
+                           messageText !== lastProcessedMessage && messageText !== text) {
+                    text = messageText;
+                    resetIdle();
+                    scheduleUpload();
                 }
+            };
+            const observer = new MutationObserver(mutations => {
+                // Text changes elsewhere on the page are ignored; added nodes may be a new bubble
+                const group = bubble?.isConnected ? bubble.closest('.relative.group') : null;
+                if (group && !mutations.some(mutation =>
+                    mutation.addedNodes.length > 0 || group.contains(mutation.target))) {
+                    return;
+                }
+                if (!checkQueued) {
+                    checkQueued = true;
+                    queueMicrotask(check);
+                }
+            });
+            observer.observe(document.body, { childList: true, subtree: true, characterData: true });
+            resetIdle();
+            check();
+        });
+    }
+
+    async function handleWorkItem(result, pushed = false) {
+        if (!(result.choices && result.choices.length > 0 && result.choices[0].message.content)) {
+            return;
+        }
+        let prompt = result.choices[0].message.content;
+        let ready = true;
+        if (result.thread === 'continue' && result.session !== currentSession) {
+            // The thread moved on since the server picked this tab: replay the conversation instead
+            prompt = result.context;
+            ready = await startNewThread();
+        } else if (result.thread === 'new' || (!result.thread && currentSession)) {
+            ready = await startNewThread();
+        }
+        currentSession = null;
+        const sent = ready && sendMessage(prompt);
+        // Reported with the answer, so the request timeline shows the time spent in Grok
+        const sentAt = Date.now() / 1000;
+        const response = sent ? await followResponse(result.id, prompt) : null;
+        if (response === CANCELLED) {
+            // The server already took the message back; just stop Grok and move on
+            stopGenerating();
+            console.log(`Request ${result.id} was cancelled`);
+        } else if (response) {
+            // Echo the request ID so the server can hand the answer to the waiting caller
+            const stored = await makeRequest('/chat/completions', 'POST', {
+                id: result.id,
+                lease_id: result.lease_id,
+                response,
+                sent_at: sentAt
+            });
+            currentSession = stored.session || null;
+            // Storing the answer acknowledges the lease; polling workers also confirm it explicitly
+            if (!pushed) {
+                await makeRequest('/messages/mark-processed', 'POST', { 
+                    id: result.id,
+                    lease_id: result.lease_id,
+                    message: prompt
+                });
             }
-            
-            if (retries < MAX_RETRIES) {
-                await new Promise(resolve => setTimeout(resolve, RETRY_DELAY));
-                return getLastResponse(retries + 1);
-            }
-            
-            return null;
-        } catch (error) {
-            console.error('Error getting last response:', error);
-            return null;
+        } else {
+            // Give the message back so another worker can pick it up immediately
+            await makeRequest('/messages/mark-processed', 'POST', {
+                id: result.id,
+                lease_id: result.lease_id,
+                release: true
+            });
         }
     }
 
     async function processPendingMessage() {
         try {
-            const result = await makeRequest('/chat/completions/latest');
-            if (result.choices && result.choices.length > 0 && result.choices[0].message.content) {
-                if (sendMessage(result.choices[0].message.content)) {
-                    const response = await getLastResponse();
-                    if (response) {
-                        await makeRequest('/chat/completions', 'POST', { response });
-                        await makeRequest('/messages/mark-processed', 'POST', { 
-                            message: result.choices[0].message.content 
-                        });
+            // Long-poll: the server holds the request open until a message is queued
+            const result = await makeRequest(`/chat/completions/latest?wait=${DEQUEUE_WAIT}`);
+            await handleWorkItem(result);
+        } catch (error) {
+            console.error('Error processing message:', error);
+            // Avoid a tight retry loop while the server is unreachable
+            await new Promise(resolve => setTimeout(resolve, ERROR_BACKOFF));
+        }
+    }
+
+    function openPushStream() {
+        // Resolves when the stream ends: true if the server accepted it, false if it is unavailable
+        return new Promise(resolve => {
+            let accepted = false;
+            let seen = 0;
+            let buffer = '';
+            // The server sends the next message only after this one is answered or released
+            let queue = Promise.resolve();
+            const onEvent = block => {
+                const fields = {};
+                for (const line of block.split('\n')) {
+                    const colon = line.indexOf(':');
+                    if (colon > 0) {
+                        fields[line.slice(0, colon)] = line.slice(colon + 1).trim();
                     }
                 }
-            }
+                if (fields.event === 'work') {
+                    const item = JSON.parse(fields.data);
+                    queue = queue.then(() => handleWorkItem(item, true))
+                        .catch(error => console.error('Error processing pushed message:', error));
+                }
+            };
+            const onProgress = response => {
+                if (response.status !== 200 || !response.responseText) {
+                    return;
+                }
+                accepted = true;
+                buffer += response.responseText.slice(seen);
+                seen = response.responseText.length;
+                let end;
+                while ((end = buffer.indexOf('\n\n')) >= 0) {
+                    onEvent(buffer.slice(0, end));
+                    buffer = buffer.slice(end + 2);
+                }
+            };
+            GM_xmlhttpRequest({
+                method: 'GET',
+                url: `${API_BASE}/workers/${WORKER_ID}/stream`,
+                headers: {
+                    'Origin': 'https://grok.example.com',
+                    'Accept': 'text/event-stream',
+                    'X-Worker-ID': WORKER_ID
+                },
+                anonymous: true,
+                onprogress: onProgress,
+                onload: function(response) {
+                    onProgress(response);
+                    queue.then(() => resolve(accepted));
+                },
+                onerror: () => queue.then(() => resolve(accepted)),
+                ontimeout: () => queue.then(() => resolve(accepted))
+            });
+        });
+    }
+
+    async function registerWorker() {
+        // Heartbeats keep this tab eligible for new messages while it is busy generating
+        let interval = DEFAULT_HEARTBEAT_INTERVAL;
+        try {
+            const result = await makeRequest('/workers/register', 'POST', {
+                worker_id: WORKER_ID,
+                info: { url: location.href, userAgent: navigator.userAgent }
+            });
+            interval = (result.heartbeat_interval || interval / 1000) * 1000;
         } catch (error) {
-            console.error('Error processing message:', error);
+            console.error('Error registering worker:', error);
         }
+        setInterval(() => {
+            makeRequest(`/workers/${WORKER_ID}/heartbeat`, 'POST')
+                .catch(error => console.error('Error sending heartbeat:', error));
+        }, interval);
     }
 
-    function startMessageListener() {
+    async function startMessageListener() {
         console.log('Starting message listener...');
-        setInterval(processPendingMessage, 2000);
+        await registerWorker();
+        while (true) {
+            // Messages are pushed the moment they are queued; reconnect whenever the stream ends
+            if (await openPushStream()) {
+                continue;
+            }
+            console.log('Push stream unavailable, polling for messages');
+            const retryAt = Date.now() + PUSH_RETRY_DELAY;
+            while (Date.now() < retryAt) {
+                await processPendingMessage();
+            }
+        }
     }
 
     window.addEventListener('load', () => {
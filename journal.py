@@ -0,0 +1,170 @@
+"""
+Append-only write-ahead journal for the message queue and response buffer.
+
+Every state change (enqueue, lease, requeue, deadline, ack, drop, response) is written
+as one JSON line. A single writer thread takes everything that piled up
+while the previous fsync ran and commits it with one write and one fsync
+(group commit), so durable enqueues stay cheap under concurrency.
+
+The journal keeps its own compact view of the live state, which is what
+replay() returns on startup and what compaction rewrites the file from.
+"""
+from collections import OrderedDict
+from threading import Condition, Event, Thread
+import json
+import os
+import time
+
+
+class Journal:
+    def __init__(self, path, max_responses, response_ttl, compact_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_responses = max_responses
+        self.response_ttl = response_ttl
+        self.compact_bytes = compact_bytes
+        # request ID -> {'item': queue item, 'lease': lease record or None}, in enqueue order
+        self._items = OrderedDict()
+        # request ID -> response record, oldest first
+        self._responses = OrderedDict()
+        self._pending = []  # (record, encoded line, Event or None) waiting for the next commit
+        self._cond = Condition()
+        self._file = None
+        self._compacted_size = 0  # file size right after the last compaction
+        self._thread = None
+        self.commits = 0
+        self.records = 0
+        self.compactions = 0
+
+    def replay(self):
+        """Rebuild the live state from the file and return it.
+
+        Returns (items, responses): a list of {'item', 'lease'} dicts in enqueue
+        order, and a list of response records, oldest first. A torn last line
+        from a crash mid-write is ignored.
+        """
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply(record)
+        cutoff = time.time() - self.response_ttl
+        for request_id in [request_id for request_id, record in self._responses.items()
+                           if record['timestamp'] <= cutoff]:
+            del self._responses[request_id]
+        return list(self._items.values()), list(self._responses.values())
+
+    def start(self):
+        """Rewrite the file from the replayed state and start the writer thread"""
+        self._compact()
+        self._thread = Thread(target=self._run, name='journal-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, record, wait=False):
+        """Queue a record for the next commit, optionally blocking until it is on disk"""
+        event = Event() if wait else None
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._cond:
+            self._pending.append((record, line, event))
+            self._cond.notify()
+        if event is not None:
+            event.wait()
+
+    def _apply(self, record):
+        """Fold one record into the live state"""
+        op = record['op']
+        request_id = record.get('id')
+        if op == 'enqueue':
+            item = record['item']
+            self._items[item['id']] = {'item': item, 'lease': None}
+        elif op == 'lease':
+            entry = self._items.get(request_id)
+            if entry is not None:
+                entry['item']['deliveries'] = record['delivery']
+                entry['lease'] = record
+        elif op == 'requeue':
+            entry = self._items.get(request_id)
+            if entry is not None:
+                entry['item']['deliveries'] = record['deliveries']
+                entry['lease'] = None
+        elif op == 'deadline':
+            entry = self._items.get(request_id)
+            if entry is not None:
+                entry['item']['deadline'] = record['deadline']
+        elif op in ('ack', 'drop'):
+            self._items.pop(request_id, None)
+        elif op == 'response':
+            self._items.pop(request_id, None)
+            self._responses.pop(request_id, None)
+            self._responses[request_id] = record
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+
+    def _live_records(self):
+        for entry in self._items.values():
+            yield {'op': 'enqueue', 'item': entry['item']}
+            if entry['lease'] is not None:
+                yield entry['lease']
+        cutoff = time.time() - self.response_ttl
+        for record in self._responses.values():
+            if record['timestamp'] > cutoff:
+                yield record
+
+    def _compact(self):
+        """Replace the file with just the live state. Runs on the writer thread."""
+        if self._file is not None:
+            self._file.close()
+        temp_path = self.path + '.compact'
+        with open(temp_path, 'wb') as f:
+            for record in self._live_records():
+                f.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._file = open(self.path, 'ab')
+        self._compacted_size = self._file.tell()
+        self.compactions += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            # Everything that arrived during the previous fsync shares this one
+            self._file.write(b''.join(line for _, line, _ in batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            for record, _, _ in batch:
+                self._apply(record)
+            for _, _, event in batch:
+                if event is not None:
+                    event.set()
+            self.commits += 1
+            self.records += len(batch)
+            # Compact once the log is big and mostly history, not live state
+            size = self._file.tell()
+            if size > self.compact_bytes and size > 2 * self._compacted_size:
+                self._compact()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            'path': self.path,
+            'bytes': self._file.tell() if self._file is not None else 0,
+            'live_items': len(self._items),
+            'live_responses': len(self._responses),
+            'records': self.records,
+            'commits': self.commits,
+            'records_per_commit': self.records / self.commits if self.commits else 0.0,
+            'pending': pending,
+            'compactions': self.compactions
+        }
@@ -0,0 +1,155 @@
+"""
+Load generator for the OpenAI-compatible completions endpoint.
+
+Runs a number of concurrent clients, each sending /v1/chat/completions
+requests back to back over its own keep-alive session, and reports
+throughput and latency percentiles. With --workers it also starts that many
+simulated workers (see sim_worker.py) so a run needs no browser:
+
+    python3 loadgen.py --clients 50 --requests 2000 --workers 8 --latency exp:0.5
+    python3 loadgen.py --clients 20 --duration 60 --json > run.json
+
+Prompts are unique per request unless --repeat is given, so the response
+cache and request coalescing do not hide the queue.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+import sim_worker
+
+
+def percentile(sorted_values, share):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(int(-(-share * len(sorted_values) // 1)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, statuses, elapsed):
+    """Throughput and latency percentiles of successful requests, and counts by status"""
+    latencies = sorted(latencies)
+    return {
+        'requests': sum(statuses.values()),
+        'ok': len(latencies),
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None
+        }
+    }
+
+
+class LoadGenerator:
+    def __init__(self, url, clients, requests_total=None, duration=None, prompt='Benchmark prompt',
+                 repeat=False, model='2', timeout=120):
+        self.url = url.rstrip('/')
+        self.clients = clients
+        self.requests_total = requests_total
+        self.duration = duration
+        self.prompt = prompt
+        self.repeat = repeat
+        self.model = model
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._issued = 0
+        self.latencies = []
+        self.statuses = Counter()
+
+    def _next(self, deadline):
+        """Whether a client may send another request"""
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        with self._lock:
+            if self.requests_total is not None and self._issued >= self.requests_total:
+                return False
+            self._issued += 1
+            return True
+
+    def _client(self, deadline):
+        session = requests.Session()
+        while self._next(deadline):
+            prompt = self.prompt if self.repeat else f'{self.prompt} {uuid.uuid4()}'
+            started = time.perf_counter()
+            try:
+                response = session.post(f'{self.url}/v1/chat/completions', json={
+                    'model': self.model,
+                    'messages': [{'role': 'user', 'content': prompt}],
+                    'timeout': self.timeout
+                }, timeout=self.timeout + 10)
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.statuses[status] += 1
+                if status == 200:
+                    self.latencies.append(elapsed)
+
+    def run(self):
+        deadline = time.monotonic() + self.duration if self.duration else None
+        threads = [threading.Thread(target=self._client, args=(deadline,), daemon=True)
+                   for _ in range(self.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(self.latencies, self.statuses, time.perf_counter() - started)
+
+
+def print_report(report):
+    def ms(value):
+        return '-' if value is None else f'{value * 1000:.1f} ms'
+    latency = report['latency']
+    print(f"Requests:   {report['requests']} ({report['ok']} ok) in {report['elapsed']:.2f} s")
+    print(f"Throughput: {report['throughput']:.2f} req/s")
+    print(f"Latency:    p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, "
+          f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}")
+    print('Statuses:   ' + ', '.join(f'{status}: {count}' for status, count in report['statuses'].items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure completion throughput and latency')
+    parser.add_argument('--clients', type=int, default=10, help='Concurrent clients (default: 10)')
+    parser.add_argument('--requests', type=int, help='Total requests to send (default: 100 without --duration)')
+    parser.add_argument('--duration', type=float, help='Send requests for this many seconds instead')
+    parser.add_argument('--prompt', default='Benchmark prompt', help='Prompt text (default: "Benchmark prompt")')
+    parser.add_argument('--repeat', action='store_true', help='Send the same prompt every time')
+    parser.add_argument('--timeout', type=float, default=120, help='Per-request completion timeout (default: 120)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Simulated workers to run alongside the clients (default: 0, use real ones)')
+    sim_worker.add_worker_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+
+    workers = sim_worker.start_workers(args.workers, **sim_worker.worker_options(args))
+    report = LoadGenerator(args.url, args.clients, args.requests, args.duration, args.prompt,
+                           args.repeat, timeout=args.timeout).run()
+    sim_worker.stop_workers(workers)
+    if workers:
+        report['workers'] = {key: sum(worker.stats[key] for worker in workers) for key in workers[0].stats}
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Structured, non-blocking logging.
+
+Records are handed to a BackgroundWriter and written by its thread as one
+JSON object per line, so a request never waits on formatting or disk.
+Request payloads travel with the record and are only serialized, and cut
+to a size cap, on that thread. Per-route sampling decides whether a
+request is logged at all; full bodies can be switched on at runtime for
+debugging.
+"""
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+from threading import Lock
+import atexit
+import json
+import logging
+import random
+import sys
+
+from background import BackgroundWriter
+
+
+def parse_rates(spec):
+    """Parse 'route=rate,route=rate' into a dict"""
+    rates = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        route, _, rate = part.rpartition('=')
+        rates[route.strip()] = float(rate)
+    return rates
+
+
+def summarize(payload, limit):
+    """Payload as JSON text, cut to limit characters unless limit is None"""
+    text = json.dumps(payload, default=str, separators=(',', ':'))
+    if limit is None or len(text) <= limit:
+        return {'body': text}
+    return {'body': text[:limit], 'truncated': True, 'size': len(text)}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and any structured fields"""
+
+    def __init__(self, max_payload):
+        super().__init__()
+        self.max_payload = max_payload
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if hasattr(record, 'payload'):
+            payload = record.payload
+            if isinstance(payload, dict) and isinstance(payload.get('messages'), list):
+                entry['messages'] = len(payload['messages'])
+            entry.update(summarize(payload, None if record.full_body else self.max_payload))
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler whose queue is a BackgroundWriter passing records on to target.
+
+    Records are dropped instead of blocking when the writer falls behind.
+    """
+
+    def __init__(self, target):
+        super().__init__(BackgroundWriter(self._write, 'log-writer'))
+        self.target = target
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+    def _write(self, records):
+        for record in records:
+            self.target.handle(record)
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+
+class RequestLogger:
+    """Sampled request logging with a runtime switch for full bodies"""
+
+    def __init__(self, logger, default_rate=1.0, rates=None, full_bodies=False):
+        self.logger = logger
+        self.default_rate = default_rate
+        self.rates = dict(rates or {})
+        self.full_bodies = full_bodies
+        self._lock = Lock()
+        # Approximate: incremented without a lock on the hot path
+        self.logged = 0
+        self.sampled_out = 0
+
+    def log(self, route, payload, message='Received request', **fields):
+        """Log a request to route with its payload, if the route's sample rate picks it"""
+        rate = self.rates.get(route, self.default_rate)
+        if rate < 1 and random.random() >= rate:
+            self.sampled_out += 1
+            return
+        self.logged += 1
+        fields['route'] = route
+        fields['sample_rate'] = rate
+        # The payload is serialized on the writer thread; callers must not mutate it afterwards
+        self.logger.info(message, extra={'fields': fields, 'payload': payload, 'full_body': self.full_bodies})
+
+    def configure(self, full_bodies=None, default_rate=None, rates=None):
+        with self._lock:
+            if full_bodies is not None:
+                self.full_bodies = bool(full_bodies)
+            if default_rate is not None:
+                self.default_rate = float(default_rate)
+            if rates is not None:
+                self.rates = {route: float(rate) for route, rate in rates.items()}
+
+    def settings(self):
+        with self._lock:
+            return {'full_bodies': self.full_bodies, 'sample_rate': self.default_rate, 'sample_rates': dict(self.rates)}
+
+
+def install(logger, path=None, max_payload=1024, level=logging.INFO):
+    """Route logger through a queue to a JSON writer thread (a file at path, else stderr).
+
+    Replaces the logger's existing handlers. Returns the queue handler.
+    """
+    target = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JSONFormatter(max_payload))
+    handler = DroppingQueueHandler(target)
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    # Write out whatever is still queued when the process exits
+    atexit.register(handler.queue.flush)
+    return handler
+
+
+def stats(handler, request_logger):
+    return dict(
+        request_logger.settings(),
+        queued=handler.queue.stats()['queued'],
+        dropped=handler.dropped,
+        logged=request_logger.logged,
+        sampled_out=request_logger.sampled_out)
@@ -0,0 +1,131 @@
+"""
+Counters and histograms in the Prometheus text exposition format.
+
+Metrics are created once, at import or on a route's first request, so
+recording on the hot path is a bisect and a few integer increments under
+an uncontended lock; no label dicts are built per request. Gauges are
+read from the store when /metrics is scraped.
+"""
+from bisect import bisect_left
+from threading import Lock
+
+# Latency buckets in seconds, from a cache hit to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Route label for requests that matched no route
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        # Prometheus buckets are cumulative upper bounds (value <= le)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """(cumulative bucket counts, count, sum)"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, total
+
+
+class RouteStats:
+    """Requests by status class, server errors and latency of one route"""
+
+    def __init__(self):
+        self.statuses = [0] * 6  # index: status // 100
+        self.latency = Histogram()
+        self._lock = Lock()
+
+    def observe(self, status, seconds):
+        self.latency.observe(seconds)
+        with self._lock:
+            self.statuses[min(status // 100, 5)] += 1
+
+    @property
+    def errors(self):
+        return self.statuses[5]
+
+
+class RouteMetrics:
+    """RouteStats per route pattern, e.g. '/api/v1/responses/<request_id>'"""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = Lock()
+
+    def route(self, name):
+        stats = self._routes.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._routes.setdefault(name, RouteStats())
+        return stats
+
+    def observe(self, name, status, seconds):
+        self.route(name or UNMATCHED_ROUTE).observe(status, seconds)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._routes.items())
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**pairs):
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs.items()) + '}' if pairs else ''
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Exposition:
+    """Builds one scrape's worth of text, family by family"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name, value, **pairs):
+        if value is None:
+            return
+        self.lines.append(f'{name}{labels(**pairs)} {number(value)}')
+
+    def gauge(self, name, help_text, value, **pairs):
+        self.family(name, 'gauge', help_text)
+        self.sample(name, value, **pairs)
+
+    def counter(self, name, help_text, value, **pairs):
+        self.family(name, 'counter', help_text)
+        self.sample(name, value, **pairs)
+
+    def histogram(self, name, histogram, **pairs):
+        """Samples of one histogram; call family() first"""
+        cumulative, count, total = histogram.snapshot()
+        for bound, bucket in zip(histogram.buckets + (float('inf'),), cumulative):
+            self.sample(f'{name}_bucket', bucket, **pairs, le=number(bound))
+        self.sample(f'{name}_count', count, **pairs)
+        self.sample(f'{name}_sum', total, **pairs)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
@@ -0,0 +1,283 @@
+"""
+Replays traffic captured with CAPTURE_PATH against a server.
+
+Client calls are sent with their captured method, path, headers and body,
+at their captured offsets divided by --speed (1 for real time, 10 for ten
+times faster, 0 for as fast as possible). Worker calls are skipped; run
+real or simulated workers (--workers, see sim_worker.py) to answer.
+Submissions to /api/v1/chat and /api/v1/chat/batch are followed up with
+/api/v1/responses/batch until answered, so their latency is end to end
+like that of a completion.
+
+Each call's status and latency are written as JSONL with --output. A
+previous output passed as --baseline is compared route by route, which
+shows how a server change moved latency on the same traffic:
+
+    python3 replay.py capture.jsonl --speed 5 --output before.jsonl
+    python3 replay.py capture.jsonl --speed 5 --output after.jsonl --baseline before.jsonl
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import sim_worker
+from loadgen import percentile
+
+# Calls that submit work; the rest (polls for old request IDs, stats) are skipped unless --all
+SUBMIT_PATHS = ('/v1/chat/completions', '/api/v1/chat/completions', '/api/v1/chat', '/api/v1/chat/batch')
+ASYNC_PATHS = ('/api/v1/chat', '/api/v1/chat/batch')
+# Longest single wait when following up an asynchronous submission (seconds)
+RESULT_POLL_WAIT = 30
+
+
+def load_capture(path, all_calls=False):
+    """Client calls from a capture file, in arrival order"""
+    calls = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            call = json.loads(line)
+            if call.get('role') == 'worker':
+                continue
+            if not all_calls and call['path'] not in SUBMIT_PATHS:
+                continue
+            calls.append(call)
+    calls.sort(key=lambda call: call['offset'])
+    # The replay starts with the first call it sends
+    first = calls[0]['offset'] if calls else 0
+    for call in calls:
+        call['offset'] -= first
+    return calls
+
+
+def replay_headers(call):
+    """Captured headers, plus a made-up key for each captured one.
+
+    Captures hold keys only as 'key-<hash>' (see capture.redact). Each
+    becomes the key 'replay-key-<hash>', so calls made with one key are
+    still scheduled as one client, apart from the others.
+    """
+    headers = dict(call.get('headers') or {})
+    for name, value in (call.get('credentials') or {}).items():
+        scheme, _, flow = value.rpartition(' ')
+        headers[name] = f'{scheme} replay-{flow}'.lstrip()
+    return headers
+
+
+def distinct_messages(path, body, index):
+    """An /api/v1/chat or /api/v1/chat/batch body with each message tagged with the call's index.
+
+    The server refuses a message it saw within DEDUP_TTL, so without this a
+    --no-cache replay of a capture that repeats prompts measures those 400s
+    instead of the load.
+    """
+    if not isinstance(body, dict):
+        return body
+    body = dict(body)
+    if path == '/api/v1/chat' and isinstance(body.get('message'), str):
+        body['message'] += f' [replay {index}]'
+    elif path == '/api/v1/chat/batch' and isinstance(body.get('messages'), list):
+        messages = []
+        for n, entry in enumerate(body['messages']):
+            if isinstance(entry, str):
+                entry = f'{entry} [replay {index}.{n}]'
+            elif isinstance(entry, dict) and isinstance(entry.get('message'), str):
+                entry = dict(entry, message=f"{entry['message']} [replay {index}.{n}]")
+            messages.append(entry)
+        body['messages'] = messages
+    return body
+
+
+def submitted_ids(path, body):
+    """Request IDs an asynchronous submission returned"""
+    if path == '/api/v1/chat':
+        return [body['id']] if body.get('id') else []
+    return [entry['id'] for entry in body.get('data', []) if entry.get('id')]
+
+
+class Replayer:
+    def __init__(self, url, calls, speed=1.0, concurrency=256, timeout=300, no_cache=False):
+        self.url = url.rstrip('/')
+        self.calls = calls
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.no_cache = no_cache
+        self._local = threading.local()
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def await_results(self, ids, deadline):
+        """Long-poll until every ID is answered or the deadline passes; True if all were"""
+        pending = list(ids)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            response = self.session().post(f'{self.url}/api/v1/responses/batch', json={
+                'ids': pending,
+                'wait': min(remaining, RESULT_POLL_WAIT)
+            }, timeout=RESULT_POLL_WAIT + 10)
+            response.raise_for_status()
+            pending = response.json()['pending']
+        return True
+
+    def send(self, index, call, scheduled):
+        started = time.monotonic()
+        result = {
+            'index': index,
+            'method': call['method'],
+            'path': call['path'],
+            'lag': max(started - scheduled, 0),
+            'captured_status': call.get('status'),
+            'captured_latency': call.get('duration')
+        }
+        headers = replay_headers(call)
+        if self.no_cache:
+            headers['Cache-Control'] = 'no-cache'
+        if 'json' in call:
+            body = call['json']
+            if self.no_cache and call['path'] in ASYNC_PATHS:
+                body = distinct_messages(call['path'], body, index)
+            body = None if body is None else json.dumps(body)
+        else:
+            body = call.get('body')
+        url = f"{self.url}{call['path']}" + (f"?{call['query']}" if call.get('query') else '')
+        try:
+            response = self.session().request(call['method'], url, data=body, headers=headers,
+                                              timeout=self.timeout)
+            result['status'] = response.status_code
+            if call['path'] in ASYNC_PATHS and response.status_code == 200:
+                ids = submitted_ids(call['path'], response.json())
+                result['answered'] = self.await_results(ids, started + self.timeout)
+        except requests.RequestException as e:
+            result['status'] = type(e).__name__
+        result['latency'] = time.monotonic() - started
+        return result
+
+    def run(self):
+        """Send every call on schedule and return their results in capture order"""
+        start = time.monotonic()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for index, call in enumerate(self.calls):
+                scheduled = start + call['offset'] / self.speed if self.speed > 0 else start
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(self.send, index, call, scheduled))
+        return [future.result() for future in futures]
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def by_route(results):
+    """Latency percentiles and error counts of successful calls, per method and path"""
+    groups = defaultdict(list)
+    for result in results:
+        groups[f"{result['method']} {result['path']}"].append(result)
+    summary = {}
+    for route, group in sorted(groups.items()):
+        latencies = sorted(result['latency'] for result in group
+                           if result['status'] == 200 and result.get('answered', True))
+        summary[route] = {
+            'calls': len(group),
+            'ok': len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)
+        }
+    return summary
+
+
+def compare(current, baseline):
+    """Per-route percentiles of both runs and their differences"""
+    comparison = {}
+    for route, stats in current.items():
+        before = baseline.get(route, {})
+        comparison[route] = dict(stats, baseline={key: before.get(key) for key in ('ok', 'p50', 'p95', 'p99')})
+        for key in ('p50', 'p95', 'p99'):
+            if stats[key] is not None and before.get(key) is not None:
+                comparison[route][f'{key}_delta'] = stats[key] - before[key]
+    return comparison
+
+
+def print_report(report):
+    def ms(value, sign=False):
+        if value is None:
+            return '-'
+        return f'{value * 1000:+.1f}' if sign else f'{value * 1000:.1f}'
+    print(f"Replayed {report['calls']} calls in {report['elapsed']:.2f} s "
+          f"(speed {report['speed']}, mean send lag {ms(report['mean_lag'])} ms)")
+    for route, stats in report['routes'].items():
+        line = (f"{route}: {stats['ok']}/{stats['calls']} ok, p50 {ms(stats['p50'])} ms, "
+                f"p95 {ms(stats['p95'])} ms, p99 {ms(stats['p99'])} ms")
+        if 'baseline' in stats:
+            line += (f" | vs baseline p50 {ms(stats.get('p50_delta'), True)}, "
+                     f"p95 {ms(stats.get('p95_delta'), True)}, p99 {ms(stats.get('p99_delta'), True)} ms")
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured API traffic against a server')
+    parser.add_argument('capture', help='JSONL file written with CAPTURE_PATH')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed: 1 is real time, 0 sends as fast as possible (default: 1)')
+    parser.add_argument('--all', action='store_true',
+                        help='Replay every client call, not just submissions')
+    parser.add_argument('--concurrency', type=int, default=256, help='Most calls in flight (default: 256)')
+    parser.add_argument('--timeout', type=float, default=300, help='Per-call timeout (default: 300)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Bypass the response cache, and make each /api/v1/chat message unique so '
+                             'repeats are not refused as duplicates')
+    parser.add_argument('--output', help='Write each call\'s result as JSONL to this file')
+    parser.add_argument('--baseline', help='Earlier --output to compare latencies with')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Simulated workers to run during the replay (default: 0, use real ones)')
+    sim_worker.add_worker_arguments(parser)
+    args = parser.parse_args(argv)
+
+    calls = load_capture(args.capture, args.all)
+    workers = sim_worker.start_workers(args.workers, **sim_worker.worker_options(args))
+    started = time.monotonic()
+    results = Replayer(args.url, calls, args.speed, args.concurrency, args.timeout, args.no_cache).run()
+    elapsed = time.monotonic() - started
+    sim_worker.stop_workers(workers)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(result) + '\n' for result in results))
+    routes = by_route(results)
+    if args.baseline:
+        routes = compare(routes, by_route(load_results(args.baseline)))
+    report = {
+        'calls': len(results),
+        'elapsed': elapsed,
+        'speed': args.speed,
+        'mean_lag': sum(result['lag'] for result in results) / len(results) if results else None,
+        'routes': routes
+    }
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Priority lanes with weighted fair queuing between clients.
+
+Lanes are served in strict priority order. Within a lane, each client flow
+(API key or client ID) is served by start-time fair queuing: a flow's items
+are stamped with a virtual finish time that advances by 1/weight per item,
+and the item with the lowest finish time goes first. A flow with weight 2
+gets twice the dispatches of a weight-1 flow while both have work queued,
+and a client that bulk-submits hundreds of prompts only delays itself.
+"""
+from collections import deque
+from queue import Empty
+from threading import Lock
+import hashlib
+import heapq
+import itertools
+import time
+
+# Dispatch waits kept per lane for the wait-time averages in stats
+WAIT_WINDOW = 100
+# Flows listed per lane in stats, deepest first
+STATS_TOP_FLOWS = 10
+# Flow of items that carry no client identity
+ANONYMOUS_FLOW = 'anonymous'
+
+
+def key_flow(api_key):
+    """Flow of a client identified by an API key. Keys are only ever shown hashed, e.g. in /api/v1/stats."""
+    return 'key-' + hashlib.blake2b(api_key.encode('utf-8'), digest_size=4).hexdigest()
+
+
+def parse_weights(spec):
+    """Parse 'flow=weight,flow=weight' into a dict"""
+    weights = {}
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        flow, _, weight = part.partition('=')
+        weights[flow.strip()] = float(weight)
+    return weights
+
+
+class LaneConfig:
+    """Lane names (highest priority first), the default lane and per-flow weights"""
+
+    def __init__(self, lanes, default_lane, weights=None, default_weight=1.0):
+        if default_lane not in lanes:
+            raise ValueError(f'Default lane {default_lane!r} is not one of {lanes}')
+        self.lanes = list(lanes)
+        self.default_lane = default_lane
+        self.weights = weights or {}
+        self.default_weight = default_weight
+
+    def lane_for(self, name):
+        """The lane called name, or the default lane for unknown or missing names"""
+        return name if name in self.lanes else self.default_lane
+
+    def rank(self, lane):
+        return self.lanes.index(lane)
+
+    def weight(self, flow):
+        return self.weights.get(flow, self.default_weight)
+
+    def stamp(self, vtime, last_finish, flow):
+        """Virtual (start, finish) tags for a new item of flow"""
+        start = max(vtime, last_finish or 0.0)
+        return start, start + 1.0 / self.weight(flow)
+
+
+def close_gap(start, finish, followers):
+    """New tags for a flow's later items once its item tagged (start, finish) is withdrawn.
+
+    followers are the (start, finish) tags of the flow's items queued after
+    it, in order. Items stamped right behind the withdrawn one move up by
+    its cost, so the flow does not pay for work it never got. An item that
+    started afresh from virtual time ends the chain. Returns the new tags
+    of the items that moved, in order.
+    """
+    cost = finish - start
+    moved = []
+    for follower_start, follower_finish in followers:
+        if follower_start != finish:
+            break
+        moved.append((follower_start - cost, follower_finish - cost))
+        finish = follower_finish
+    return moved
+
+
+class WaitStats:
+    """Recent enqueue-to-dispatch waits per lane"""
+
+    def __init__(self, lanes):
+        self._waits = {lane: deque(maxlen=WAIT_WINDOW) for lane in lanes}
+        self._dispatched = {lane: 0 for lane in lanes}
+        self._lock = Lock()
+
+    def record(self, lane, item, now):
+        if 'enqueued_at' not in item:
+            return
+        with self._lock:
+            self._waits[lane].append(now - item['enqueued_at'])
+            self._dispatched[lane] += 1
+
+    def lane_stats(self, lane):
+        with self._lock:
+            waits = list(self._waits[lane])
+            dispatched = self._dispatched[lane]
+        return {
+            'dispatched': dispatched,
+            'avg_wait': sum(waits) / len(waits) if waits else None,
+            'max_wait': max(waits) if waits else None
+        }
+
+
+class FairQueue:
+    """In-process scheduler with the put/get_nowait/qsize interface of queue.Queue.
+
+    Items need 'lane' and 'flow' keys; 'enqueued_at' feeds the wait statistics.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._heaps = {lane: [] for lane in config.lanes}  # (finish, seq, start, item)
+        self._vtime = {lane: 0.0 for lane in config.lanes}
+        self._finish = {lane: {} for lane in config.lanes}  # flow -> finish tag of its last item
+        self._depths = {lane: {} for lane in config.lanes}  # flow -> queued items
+        self._seq = itertools.count()
+        self._size = 0
+        self._lock = Lock()
+        self.waits = WaitStats(config.lanes)
+
+    def put(self, item):
+        lane = self.config.lane_for(item.get('lane'))
+        flow = item.get('flow') or ANONYMOUS_FLOW
+        with self._lock:
+            start, finish = self.config.stamp(self._vtime[lane], self._finish[lane].get(flow), flow)
+            self._finish[lane][flow] = finish
+            heapq.heappush(self._heaps[lane], (finish, next(self._seq), start, item))
+            self._depths[lane][flow] = self._depths[lane].get(flow, 0) + 1
+            self._size += 1
+
+    def get_nowait(self):
+        with self._lock:
+            for lane in self.config.lanes:
+                heap = self._heaps[lane]
+                if heap:
+                    _, _, start, item = heapq.heappop(heap)
+                    self._vtime[lane] = max(self._vtime[lane], start)
+                    flow = item.get('flow') or ANONYMOUS_FLOW
+                    self._depths[lane][flow] -= 1
+                    if not self._depths[lane][flow]:
+                        del self._depths[lane][flow]
+                    self._size -= 1
+                    break
+            else:
+                raise Empty
+        self.waits.record(lane, item, time.time())
+        return item
+
+    def remove(self, item):
+        """Take item out of the queue, e.g. because it was cancelled; returns whether it was queued.
+
+        The flow's items behind it move up in its place (see close_gap).
+        """
+        lane = self.config.lane_for(item.get('lane'))
+        flow = item.get('flow') or ANONYMOUS_FLOW
+        with self._lock:
+            heap = self._heaps[lane]
+            index = next((index for index, entry in enumerate(heap) if entry[3] is item), None)
+            if index is None:
+                return False
+            finish, _, start, _ = heap[index]
+            heap[index] = heap[-1]
+            heap.pop()
+            followers = sorted((index for index, entry in enumerate(heap)
+                                if entry[0] > finish and (entry[3].get('flow') or ANONYMOUS_FLOW) == flow),
+                               key=lambda index: heap[index][0])
+            tags = [(heap[index][2], heap[index][0]) for index in followers]
+            moved = close_gap(start, finish, tags)
+            for index, (new_start, new_finish) in zip(followers, moved):
+                heap[index] = (new_finish, heap[index][1], new_start, heap[index][3])
+            heapq.heapify(heap)
+            # The flow's next item is stamped behind its last queued one
+            if len(moved) == len(tags) and self._finish[lane].get(flow) == (tags[-1][1] if tags else finish):
+                self._finish[lane][flow] = moved[-1][1] if moved else start
+            self._depths[lane][flow] -= 1
+            if not self._depths[lane][flow]:
+                del self._depths[lane][flow]
+            self._size -= 1
+        return True
+
+    def qsize(self):
+        return self._size
+
+    def prune(self):
+        """Forget flows that have fallen behind virtual time; they would restart from it anyway"""
+        with self._lock:
+            for lane, finishes in self._finish.items():
+                vtime = self._vtime[lane]
+                for flow in [flow for flow, finish in finishes.items() if finish <= vtime]:
+                    del finishes[flow]
+
+    def stats(self):
+        now = time.time()
+        lanes = {}
+        for lane in self.config.lanes:
+            with self._lock:
+                heap = self._heaps[lane]
+                depth = len(heap)
+                oldest = min((entry[3]['enqueued_at'] for entry in heap if 'enqueued_at' in entry[3]), default=None)
+                flows = sorted(self._depths[lane].items(), key=lambda flow: -flow[1])[:STATS_TOP_FLOWS]
+            lanes[lane] = dict(
+                self.waits.lane_stats(lane),
+                depth=depth,
+                oldest_age=now - oldest if oldest is not None else None,
+                flows=dict(flows))
+        return lanes
@@ -0,0 +1,47 @@
+"""
+Production launcher: serves the API from asgi.py on uvicorn.
+
+With the default in-memory store all queue and response state lives in one
+process, so the server runs a single event loop. With a shared store
+(STORE_URL=sqlite:///...) several processes can serve the same port.
+
+    python3 server.py --host 0.0.0.0 --port 5001
+    STORE_URL=sqlite:///state.db python3 server.py --workers 4
+"""
+import argparse
+import os
+
+import uvicorn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the Grok API on asyncio')
+    parser.add_argument('--host', default='0.0.0.0', help='Interface to bind (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=5001, help='Port to listen on (default: 5001)')
+    parser.add_argument('--log-level', default='info', help='uvicorn log level (default: info)')
+    parser.add_argument('--backlog', type=int, default=4096,
+                        help='Maximum number of pending connections (default: 4096)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Server processes; more than one needs a shared STORE_URL (default: 1)')
+    args = parser.parse_args(argv)
+    if args.workers > 1 and os.environ.get('STORE_URL', 'memory') == 'memory':
+        parser.error('--workers > 1 needs a shared store, e.g. STORE_URL=sqlite:///state.db')
+
+    print(f"Starting server on http://{args.host}:{args.port}")
+    print("OpenAI-compatible endpoints available at:")
+    print(f"  - http://localhost:{args.port}/v1/models")
+    print(f"  - http://localhost:{args.port}/v1/chat/completions")
+    uvicorn.run(
+        'asgi:application',
+        host=args.host,
+        port=args.port,
+        log_level=args.log_level,
+        backlog=args.backlog,
+        workers=args.workers,
+        # Completions are long-lived; keep idle client connections around for reuse
+        timeout_keep_alive=30
+    )
+
+
+if __name__ == '__main__':
+    main()
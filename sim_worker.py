@@ -0,0 +1,234 @@
+"""
+Headless stand-in for the chat.user.js browser worker.
+
+Speaks the same protocol as the userscript: registers and heartbeats,
+long-polls /api/v1/chat/completions/latest for a leased message, optionally
+uploads partial text, posts the answer to /api/v1/chat/completions and
+acknowledges it with /api/v1/messages/mark-processed. Instead of Grok it
+sleeps for a time drawn from a configurable distribution, and it can inject
+failures, so the queue can be exercised without a browser.
+
+    python3 sim_worker.py --workers 4 --latency exp:1.5 --release-rate 0.05
+
+Latency specs: fixed:S, uniform:LOW,HIGH, exp:MEAN, normal:MEAN,STDDEV,
+lognormal:MU,SIGMA (all in seconds).
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+DEFAULT_URL = 'http://localhost:5001'
+# Shorter than the userscript's long-poll so stopping a worker takes at most this long
+DEQUEUE_WAIT = 5
+ERROR_BACKOFF = 2
+
+
+def parse_latency(spec):
+    """A function returning response times in seconds, from a 'kind:params' spec"""
+    kind, _, params = spec.partition(':')
+    args = [float(value) for value in params.split(',')] if params else []
+    samplers = {
+        'fixed': lambda seconds: lambda: seconds,
+        'uniform': lambda low, high: lambda: random.uniform(low, high),
+        'exp': lambda mean: lambda: random.expovariate(1 / mean) if mean > 0 else 0,
+        'normal': lambda mean, stddev: lambda: max(random.gauss(mean, stddev), 0),
+        'lognormal': lambda mu, sigma: lambda: random.lognormvariate(mu, sigma)
+    }
+    if kind not in samplers:
+        raise ValueError(f'Unknown latency distribution: {kind}')
+    try:
+        return samplers[kind](*args)
+    except TypeError:
+        raise ValueError(f'Wrong number of parameters for {kind}: {spec}')
+
+
+class SimulatedWorker:
+    """One simulated browser tab: handles one message at a time until stopped"""
+
+    def __init__(self, url=DEFAULT_URL, latency=lambda: 1.0, response_chars=200, partials=0,
+                 release_rate=0.0, drop_rate=0.0, worker_id=None):
+        self.url = url.rstrip('/')
+        self.latency = latency
+        self.response_chars = response_chars
+        self.partials = partials
+        self.release_rate = release_rate
+        self.drop_rate = drop_rate
+        self.worker_id = worker_id or str(uuid.uuid4())
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json', 'X-Worker-ID': self.worker_id})
+        self.stopped = threading.Event()
+        self.stats = {'answered': 0, 'released': 0, 'dropped': 0, 'cancelled': 0, 'errors': 0}
+        self.thread = None
+
+    def api(self, method, endpoint, **kwargs):
+        response = self.session.request(method, f'{self.url}/api/v1{endpoint}', timeout=DEQUEUE_WAIT + 10, **kwargs)
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    def register(self):
+        result = self.api('POST', '/workers/register', json={
+            'worker_id': self.worker_id,
+            'info': {'userAgent': 'sim_worker.py'}
+        })
+        return result.get('heartbeat_interval', 10)
+
+    def heartbeat(self, interval):
+        while not self.stopped.wait(interval):
+            try:
+                self.api('POST', f'/workers/{self.worker_id}/heartbeat')
+            except requests.RequestException:
+                pass
+
+    def answer(self, prompt):
+        text = f'Simulated answer to: {prompt}'
+        return (text * (self.response_chars // max(len(text), 1) + 1))[:self.response_chars]
+
+    def release(self, item):
+        """Give a message back so it is redelivered right away"""
+        self.api('POST', '/messages/mark-processed', json={
+            'id': item['id'],
+            'lease_id': item.get('lease_id'),
+            'release': True
+        })
+        self.stats['released'] += 1
+
+    def handle(self, item):
+        request_id = item['id']
+        prompt = item['choices'][0]['message']['content']
+        roll = random.random()
+        if roll < self.drop_rate:
+            # A tab that crashed: the lease expires and the server redelivers
+            self.stats['dropped'] += 1
+            return
+        sent_at = time.time()
+        delay = self.latency()
+        response = self.answer(prompt)
+        if self.partials:
+            step = delay / (self.partials + 1)
+            uploaded = 0
+            for part in range(1, self.partials + 1):
+                if self.stopped.wait(step):
+                    self.release(item)
+                    return
+                # Like the userscript, upload only the text added since the last upload
+                end = len(response) * part // (self.partials + 1)
+                try:
+                    reply = self.api('POST', '/chat/completions/partial', json={
+                        'id': request_id,
+                        'offset': uploaded,
+                        'response': response[uploaded:end]
+                    })
+                    uploaded = end
+                except requests.RequestException:
+                    # The server lost the earlier text; the next upload sends all of it
+                    uploaded = 0
+                    continue
+                if reply.get('cancelled'):
+                    # Nobody wants the answer any more, and the server already took the message back
+                    self.stats['cancelled'] += 1
+                    return
+            delay = step
+        # A tab that could not get an answer out of Grok gives the message back,
+        # and so does one that is shut down mid-answer
+        if self.stopped.wait(delay) or roll < self.drop_rate + self.release_rate:
+            self.release(item)
+            return
+        self.api('POST', '/chat/completions', json={
+            'id': request_id,
+            'lease_id': item.get('lease_id'),
+            'response': response,
+            'sent_at': sent_at
+        })
+        self.api('POST', '/messages/mark-processed', json={
+            'id': request_id,
+            'lease_id': item.get('lease_id'),
+            'message': prompt
+        })
+        self.stats['answered'] += 1
+
+    def run(self):
+        try:
+            interval = self.register()
+        except requests.RequestException:
+            interval = 10
+        threading.Thread(target=self.heartbeat, args=(interval,), daemon=True).start()
+        while not self.stopped.is_set():
+            try:
+                item = self.api('GET', f'/chat/completions/latest?wait={DEQUEUE_WAIT}')
+                if item and item.get('choices'):
+                    if self.stopped.is_set():
+                        self.release(item)
+                    else:
+                        self.handle(item)
+            except requests.RequestException:
+                self.stats['errors'] += 1
+                self.stopped.wait(ERROR_BACKOFF)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_workers(count, **options):
+    """Run count simulated workers on daemon threads and return them"""
+    workers = [SimulatedWorker(**options) for _ in range(count)]
+    for worker in workers:
+        worker.thread = threading.Thread(target=worker.run, name=f'sim-worker-{worker.worker_id[:8]}', daemon=True)
+        worker.thread.start()
+    return workers
+
+
+def stop_workers(workers):
+    """Stop workers and wait for their open polls, so no message is left leased to them"""
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.thread.join(DEQUEUE_WAIT + 10)
+
+
+def add_worker_arguments(parser):
+    parser.add_argument('--url', default=DEFAULT_URL, help=f'Server URL (default: {DEFAULT_URL})')
+    parser.add_argument('--latency', default='fixed:1', type=parse_latency,
+                        help='Response time distribution, e.g. exp:1.5 or uniform:0.5,3 (default: fixed:1)')
+    parser.add_argument('--response-chars', type=int, default=200, help='Length of each answer (default: 200)')
+    parser.add_argument('--partials', type=int, default=0,
+                        help='Partial uploads per answer, spread over its response time (default: 0)')
+    parser.add_argument('--release-rate', type=float, default=0.0,
+                        help='Share of messages given back unanswered (default: 0)')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Share of messages silently abandoned until their lease expires (default: 0)')
+
+
+def worker_options(args):
+    return {
+        'url': args.url,
+        'latency': args.latency,
+        'response_chars': args.response_chars,
+        'partials': args.partials,
+        'release_rate': args.release_rate,
+        'drop_rate': args.drop_rate
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Answer queued messages like the browser worker would')
+    parser.add_argument('--workers', type=int, default=1, help='Simulated tabs (default: 1)')
+    add_worker_arguments(parser)
+    args = parser.parse_args(argv)
+
+    workers = start_workers(args.workers, **worker_options(args))
+    print(f'{args.workers} simulated worker(s) polling {args.url}')
+    try:
+        while True:
+            time.sleep(10)
+            totals = {key: sum(worker.stats[key] for worker in workers) for key in workers[0].stats}
+            print(', '.join(f'{key}: {value}' for key, value in totals.items()))
+    except KeyboardInterrupt:
+        stop_workers(workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1153 @@
+"""
+Storage backends for the message queue, leases, buffered responses and the
+dedup index.
+
+MemoryStore keeps everything in this process, optionally made durable by
+the write-ahead journal. SQLiteStore keeps it in a SQLite file that every
+server process on the host opens, so several processes serve one logical
+queue. Both expose the same methods, and app.py only talks to that
+interface.
+
+Waiting callers (Futures, streaming queues) always stay in the process that
+accepted the request. With a shared store, answers, partial text and
+delivery failures posted to another process are picked up by poll().
+"""
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from queue import Empty
+from threading import Lock, local
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+import uuid
+
+from scheduler import ANONYMOUS_FLOW, FairQueue, WaitStats, STATS_TOP_FLOWS, close_gap
+
+
+class DedupIndex:
+    """Recently processed messages, stored as fixed-size content fingerprints.
+
+    Entries expire after ttl seconds and the least recently added entry is
+    evicted once max_entries is reached, so memory stays bounded no matter
+    how long the process runs.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # fingerprint -> time added, oldest first
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def fingerprint(message):
+        return hashlib.blake2b(message.encode('utf-8'), digest_size=16).digest()
+
+    def _is_live(self, key, now):
+        added = self._entries.get(key)
+        return added is not None and now - added < self.ttl
+
+    def _add(self, key, now):
+        self._entries[key] = now
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def add(self, message):
+        """Record a message as processed"""
+        with self._lock:
+            self._add(self.fingerprint(message), time.time())
+
+    def check_and_add(self, message):
+        """Atomically record a message, returning True if it was already processed"""
+        key = self.fingerprint(message)
+        now = time.time()
+        with self._lock:
+            if self._is_live(key, now):
+                self.hits += 1
+                return True
+            self.misses += 1
+            self._add(key, now)
+            return False
+
+    def discard(self, message):
+        """Forget a message, e.g. because it was given up on before it was answered"""
+        with self._lock:
+            self._entries.pop(self.fingerprint(message), None)
+
+    def sweep(self):
+        """Drop expired entries, returning how many were removed"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with self._lock:
+            # Entries are kept in insertion order, so expired ones are at the front
+            while self._entries:
+                key, added = next(iter(self._entries.items()))
+                if added > cutoff:
+                    break
+                del self._entries[key]
+                removed += 1
+            self.expirations += removed
+        return removed
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+            lookups = self.hits + self.misses
+            return {
+                'entries': entries,
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                # Container overhead plus one 16-byte digest and one float per entry
+                'approx_bytes': sys.getsizeof(self._entries) + entries * (
+                    sys.getsizeof(b'\0' * 16) + sys.getsizeof(0.0))
+            }
+
+
+class TimelineIndex:
+    """Lifecycle events per request ID, bounded in count and age.
+
+    Timelines are kept in order of their latest event, so the least
+    recently active request is evicted first and expired ones are at the front.
+    """
+
+    def __init__(self, ttl, max_requests):
+        self.ttl = ttl
+        self.max_requests = max_requests
+        self._timelines = OrderedDict()  # request ID -> [event dict]
+        self._lock = Lock()
+
+    def _append(self, request_id, event):
+        """Caller must hold _lock"""
+        timeline = self._timelines.get(request_id)
+        if timeline is None:
+            timeline = self._timelines[request_id] = []
+        else:
+            self._timelines.move_to_end(request_id)
+        timeline.append(event)
+        while len(self._timelines) > self.max_requests:
+            self._timelines.popitem(last=False)
+
+    def add(self, events):
+        with self._lock:
+            for request_id, stage, at, attrs in events:
+                self._append(request_id, dict(attrs or {}, stage=stage, at=at))
+
+    def add_once(self, request_id, stage, at, attrs=None):
+        """Record stage unless request_id already has it; returns whether it was recorded"""
+        with self._lock:
+            if any(event['stage'] == stage for event in self._timelines.get(request_id, ())):
+                return False
+            self._append(request_id, dict(attrs or {}, stage=stage, at=at))
+            return True
+
+    def get(self, request_id):
+        with self._lock:
+            return sorted(self._timelines.get(request_id, ()), key=lambda event: event['at'])
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            while self._timelines:
+                request_id, timeline = next(iter(self._timelines.items()))
+                if timeline[-1]['at'] > cutoff:
+                    break
+                del self._timelines[request_id]
+
+    def __len__(self):
+        return len(self._timelines)
+
+
+# Reason recorded for an item dropped because its deadline passed while it was queued
+EXPIRED_REASON = 'Deadline passed before a worker picked up the message'
+
+
+def is_expired(item, now):
+    """Whether nobody is waiting for item any more"""
+    deadline = item.get('deadline')
+    return deadline is not None and deadline <= now
+
+def later_deadline(current, deadline):
+    """The deadline that keeps every caller covered; None means no deadline"""
+    if current is None or deadline is None:
+        return None
+    return max(current, deadline)
+
+def lease_matches(lease, lease_id, worker_id):
+    """Whether an ack naming lease_id, or else coming from worker_id, is for lease"""
+    if lease_id:
+        return lease['lease_id'] == lease_id
+    return not worker_id or lease['worker'] == worker_id
+
+def new_lease(item, worker_id, lease_timeout):
+    """Count a delivery of item and build its lease"""
+    item['deliveries'] = item.get('deliveries', 0) + 1
+    now = time.time()
+    return {
+        'item': item,
+        'lease_id': uuid.uuid4().hex,
+        'worker': worker_id,
+        'leased_at': now,
+        'expires': now + lease_timeout
+    }
+
+
+class MemoryStore:
+    """State held in this process. Fastest, but private to one server process."""
+
+    shared = False
+
+    def __init__(self, max_responses, response_ttl, dedup_ttl, dedup_max_entries, lanes, journal=None,
+                 timeline_ttl=3600, timeline_max_requests=10000):
+        self.response_ttl = response_ttl
+        self.journal = journal
+        # Lifecycle events per request, for /api/v1/requests/<id>/timeline. Not journaled.
+        self._timelines = TimelineIndex(timeline_ttl, timeline_max_requests)
+        # Queue items are dicts of the form {'id': request_id, 'message': content,
+        # 'lane', 'flow', 'enqueued_at'}, plus an optional 'deadline' after which
+        # nobody is waiting for the answer. See scheduler.py for the dispatch order.
+        self._queue = FairQueue(lanes)
+        self._queued = {}  # request ID -> queued item, for deadline extensions
+        # Items with an 'affinity' wait for that worker instead, ahead of the fair queue
+        self._pinned = {}  # worker ID -> deque of items
+        self._pin_lock = Lock()
+        # Messages handed to a worker but not yet acknowledged, keyed by request ID.
+        # Each lease holds the queue item, its lease ID, owning worker and expiry time.
+        self._inflight = {}
+        self._lease_lock = Lock()
+        # Requests given up on -> (status, reason, when), kept for response_ttl so pollers
+        # learn of it. status is 'failed', 'expired' or 'cancelled'. Guarded by _lease_lock.
+        self._given_up = OrderedDict()
+        self._last_dispatch = None  # when a message was last leased
+        # Responses are numbered with a contiguous sequence so that lookups by request ID
+        # and per-client "next response" cursors are both O(1) dict accesses.
+        self._storage = {
+            'responses': {},  # sequence number -> {'id', 'response', 'timestamp'}, oldest first
+            'by_id': {},  # request ID -> sequence number
+            'next_sequence': 0,
+            'max_responses': max_responses,
+            'timestamp': time.time(),
+            'cursors': {}  # client ID -> sequence number of the last response it retrieved
+        }
+        self._response_lock = Lock()
+        self._dedup = DedupIndex(dedup_ttl, dedup_max_entries)
+
+    def _record(self, record, wait=False):
+        """Append a state change to the journal, if enabled"""
+        if self.journal is not None:
+            self.journal.append(record, wait)
+
+    def start(self):
+        """Replay the journal, if any, and return what was restored"""
+        if self.journal is None:
+            return None
+        items, responses = self.journal.replay()
+        for record in responses:
+            self._buffer_response(record['id'], record['response'], record['timestamp'])
+        leased = 0
+        for entry in items:
+            # The journal keeps its own copy of each item
+            item = dict(entry['item'])
+            self._dedup.add(item['message'])
+            lease = entry['lease']
+            if lease is None:
+                self._enqueue(item)
+                continue
+            # The worker may still post its answer under this lease. If it does
+            # not come back, the reaper redelivers the message as usual.
+            self._inflight[item['id']] = {
+                'item': item,
+                'lease_id': lease['lease_id'],
+                'worker': lease['worker'],
+                'leased_at': lease['leased_at'],
+                'expires': lease['expires']
+            }
+            leased += 1
+        self.journal.start()
+        return {'queued': len(items) - leased, 'leased': leased, 'responses': len(responses)}
+
+    # Queue and leases
+
+    def _enqueue(self, item):
+        self._queued[item['id']] = item
+        if item.get('affinity'):
+            with self._pin_lock:
+                self._pinned.setdefault(item['affinity'], deque()).append(item)
+        else:
+            self._queue.put(item)
+
+    def _next_item(self, worker_id):
+        """The next item for worker_id: those pinned to it first, then the fair queue. Raises Empty."""
+        with self._pin_lock:
+            pinned = self._pinned.get(worker_id)
+            if pinned:
+                item = pinned.popleft()
+                if not pinned:
+                    del self._pinned[worker_id]
+                return item
+        return self._queue.get_nowait()
+
+    def _withdraw(self, item):
+        """Take a cancelled item out of the pinned or fair queue, unless a worker just took it"""
+        with self._pin_lock:
+            for worker_id, pinned in self._pinned.items():
+                for index, other in enumerate(pinned):
+                    if other is item:
+                        del pinned[index]
+                        if not pinned:
+                            del self._pinned[worker_id]
+                        return
+        self._queue.remove(item)
+
+    def push(self, item):
+        """Queue a new item"""
+        self.push_many([item])
+
+    def push_many(self, items):
+        """Queue several new items with a single journal commit"""
+        # Durable before visible. Commits are in order, so waiting for the last
+        # record covers the batch, and concurrent enqueues share one fsync.
+        for index, item in enumerate(items):
+            self._record({'op': 'enqueue', 'item': dict(item)}, wait=index == len(items) - 1)
+        for item in items:
+            self._enqueue(item)
+
+    def requeue(self, item):
+        """Put an item whose lease was taken back at the end of the queue"""
+        self._record({'op': 'requeue', 'id': item['id'], 'deliveries': item['deliveries']})
+        self._enqueue(item)
+
+    def pinned_workers(self):
+        """Workers that queued items are waiting for"""
+        with self._pin_lock:
+            return list(self._pinned)
+
+    def unpin(self, worker_ids):
+        """Hand the items waiting for worker_ids to any worker; returns how many there were"""
+        with self._pin_lock:
+            items = [item for worker_id in worker_ids for item in self._pinned.pop(worker_id, ())]
+        for item in items:
+            item['affinity'] = None
+            self._queue.put(item)
+        return len(items)
+
+    def extend_deadline(self, request_id, deadline):
+        """Make a queued item wait at least until deadline (None: indefinitely)"""
+        item = self._queued.get(request_id)
+        if item is None or item.get('deadline') is None:
+            return
+        item['deadline'] = later_deadline(item['deadline'], deadline)
+        self._record({'op': 'deadline', 'id': request_id, 'deadline': item['deadline']})
+
+    def lease_next(self, worker_id, lease_timeout, limit=1):
+        """Lease up to limit unanswered items to worker_id, in dispatch order.
+
+        Returns (leases, expired): leases is empty if the queue is empty, and
+        expired lists the IDs of items dropped on the way because their
+        deadline had passed.
+        """
+        leases = []
+        expired = []
+        now = time.time()
+        while len(leases) < limit:
+            try:
+                item = self._next_item(worker_id)
+            except Empty:
+                break
+            # A redelivered message may have been answered late by its previous worker
+            if self.is_answered(item['id']):
+                self._queued.pop(item['id'], None)
+                continue
+            if is_expired(item, now):
+                self._queued.pop(item['id'], None)
+                self._dedup.discard(item['message'])
+                with self._lease_lock:
+                    self._given_up[item['id']] = ('expired', EXPIRED_REASON, now)
+                self._record({'op': 'drop', 'id': item['id']})
+                expired.append(item['id'])
+                continue
+            with self._lease_lock:
+                # Whoever takes it out of _queued first, cancel() or this, owns the item
+                if self._queued.pop(item['id'], None) is None:
+                    continue
+                lease = new_lease(item, worker_id, lease_timeout)
+                self._inflight[item['id']] = lease
+            self._record({
+                'op': 'lease',
+                'id': item['id'],
+                'lease_id': lease['lease_id'],
+                'worker': worker_id,
+                'leased_at': lease['leased_at'],
+                'expires': lease['expires'],
+                'delivery': item['deliveries']
+            })
+            leases.append(lease)
+        if leases:
+            self._last_dispatch = now
+        return leases, expired
+
+    def acknowledge(self, request_id, lease_id=None, worker_id=None):
+        """End the lease for request_id, if lease_id (else worker_id) matches, and return it"""
+        with self._lease_lock:
+            lease = self._inflight.get(request_id)
+            if lease is None or not lease_matches(lease, lease_id, worker_id):
+                return None
+            del self._inflight[request_id]
+        self._record({'op': 'ack', 'id': request_id})
+        return lease
+
+    def renew_lease(self, request_id, expires):
+        with self._lease_lock:
+            lease = self._inflight.get(request_id)
+            if lease is None:
+                return False
+            lease['expires'] = expires
+            return True
+
+    def expire_lease(self, request_id, lease_id=None):
+        with self._lease_lock:
+            lease = self._inflight.get(request_id)
+            if lease is None or (lease_id and lease['lease_id'] != lease_id):
+                return False
+            lease['expires'] = 0
+            return True
+
+    def take_expired_leases(self, now, gone_workers=()):
+        """Remove and return leases that expired or whose worker is in gone_workers"""
+        with self._lease_lock:
+            expired = [
+                request_id for request_id, lease in self._inflight.items()
+                if lease['expires'] <= now or lease['worker'] in gone_workers
+            ]
+            return [self._inflight.pop(request_id) for request_id in expired]
+
+    def fail(self, item, reason):
+        """Record that a taken-back item is given up on rather than requeued"""
+        self._dedup.discard(item['message'])
+        with self._lease_lock:
+            self._given_up[item['id']] = ('failed', reason, time.time())
+        self._record({'op': 'drop', 'id': item['id']})
+
+    def cancel(self, request_id, reason):
+        """Withdraw request_id: drop it if queued, and end its lease if leased.
+
+        Returns (state, lease): state is 'queued', 'leased', or None when the
+        request is neither (unknown, answered or already cancelled); lease is
+        the ended lease, if any. Remembered for response_ttl, for is_cancelled.
+        The message is forgotten by the dedup index, so it can be sent again.
+        """
+        with self._lease_lock:
+            item = self._queued.pop(request_id, None)
+            lease = self._inflight.pop(request_id, None) if item is None else None
+            if item is None and lease is None:
+                return None, None
+            self._given_up[request_id] = ('cancelled', reason, time.time())
+        if item is not None:
+            self._withdraw(item)
+        self._dedup.discard((item or lease['item'])['message'])
+        self._record({'op': 'drop', 'id': request_id})
+        return ('queued', None) if item is not None else ('leased', lease)
+
+    def is_cancelled(self, request_id):
+        return (self.failure(request_id) or ('',))[0] == 'cancelled'
+
+    def failure(self, request_id):
+        """(status, reason) of a request given up on within response_ttl, or None.
+
+        status is 'failed' (out of deliveries), 'expired' (deadline passed
+        while queued) or 'cancelled'.
+        """
+        with self._lease_lock:
+            entry = self._given_up.get(request_id)
+        return entry[:2] if entry is not None else None
+
+    def queue_depth(self):
+        with self._pin_lock:
+            pinned = sum(len(items) for items in self._pinned.values())
+        return self._queue.qsize() + pinned
+
+    def last_dispatch(self):
+        """When a message was last leased to a worker (epoch seconds), or None"""
+        return self._last_dispatch
+
+    def inflight_count(self):
+        with self._lease_lock:
+            return len(self._inflight)
+
+    def held_by(self, worker_id):
+        """How many leases worker_id holds"""
+        with self._lease_lock:
+            return sum(1 for lease in self._inflight.values() if lease['worker'] == worker_id)
+
+    # Responses
+
+    def add_response(self, request_id, text):
+        """Buffer an answer under its request ID, evicting the oldest beyond max_responses"""
+        return self.add_responses([(request_id, text)])[0]
+
+    def add_responses(self, answers):
+        """Buffer several (request ID, text) answers with a single journal commit.
+
+        Returns their sequence numbers.
+        """
+        current_time = time.time()
+        sequences = [self._buffer_response(request_id, text, current_time) for request_id, text in answers]
+        for index, (request_id, text) in enumerate(answers):
+            self._record({'op': 'response', 'id': request_id, 'response': text, 'timestamp': current_time},
+                         wait=index == len(answers) - 1)
+        return sequences
+
+    def _buffer_response(self, request_id, text, current_time):
+        storage = self._storage
+        with self._response_lock:
+            sequence = storage['next_sequence']
+            storage['next_sequence'] = sequence + 1
+            storage['responses'][sequence] = {
+                'id': request_id,
+                'response': text,
+                'timestamp': current_time
+            }
+            storage['by_id'][request_id] = sequence
+            storage['timestamp'] = current_time
+
+            # Keep only the last N responses
+            while len(storage['responses']) > storage['max_responses']:
+                self._evict_oldest_response()
+        return sequence
+
+    def _evict_oldest_response(self):
+        """Drop the oldest buffered response. Caller must hold _response_lock."""
+        storage = self._storage
+        oldest = storage['next_sequence'] - len(storage['responses'])
+        evicted = storage['responses'].pop(oldest)
+        # A re-posted answer for the same ID may have superseded this entry
+        if storage['by_id'].get(evicted['id']) == oldest:
+            del storage['by_id'][evicted['id']]
+
+    def get_response(self, request_id):
+        """Return (sequence, response) for request_id, or (None, None)"""
+        with self._response_lock:
+            sequence = self._storage['by_id'].get(request_id)
+            if sequence is None:
+                return None, None
+            return sequence, self._storage['responses'][sequence]
+
+    def next_response(self, client_id):
+        """Advance client_id's cursor to the oldest response it has not seen yet.
+
+        Returns (sequence, response, buffered, last_retrieved); sequence and
+        response are None when the client is caught up.
+        """
+        storage = self._storage
+        with self._response_lock:
+            buffered = len(storage['responses'])
+            oldest = storage['next_sequence'] - buffered
+            last_retrieved = storage['cursors'].get(client_id, -1)
+            # Responses evicted before this client asked for them are skipped
+            sequence = max(last_retrieved + 1, oldest)
+            response = storage['responses'].get(sequence)
+            if response is None:
+                return None, None, buffered, last_retrieved
+            storage['cursors'][client_id] = sequence
+            return sequence, response, buffered, sequence
+
+    def is_answered(self, request_id):
+        with self._response_lock:
+            return request_id in self._storage['by_id']
+
+    def expire_responses(self):
+        """Drop buffered responses older than response_ttl, returning how many"""
+        storage = self._storage
+        cutoff = time.time() - self.response_ttl
+        removed = 0
+        with self._response_lock:
+            responses = storage['responses']
+            # Sequence order is storage order, so expired responses are at the front
+            while responses:
+                oldest = storage['next_sequence'] - len(responses)
+                if responses[oldest]['timestamp'] > cutoff:
+                    break
+                self._evict_oldest_response()
+                removed += 1
+            # A cursor behind the oldest buffered response behaves exactly like a new client's
+            oldest = storage['next_sequence'] - len(responses)
+            stale = [client for client, seq in storage['cursors'].items() if seq < oldest]
+            for client in stale:
+                del storage['cursors'][client]
+        return removed
+
+    # Dedup
+
+    def check_and_add(self, message):
+        """Record a message as processed, returning True if it already was"""
+        return self._dedup.check_and_add(message)
+
+    def mark_processed(self, message):
+        self._dedup.add(message)
+
+    # Updates for callers waiting in other processes; there are none here
+
+    def put_partial(self, request_id, text):
+        pass
+
+    def poll(self, request_ids):
+        return {}, {}, {}
+
+    # Timelines
+
+    def record_events(self, events):
+        """Record (request ID, stage, time, attrs) lifecycle events"""
+        self._timelines.add(events)
+
+    def record_once(self, request_id, stage, at, attrs=None):
+        """Record an event unless the request already has one for stage; returns whether it did"""
+        return self._timelines.add_once(request_id, stage, at, attrs)
+
+    def timeline(self, request_id):
+        """Events of request_id as {'stage', 'at', ...attrs} dicts, oldest first"""
+        return self._timelines.get(request_id)
+
+    def sweep(self):
+        """Expire dedup entries, buffered responses, old timelines and failures"""
+        cutoff = time.time() - self.response_ttl
+        with self._lease_lock:
+            while self._given_up and next(iter(self._given_up.values()))[2] <= cutoff:
+                self._given_up.popitem(last=False)
+        self._dedup.sweep()
+        self.expire_responses()
+        self._queue.prune()
+        self._timelines.sweep()
+
+    def stats(self):
+        storage = self._storage
+        with self._response_lock:
+            responses = storage['responses']
+            oldest = storage['next_sequence'] - len(responses)
+            response_stats = {
+                'buffered': len(responses),
+                'max_responses': storage['max_responses'],
+                'expiration_time': self.response_ttl,
+                'oldest_age': time.time() - responses[oldest]['timestamp'] if responses else None,
+                'client_cursors': len(storage['cursors'])
+            }
+        with self._pin_lock:
+            pinned = sum(len(items) for items in self._pinned.values())
+        return {
+            'backend': 'memory',
+            'queue': {'depth': self.queue_depth(), 'inflight': self.inflight_count(), 'pinned': pinned},
+            'lanes': self._queue.stats(),
+            'dedup': self._dedup.stats(),
+            'responses': response_stats,
+            'journal': self.journal.stats() if self.journal is not None else None
+        }
+
+
+class SQLiteStore:
+    """State in a SQLite file shared by every server process that opens it.
+
+    Each thread uses its own connection. Read-then-write operations run in
+    BEGIN IMMEDIATE transactions, so two processes never lease the same
+    message. Dedup hit counters are per process.
+    """
+
+    shared = True
+
+    SCHEMA = (
+        # Queued items have no lease_id; leased ones carry their lease
+        'CREATE TABLE IF NOT EXISTS messages ('
+        ' seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, item TEXT NOT NULL,'
+        ' lease_id TEXT, worker TEXT, leased_at REAL, expires REAL)',
+        'CREATE INDEX IF NOT EXISTS messages_queued ON messages (seq) WHERE lease_id IS NULL',
+        # Fair queuing state per lane (virtual time) and per flow (finish tag of its last item)
+        'CREATE TABLE IF NOT EXISTS lanes (lane TEXT PRIMARY KEY, vtime REAL NOT NULL, dispatched REAL)',
+        'CREATE TABLE IF NOT EXISTS flows (lane TEXT NOT NULL, flow TEXT NOT NULL, finish REAL NOT NULL,'
+        ' PRIMARY KEY (lane, flow))',
+        'CREATE INDEX IF NOT EXISTS messages_leased ON messages (expires) WHERE lease_id IS NOT NULL',
+        'CREATE TABLE IF NOT EXISTS responses ('
+        ' seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL, response TEXT NOT NULL,'
+        ' timestamp REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS responses_id ON responses (id)',
+        'CREATE TABLE IF NOT EXISTS cursors (client TEXT PRIMARY KEY, seq INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS dedup (fingerprint BLOB PRIMARY KEY, added REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS dedup_added ON dedup (added)',
+        'CREATE TABLE IF NOT EXISTS partials (id TEXT PRIMARY KEY, text TEXT NOT NULL, updated REAL NOT NULL)',
+        # Requests given up on; status is 'failed', 'expired' or 'cancelled'
+        'CREATE TABLE IF NOT EXISTS failures (id TEXT PRIMARY KEY, reason TEXT NOT NULL, failed REAL NOT NULL,'
+        ' status TEXT)',
+        'CREATE TABLE IF NOT EXISTS cancelled (id TEXT PRIMARY KEY, cancelled REAL NOT NULL)',
+        # Lifecycle events per request, for /api/v1/requests/<id>/timeline
+        'CREATE TABLE IF NOT EXISTS events (id TEXT NOT NULL, stage TEXT NOT NULL, at REAL NOT NULL, attrs TEXT)',
+        'CREATE INDEX IF NOT EXISTS events_id ON events (id, stage)',
+        'CREATE INDEX IF NOT EXISTS events_at ON events (at)'
+    )
+    # Scheduling columns, added to files created before priority lanes existed
+    MESSAGE_COLUMNS = (('lane', 'TEXT'), ('flow', 'TEXT'), ('rank', 'INTEGER'), ('start', 'REAL'),
+                       ('finish', 'REAL'), ('enqueued_at', 'REAL'), ('affinity', 'TEXT'))
+    # SQLite's default limit on bound parameters is 999
+    POLL_CHUNK = 500
+
+    def __init__(self, path, max_responses, response_ttl, dedup_ttl, dedup_max_entries, lanes,
+                 timeline_ttl=3600):
+        self.path = path
+        self.timeline_ttl = timeline_ttl
+        self.lanes = lanes
+        self.waits = WaitStats(lanes.lanes)
+        self.max_responses = max_responses
+        self.response_ttl = response_ttl
+        self.dedup_ttl = dedup_ttl
+        self.dedup_max_entries = dedup_max_entries
+        self._local = local()
+        self._counter_lock = Lock()
+        self.dedup_hits = 0
+        self.dedup_misses = 0
+        with self._transaction() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            columns = {row[1] for row in db.execute('PRAGMA table_info(messages)')}
+            for column, kind in self.MESSAGE_COLUMNS:
+                if column not in columns:
+                    db.execute(f'ALTER TABLE messages ADD COLUMN {column} {kind}')
+            db.execute('CREATE INDEX IF NOT EXISTS messages_fair ON messages (rank, finish, seq) '
+                       'WHERE lease_id IS NULL')
+            db.execute('CREATE INDEX IF NOT EXISTS messages_pinned ON messages (affinity, seq) '
+                       'WHERE lease_id IS NULL AND affinity IS NOT NULL')
+            if 'dispatched' not in {row[1] for row in db.execute('PRAGMA table_info(lanes)')}:
+                db.execute('ALTER TABLE lanes ADD COLUMN dispatched REAL')
+            if 'status' not in {row[1] for row in db.execute('PRAGMA table_info(failures)')}:
+                db.execute('ALTER TABLE failures ADD COLUMN status TEXT')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Autocommit; multi-statement operations open their own transaction
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _lease_from_row(row):
+        item, lease_id, worker, leased_at, expires = row
+        return {
+            'item': json.loads(item),
+            'lease_id': lease_id,
+            'worker': worker,
+            'leased_at': leased_at,
+            'expires': expires
+        }
+
+    def start(self):
+        """Report the state left in the file by earlier runs"""
+        return {'queued': self.queue_depth(), 'leased': self.inflight_count(),
+                'responses': self._db().execute('SELECT COUNT(*) FROM responses').fetchone()[0]}
+
+    # Queue and leases
+
+    def _insert(self, db, item):
+        """Stamp item with its fair queuing tags and queue it. Caller must hold a transaction."""
+        lane = self.lanes.lane_for(item.get('lane'))
+        flow = item.get('flow') or ANONYMOUS_FLOW
+        vtime = db.execute('SELECT vtime FROM lanes WHERE lane = ?', (lane,)).fetchone()
+        last = db.execute('SELECT finish FROM flows WHERE lane = ? AND flow = ?', (lane, flow)).fetchone()
+        start, finish = self.lanes.stamp(vtime[0] if vtime else 0.0, last[0] if last else None, flow)
+        db.execute('INSERT OR REPLACE INTO flows (lane, flow, finish) VALUES (?, ?, ?)', (lane, flow, finish))
+        db.execute(
+            'INSERT OR REPLACE INTO messages (id, item, lane, flow, rank, start, finish, enqueued_at, affinity) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (item['id'], json.dumps(item), lane, flow, self.lanes.rank(lane), start, finish,
+             item.get('enqueued_at'), item.get('affinity')))
+
+    def push(self, item):
+        self.push_many([item])
+
+    def push_many(self, items):
+        with self._transaction() as db:
+            for item in items:
+                self._insert(db, item)
+
+    def requeue(self, item):
+        # The row was deleted when the lease was taken back
+        with self._transaction() as db:
+            self._insert(db, item)
+
+    def pinned_workers(self):
+        return [row[0] for row in self._db().execute(
+            'SELECT DISTINCT affinity FROM messages WHERE lease_id IS NULL AND affinity IS NOT NULL')]
+
+    def unpin(self, worker_ids):
+        worker_ids = list(worker_ids)
+        if not worker_ids:
+            return 0
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE messages SET affinity = NULL, item = json_set(item, '$.affinity', NULL) "
+                f"WHERE lease_id IS NULL AND affinity IN ({','.join('?' * len(worker_ids))})",
+                worker_ids).rowcount
+
+    def extend_deadline(self, request_id, deadline):
+        with self._transaction() as db:
+            row = db.execute('SELECT item FROM messages WHERE id = ? AND lease_id IS NULL', (request_id,)).fetchone()
+            if row is None:
+                return
+            item = json.loads(row[0])
+            if item.get('deadline') is None:
+                return
+            item['deadline'] = later_deadline(item['deadline'], deadline)
+            db.execute('UPDATE messages SET item = ? WHERE id = ?', (json.dumps(item), request_id))
+
+    def lease_next(self, worker_id, lease_timeout, limit=1):
+        leases = []
+        expired = []
+        db = self._db()
+        # Cheap check first, so idle long-polls don't take the write lock
+        if db.execute('SELECT 1 FROM messages WHERE lease_id IS NULL LIMIT 1').fetchone() is None:
+            return leases, expired
+        now = time.time()
+        with self._transaction() as db:
+            while len(leases) < limit:
+                # Items pinned to this worker first, then the fair queue
+                row = db.execute(
+                    'SELECT seq, item, lane, start FROM messages WHERE lease_id IS NULL AND affinity = ? '
+                    'ORDER BY seq LIMIT 1', (worker_id,)).fetchone() if worker_id else None
+                if row is None:
+                    row = db.execute(
+                        'SELECT seq, item, lane, start FROM messages WHERE lease_id IS NULL AND affinity IS NULL '
+                        'ORDER BY rank, finish, seq LIMIT 1').fetchone()
+                if row is None:
+                    break
+                seq, item = row[0], json.loads(row[1])
+                lane = self.lanes.lane_for(row[2])
+                db.execute(
+                    'INSERT INTO lanes (lane, vtime) VALUES (?, ?) '
+                    'ON CONFLICT (lane) DO UPDATE SET vtime = MAX(vtime, excluded.vtime)', (lane, row[3] or 0.0))
+                # A redelivered message may have been answered late by its previous worker
+                if db.execute('SELECT 1 FROM responses WHERE id = ?', (item['id'],)).fetchone():
+                    db.execute('DELETE FROM messages WHERE seq = ?', (seq,))
+                    continue
+                if is_expired(item, now):
+                    db.execute('DELETE FROM messages WHERE seq = ?', (seq,))
+                    db.execute('DELETE FROM dedup WHERE fingerprint = ?', (DedupIndex.fingerprint(item['message']),))
+                    db.execute('INSERT OR REPLACE INTO failures (id, reason, failed, status) '
+                               "VALUES (?, ?, ?, 'expired')", (item['id'], EXPIRED_REASON, now))
+                    expired.append(item['id'])
+                    continue
+                lease = new_lease(item, worker_id, lease_timeout)
+                db.execute(
+                    'UPDATE messages SET item = ?, lease_id = ?, worker = ?, leased_at = ?, expires = ? '
+                    'WHERE seq = ?',
+                    (json.dumps(item), lease['lease_id'], worker_id, lease['leased_at'], lease['expires'], seq))
+                db.execute('UPDATE lanes SET dispatched = ? WHERE lane = ?', (now, lane))
+                self.waits.record(lane, item, now)
+                leases.append(lease)
+        return leases, expired
+
+    def acknowledge(self, request_id, lease_id=None, worker_id=None):
+        with self._transaction() as db:
+            row = db.execute(
+                'SELECT item, lease_id, worker, leased_at, expires FROM messages '
+                'WHERE id = ? AND lease_id IS NOT NULL', (request_id,)).fetchone()
+            if row is None:
+                return None
+            lease = self._lease_from_row(row)
+            if not lease_matches(lease, lease_id, worker_id):
+                return None
+            db.execute('DELETE FROM messages WHERE id = ?', (request_id,))
+        return lease
+
+    def renew_lease(self, request_id, expires):
+        cursor = self._db().execute(
+            'UPDATE messages SET expires = ? WHERE id = ? AND lease_id IS NOT NULL', (expires, request_id))
+        return cursor.rowcount > 0
+
+    def expire_lease(self, request_id, lease_id=None):
+        if lease_id:
+            cursor = self._db().execute(
+                'UPDATE messages SET expires = 0 WHERE id = ? AND lease_id = ?', (request_id, lease_id))
+        else:
+            cursor = self._db().execute(
+                'UPDATE messages SET expires = 0 WHERE id = ? AND lease_id IS NOT NULL', (request_id,))
+        return cursor.rowcount > 0
+
+    def take_expired_leases(self, now, gone_workers=()):
+        gone_workers = list(gone_workers)
+        condition = 'expires <= ?'
+        if gone_workers:
+            condition += f" OR worker IN ({','.join('?' * len(gone_workers))})"
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT id, item, lease_id, worker, leased_at, expires FROM messages '
+                f'WHERE lease_id IS NOT NULL AND ({condition})', [now] + gone_workers).fetchall()
+            db.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+        return [self._lease_from_row(row[1:]) for row in rows]
+
+    def fail(self, item, reason):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO failures (id, reason, failed, status) VALUES (?, ?, ?, 'failed')",
+                       (item['id'], reason, time.time()))
+            db.execute('DELETE FROM dedup WHERE fingerprint = ?', (DedupIndex.fingerprint(item['message']),))
+
+    def cancel(self, request_id, reason):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT item, lease_id, worker, leased_at, expires, lane, flow, start, finish '
+                             'FROM messages WHERE id = ?', (request_id,)).fetchone()
+            if row is None:
+                return None, None
+            db.execute('DELETE FROM messages WHERE id = ?', (request_id,))
+            if row[1] is None and row[8] is not None:
+                self._close_gap(db, *row[5:])
+            db.execute('DELETE FROM dedup WHERE fingerprint = ?',
+                       (DedupIndex.fingerprint(json.loads(row[0])['message']),))
+            db.execute('INSERT OR REPLACE INTO cancelled (id, cancelled) VALUES (?, ?)', (request_id, now))
+            # Callers waiting in other processes are failed by their poll()
+            db.execute("INSERT OR REPLACE INTO failures (id, reason, failed, status) VALUES (?, ?, ?, 'cancelled')",
+                       (request_id, reason, now))
+        if row[1] is None:
+            return 'queued', None
+        return 'leased', self._lease_from_row(row[:5])
+
+    @staticmethod
+    def _close_gap(db, lane, flow, start, finish):
+        """Move a flow's later items up into the slot of its withdrawn item. Caller must hold a transaction."""
+        followers = db.execute(
+            'SELECT seq, start, finish FROM messages WHERE lease_id IS NULL AND lane = ? AND flow = ? AND finish > ? '
+            'ORDER BY finish', (lane, flow, finish)).fetchall()
+        moved = close_gap(start, finish, [(row[1], row[2]) for row in followers])
+        db.executemany('UPDATE messages SET start = ?, finish = ? WHERE seq = ?',
+                       [(new_start, new_finish, row[0]) for row, (new_start, new_finish) in zip(followers, moved)])
+        # The flow's next item is stamped behind its last queued one
+        if len(moved) == len(followers):
+            db.execute('UPDATE flows SET finish = ? WHERE lane = ? AND flow = ? AND finish = ?',
+                       (moved[-1][1] if moved else start, lane, flow, followers[-1][2] if followers else finish))
+
+    def is_cancelled(self, request_id):
+        return self._db().execute('SELECT 1 FROM cancelled WHERE id = ?', (request_id,)).fetchone() is not None
+
+    def failure(self, request_id):
+        row = self._db().execute(
+            'SELECT status, reason, EXISTS (SELECT 1 FROM cancelled WHERE cancelled.id = failures.id) '
+            'FROM failures WHERE id = ?', (request_id,)).fetchone()
+        if row is None:
+            return None
+        # Rows written before statuses were recorded are failed deliveries or cancellations
+        return row[0] or ('cancelled' if row[2] else 'failed'), row[1]
+
+    def queue_depth(self):
+        return self._db().execute('SELECT COUNT(*) FROM messages WHERE lease_id IS NULL').fetchone()[0]
+
+    def inflight_count(self):
+        return self._db().execute('SELECT COUNT(*) FROM messages WHERE lease_id IS NOT NULL').fetchone()[0]
+
+    def held_by(self, worker_id):
+        return self._db().execute(
+            'SELECT COUNT(*) FROM messages WHERE lease_id IS NOT NULL AND worker = ?', (worker_id,)).fetchone()[0]
+
+    def last_dispatch(self):
+        return self._db().execute('SELECT MAX(dispatched) FROM lanes').fetchone()[0]
+
+    # Responses
+
+    def add_response(self, request_id, text):
+        return self.add_responses([(request_id, text)])[0]
+
+    def add_responses(self, answers):
+        now = time.time()
+        sequences = []
+        with self._transaction() as db:
+            for request_id, text in answers:
+                sequences.append(db.execute('INSERT INTO responses (id, response, timestamp) VALUES (?, ?, ?)',
+                                            (request_id, text, now)).lastrowid)
+                db.execute('DELETE FROM partials WHERE id = ?', (request_id,))
+            # Keep only the last N responses
+            if sequences:
+                db.execute('DELETE FROM responses WHERE seq <= ?', (sequences[-1] - self.max_responses,))
+        return sequences
+
+    def get_response(self, request_id):
+        row = self._db().execute(
+            'SELECT seq, response, timestamp FROM responses WHERE id = ? ORDER BY seq DESC LIMIT 1',
+            (request_id,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], {'id': request_id, 'response': row[1], 'timestamp': row[2]}
+
+    def next_response(self, client_id):
+        with self._transaction() as db:
+            buffered = db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            cursor = db.execute('SELECT seq FROM cursors WHERE client = ?', (client_id,)).fetchone()
+            last_retrieved = cursor[0] if cursor is not None else -1
+            row = db.execute(
+                'SELECT seq, id, response, timestamp FROM responses WHERE seq > ? ORDER BY seq LIMIT 1',
+                (last_retrieved,)).fetchone()
+            if row is None:
+                return None, None, buffered, last_retrieved
+            db.execute('INSERT OR REPLACE INTO cursors (client, seq) VALUES (?, ?)', (client_id, row[0]))
+        return row[0], {'id': row[1], 'response': row[2], 'timestamp': row[3]}, buffered, row[0]
+
+    def is_answered(self, request_id):
+        return self._db().execute('SELECT 1 FROM responses WHERE id = ? LIMIT 1', (request_id,)).fetchone() is not None
+
+    def expire_responses(self):
+        cutoff = time.time() - self.response_ttl
+        with self._transaction() as db:
+            removed = db.execute('DELETE FROM responses WHERE timestamp <= ?', (cutoff,)).rowcount
+            # A cursor behind the oldest buffered response behaves exactly like a new client's
+            db.execute('DELETE FROM cursors WHERE seq < COALESCE((SELECT MIN(seq) FROM responses), seq + 1)')
+            db.execute('DELETE FROM partials WHERE updated <= ?', (cutoff,))
+            db.execute('DELETE FROM failures WHERE failed <= ?', (cutoff,))
+            db.execute('DELETE FROM cancelled WHERE cancelled <= ?', (cutoff,))
+        return removed
+
+    # Dedup
+
+    def check_and_add(self, message):
+        key = DedupIndex.fingerprint(message)
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT added FROM dedup WHERE fingerprint = ?', (key,)).fetchone()
+            seen = row is not None and now - row[0] < self.dedup_ttl
+            if not seen:
+                db.execute('INSERT OR REPLACE INTO dedup (fingerprint, added) VALUES (?, ?)', (key, now))
+        with self._counter_lock:
+            if seen:
+                self.dedup_hits += 1
+            else:
+                self.dedup_misses += 1
+        return seen
+
+    def mark_processed(self, message):
+        self._db().execute('INSERT OR REPLACE INTO dedup (fingerprint, added) VALUES (?, ?)',
+                           (DedupIndex.fingerprint(message), time.time()))
+
+    # Updates for callers waiting in other processes
+
+    def put_partial(self, request_id, text):
+        self._db().execute('INSERT OR REPLACE INTO partials (id, text, updated) VALUES (?, ?, ?)',
+                           (request_id, text, time.time()))
+
+    def poll(self, request_ids):
+        """Return (answers, partials, failures) for request_ids, each a dict keyed by request ID"""
+        answers, partials, failures = {}, {}, {}
+        db = self._db()
+        for start in range(0, len(request_ids), self.POLL_CHUNK):
+            chunk = request_ids[start:start + self.POLL_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            answers.update(db.execute(
+                f'SELECT id, response FROM responses WHERE id IN ({placeholders}) ORDER BY seq', chunk))
+            partials.update(db.execute(f'SELECT id, text FROM partials WHERE id IN ({placeholders})', chunk))
+            failures.update(db.execute(f'SELECT id, reason FROM failures WHERE id IN ({placeholders})', chunk))
+        return answers, partials, failures
+
+    def record_events(self, events):
+        with self._transaction() as db:
+            db.executemany('INSERT INTO events (id, stage, at, attrs) VALUES (?, ?, ?, ?)',
+                           [(request_id, stage, at, json.dumps(attrs) if attrs else None)
+                            for request_id, stage, at, attrs in events])
+
+    def record_once(self, request_id, stage, at, attrs=None):
+        cursor = self._db().execute(
+            'INSERT INTO events (id, stage, at, attrs) SELECT ?, ?, ?, ? '
+            'WHERE NOT EXISTS (SELECT 1 FROM events WHERE id = ? AND stage = ?)',
+            (request_id, stage, at, json.dumps(attrs) if attrs else None, request_id, stage))
+        return cursor.rowcount > 0
+
+    def timeline(self, request_id):
+        rows = self._db().execute('SELECT stage, at, attrs FROM events WHERE id = ? ORDER BY at, rowid',
+                                  (request_id,)).fetchall()
+        return [dict(json.loads(attrs) if attrs else {}, stage=stage, at=at) for stage, at, attrs in rows]
+
+    def sweep(self):
+        """Expire dedup entries, buffered responses and old events, and trim the dedup table to size"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM events WHERE at <= ?', (time.time() - self.timeline_ttl,))
+            db.execute('DELETE FROM dedup WHERE added <= ?', (time.time() - self.dedup_ttl,))
+            db.execute(
+                'DELETE FROM dedup WHERE fingerprint IN (SELECT fingerprint FROM dedup '
+                'ORDER BY added DESC LIMIT -1 OFFSET ?)', (self.dedup_max_entries,))
+            # Flows behind virtual time would restart from it anyway
+            db.execute('DELETE FROM flows WHERE finish <= '
+                       'COALESCE((SELECT vtime FROM lanes WHERE lanes.lane = flows.lane), 0)')
+        self.expire_responses()
+
+    def lane_stats(self):
+        now = time.time()
+        db = self._db()
+        queued = {}
+        # Rows queued before lanes existed have no lane and count towards the default one
+        for lane, depth, oldest in db.execute(
+                'SELECT lane, COUNT(*), MIN(enqueued_at) FROM messages WHERE lease_id IS NULL GROUP BY lane'):
+            lane = self.lanes.lane_for(lane)
+            total, earliest = queued.get(lane, (0, None))
+            queued[lane] = (total + depth, min(filter(None, (earliest, oldest)), default=None))
+        flows = {lane: {} for lane in self.lanes.lanes}
+        for lane, flow, depth in db.execute(
+                'SELECT lane, flow, COUNT(*) AS depth FROM messages WHERE lease_id IS NULL '
+                'GROUP BY lane, flow ORDER BY depth DESC'):
+            lane_flows = flows[self.lanes.lane_for(lane)]
+            flow = flow or ANONYMOUS_FLOW
+            if flow in lane_flows or len(lane_flows) < STATS_TOP_FLOWS:
+                lane_flows[flow] = lane_flows.get(flow, 0) + depth
+        lanes = {}
+        for lane in self.lanes.lanes:
+            depth, oldest = queued.get(lane, (0, None))
+            lanes[lane] = dict(
+                self.waits.lane_stats(lane),
+                depth=depth,
+                oldest_age=now - oldest if oldest is not None else None,
+                flows=flows[lane])
+        return lanes
+
+    def stats(self):
+        db = self._db()
+        buffered, oldest = db.execute('SELECT COUNT(*), MIN(timestamp) FROM responses').fetchone()
+        with self._counter_lock:
+            hits, misses = self.dedup_hits, self.dedup_misses
+        pinned = db.execute(
+            'SELECT COUNT(*) FROM messages WHERE lease_id IS NULL AND affinity IS NOT NULL').fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'queue': {'depth': self.queue_depth(), 'inflight': self.inflight_count(), 'pinned': pinned},
+            'lanes': self.lane_stats(),
+            'dedup': {
+                'entries': db.execute('SELECT COUNT(*) FROM dedup').fetchone()[0],
+                'max_entries': self.dedup_max_entries,
+                'ttl': self.dedup_ttl,
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0
+            },
+            'responses': {
+                'buffered': buffered,
+                'max_responses': self.max_responses,
+                'expiration_time': self.response_ttl,
+                'oldest_age': time.time() - oldest if oldest is not None else None,
+                'client_cursors': db.execute('SELECT COUNT(*) FROM cursors').fetchone()[0]
+            }
+        }
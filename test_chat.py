@@ -7,19 +7,32 @@ import sys
 import itertools
 import readline
 import json
+import uuid
+import argparse
+from collections import Counter, deque
 from datetime import datetime
 from colorama import init, Fore, Style, Back
 
 # Initialize colorama for cross-platform color support
 init(autoreset=True)
 
+DEFAULT_URL = 'http://localhost:5001'
+# Longest single long-poll for batch answers (seconds)
+RESULT_POLL_WAIT = 30
+# Longest pause between retries of a failed batch answer poll (seconds)
+MAX_POLL_BACKOFF = 10
+
 class ChatAPI:
-    def __init__(self):
+    def __init__(self, api_url=DEFAULT_URL):
         load_dotenv()
-        self.api_url = 'http://localhost:5001'
+        self.api_url = api_url.rstrip('/')
+        # One keep-alive connection pool for every call instead of a new connection each time
+        self.session = requests.Session()
         self.headers = {
             'Content-Type': 'application/json',
-            'Accept': 'application/json'
+            'Accept': 'application/json',
+            # Gives this client its own cursor on /api/v1/response/latest
+            'X-Client-ID': str(uuid.uuid4())
         }
         self.running = True
         self.history = []
@@ -87,18 +100,19 @@ class ChatAPI:
             pass
 
     def send_message(self, message):
-        """Send a message through the local API server without limitations."""
+        """Send a message through the local API server and return its request ID."""
         try:
             # Add to history before sending
             self.history.append({'role': 'user', 'content': message, 'timestamp': datetime.now().isoformat()})
             
-            response = requests.post(
+            response = self.session.post(
                 f'{self.api_url}/api/v1/chat',
                 json={'message': message},
                 headers=self.headers
             )
             response.raise_for_status()
-            return True
+            # Older servers don't return an ID; fall back to the latest-response cursor
+            return response.json().get('id') or True
         except requests.exceptions.RequestException as e:
             print(f"\n{Fore.RED}Error sending message: {str(e)}{Style.RESET_ALL}")
             if e.response:
@@ -106,9 +120,21 @@ class ChatAPI:
                 print(f"{Fore.RED}Response content: {e.response.text}{Style.RESET_ALL}")
             return False
 
-    def get_response(self, timeout=300):
+    def cancel_request(self, request_id):
+        """Tell the server nobody will read the answer, so no worker spends time on it."""
+        try:
+            self.session.delete(f'{self.api_url}/api/v1/requests/{request_id}', headers=self.headers, timeout=10)
+        except requests.exceptions.RequestException:
+            # The server drops it once its lease or the response buffer expires anyway
+            pass
+
+    def get_response(self, request_id=None, timeout=300):
         """Wait for and retrieve the response from the chat with extended timeout and optimized polling."""
         start_time = time.time()
+        if isinstance(request_id, str):
+            response_url = f'{self.api_url}/api/v1/responses/{request_id}'
+        else:
+            response_url = f'{self.api_url}/api/v1/response/latest'
         # Begin with short polling intervals then gradually increase to reduce load
         polling_interval = 0.1  # Start with a very short interval
         max_interval = 1.0      # Maximum polling interval
@@ -121,10 +147,7 @@ class ChatAPI:
                 # Update spinner animation with color
                 print(f"\r{Fore.CYAN}{next(spinner)} Waiting for response... {Style.RESET_ALL}", end="", flush=True)
                 
-                response = requests.get(
-                    f'{self.api_url}/api/v1/response/latest',
-                    headers=self.headers
-                )
+                response = self.session.get(response_url, headers=self.headers)
                 if response.status_code == 200:
                     # Clear the spinner line
                     print("\r" + " " * 50 + "\r", end="", flush=True)
@@ -141,6 +164,11 @@ class ChatAPI:
                 elif response.status_code == 202:  # Accepted - server is still processing
                     # Continue polling silently - don't try to parse JSON
                     pass
+                elif response.status_code == 410:  # Gone - the request was cancelled, failed or expired
+                    print("\r" + " " * 50 + "\r", end="", flush=True)
+                    body = response.json()
+                    print(f"{Fore.YELLOW}{body.get('error') or 'The request was cancelled.'}{Style.RESET_ALL}")
+                    return None
                 elif response.status_code != 404:  # If it's an actual error, not just "no response yet"
                     # Only display actual errors, not status updates
                     if response.status_code >= 400:
@@ -165,8 +193,140 @@ class ChatAPI:
         # Clear the spinner line
         print("\r" + " " * 50 + "\r", end="", flush=True)
         print(f"{Fore.YELLOW}No response received within timeout.{Style.RESET_ALL}")
+        if isinstance(request_id, str):
+            self.cancel_request(request_id)
         return None
 
+    def submit_prompts(self, prompts):
+        """Queue prompts with one /api/v1/chat/batch call; returns (per-prompt results, Retry-After).
+
+        A full queue turns prompts away with status 'rejected' rather than failing the call.
+        """
+        response = self.session.post(f'{self.api_url}/api/v1/chat/batch', json={'messages': prompts},
+                                     headers=self.headers, timeout=30)
+        body = response.json() if response.content else {}
+        if response.status_code not in (200, 429) or 'data' not in body:
+            raise requests.exceptions.HTTPError(body.get('error') or f'HTTP {response.status_code}',
+                                                response=response)
+        return body['data'], float(response.headers.get('Retry-After', 1))
+
+    def poll_results(self, request_ids, wait):
+        """Answers that are ready for any of request_ids, long-polling up to wait seconds for the first"""
+        response = self.session.post(f'{self.api_url}/api/v1/responses/batch', json={
+            'ids': request_ids,
+            'wait': wait
+        }, headers=self.headers, timeout=RESULT_POLL_WAIT + 10)
+        response.raise_for_status()
+        return response.json()['data']
+
+    def run_batch(self, prompts, concurrency=8, timeout=300, output=sys.stdout):
+        """Answer many prompts without prompting, at most concurrency at a time.
+
+        Prompts are queued through /api/v1/chat/batch as room frees up, and
+        the answers to all of them are collected with one shared long-poll
+        of /api/v1/responses/batch, so a run holds a single connection
+        however many prompts are in flight. Each result is written to
+        output as a JSON line as soon as it is ready, with the prompt's
+        index in the input and its latency from submission to answer.
+        Prompts not answered within timeout are cancelled, and on Ctrl-C so
+        is every prompt still in flight. Returns the counts of results by status.
+        """
+        prompts = enumerate(prompts)
+        more = True
+        retries = deque()  # prompts the server turned away with a full queue, in order
+        pending = {}  # request ID -> results of the prompts waiting on it (identical prompts share one)
+        retry_at = 0
+        poll_failures = 0  # consecutive failed answer polls, for backoff
+        statuses = Counter()
+
+        def finish(result, status, **fields):
+            result.update(fields, status=status, latency=time.monotonic() - result.pop('started'))
+            statuses[status] += 1
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+
+        try:
+            while self.running:
+                now = time.monotonic()
+                room = concurrency - sum(len(results) for results in pending.values())
+                batch = []
+                if now >= retry_at:
+                    while retries and len(batch) < room:
+                        batch.append(retries.popleft())
+                    wanted = room - len(batch)
+                    for index, prompt in itertools.islice(prompts, wanted):
+                        batch.append({'index': index, 'prompt': prompt, 'started': now})
+                        wanted -= 1
+                    more = more and wanted == 0
+                if batch:
+                    try:
+                        entries, wait = self.submit_prompts([result['prompt'] for result in batch])
+                    except (requests.exceptions.RequestException, ValueError) as e:
+                        entries, wait = [{'status': 'error', 'error': str(e)}] * len(batch), 0
+                    for result, entry in zip(batch, entries):
+                        if entry['status'] == 'rejected':
+                            if now + wait < result['started'] + timeout:
+                                retries.append(result)
+                                retry_at = now + wait
+                            else:
+                                finish(result, 'timeout', error='Queue is full')
+                        elif 'id' in entry:
+                            result['id'] = entry['id']
+                            pending.setdefault(entry['id'], []).append(result)
+                        else:
+                            # 'invalid' entries carry their error; 'duplicate' ones were answered recently
+                            finish(result, 'error', error=entry.get('error', 'Message already processed'))
+                if not pending:
+                    if not retries and not more:
+                        break
+                    time.sleep(max(retry_at - time.monotonic(), 0))
+                    continue
+
+                # Wake up for the first answer, the next deadline or the next chance to queue more
+                now = time.monotonic()
+                deadline = min(result['started'] for results in pending.values() for result in results) + timeout
+                wait = min(RESULT_POLL_WAIT, deadline - now)
+                if retries:
+                    wait = min(wait, retry_at - now)
+                elif more and sum(len(results) for results in pending.values()) < concurrency:
+                    wait = 0
+                try:
+                    answers = self.poll_results(list(pending), max(wait, 0))
+                    poll_failures = 0
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    # The prompts are still queued or being answered; keep polling until they
+                    # time out, which cancels them, rather than leave them to the workers
+                    poll_failures += 1
+                    print(f"{Fore.YELLOW}Polling for answers failed ({e}), retrying{Style.RESET_ALL}", file=sys.stderr)
+                    time.sleep(max(min(2 ** (poll_failures - 1), MAX_POLL_BACKOFF, deadline - time.monotonic()), 0))
+                    answers = []
+                for answer in answers:
+                    for result in pending.pop(answer['id'], []):
+                        if answer['status'] == 'ready':
+                            finish(result, 'ok', response=answer['response'])
+                        else:
+                            finish(result, answer['status'], error=answer.get('error'))
+
+                now = time.monotonic()
+                for request_id, results in list(pending.items()):
+                    for result in [result for result in results if now >= result['started'] + timeout]:
+                        results.remove(result)
+                        finish(result, 'timeout')
+                    if not results:
+                        del pending[request_id]
+                        self.cancel_request(request_id)
+        except KeyboardInterrupt:
+            # Nobody will read the answers still coming; free the workers answering them
+            self.running = False
+            print(f"\n{Fore.YELLOW}Interrupted, cancelling prompts in flight...{Style.RESET_ALL}", file=sys.stderr)
+            for request_id, results in list(pending.items()):
+                self.cancel_request(request_id)
+                for result in results:
+                    finish(result, 'interrupted')
+            for result in retries:
+                finish(result, 'interrupted')
+        return statuses
+
     def interactive_chat(self):
         """Start an interactive chat session."""
         print(f"{Fore.GREEN}╔═════════════════════════════════════════════╗{Style.RESET_ALL}")
@@ -191,9 +351,10 @@ class ChatAPI:
                 # Skip the echo since the input line already shows what the user typed
                 # Send regular message
                 print(f"{Fore.YELLOW}Sending message...{Style.RESET_ALL}")
-                if self.send_message(message):
+                request_id = self.send_message(message)
+                if request_id:
                     # The get_response method now handles the spinner animation
-                    response = self.get_response()
+                    response = self.get_response(request_id)
                     if response:
                         print(f"{Fore.GREEN}AI:{Style.RESET_ALL} {response}\n")
                     # get_response handles printing the timeout message
@@ -268,9 +429,50 @@ class ChatAPI:
             print(f"\n{Fore.YELLOW}Unknown command: {command}{Style.RESET_ALL}")
             print(f"{Fore.YELLOW}Type /help to see available commands{Style.RESET_ALL}\n")
 
+def read_prompts(source):
+    """Prompts from a file, one per line, skipping blank lines."""
+    for line in source:
+        prompt = line.rstrip('\n')
+        if prompt.strip():
+            yield prompt
+
+def run_batch_mode(chat, args):
+    source = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    # Ctrl-C raises KeyboardInterrupt, so run_batch can cancel what is in flight instead of exiting
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    started = time.monotonic()
+    try:
+        statuses = chat.run_batch(read_prompts(source), args.concurrency, args.timeout, output)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.monotonic() - started
+    total = sum(statuses.values())
+    # The summary goes to stderr so stdout stays valid JSONL
+    print(f"{Fore.CYAN}{total} prompts in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f}/s): "
+          + ', '.join(f'{status}: {count}' for status, count in sorted(statuses.items()))
+          + Style.RESET_ALL, file=sys.stderr)
+
 def main():
-    chat = ChatAPI()
-    chat.interactive_chat()
+    parser = argparse.ArgumentParser(description='Chat with grok.example.com through the local API server')
+    parser.add_argument('--url', default=DEFAULT_URL, help=f'Server URL (default: {DEFAULT_URL})')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='Answer the prompts in FILE (one per line, - for stdin) and exit instead of chatting')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Batch prompts queued or being answered at once (default: 8)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='Seconds to wait for each batch answer before cancelling it (default: 300)')
+    parser.add_argument('--output', help='Write batch results as JSONL to this file (default: stdout)')
+    args = parser.parse_args()
+
+    chat = ChatAPI(args.url)
+    if args.batch:
+        run_batch_mode(chat, args)
+    else:
+        chat.interactive_chat()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
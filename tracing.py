@@ -0,0 +1,211 @@
+"""
+Request lifecycle traces in the OTLP/JSON format.
+
+Each request records timestamped stages in the store (received, enqueued,
+dequeued, worker_sent, response_stored, delivered, plus requeued, failed,
+expired and cancelled). Once it is delivered or given up on, its timeline is turned
+into spans: a server span for the whole request with children for the
+queue wait, each worker attempt, the generation in Grok and the wait for
+the client to fetch the answer. A W3C traceparent header on the incoming
+request makes the root span a child of the caller's span.
+
+SpanExporter appends ExportTraceServiceRequest documents to a JSONL file
+or POSTs them to an OTLP/HTTP collector (e.g. http://localhost:4318/v1/traces)
+from a background thread, so exporting never blocks a request.
+"""
+import json
+import os
+import re
+import time
+import urllib.request
+
+from background import BackgroundWriter
+
+SERVICE_NAME = 'grok-api'
+# Most traces sent in one export request
+EXPORT_BATCH = 100
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+# Stages that end a request's trace
+FINAL_STAGES = ('delivered', 'failed', 'expired', 'cancelled')
+
+
+def new_trace(headers):
+    """Trace context for an incoming request, continuing its traceparent header if valid"""
+    match = TRACEPARENT.match(headers.get('traceparent', '').strip().lower())
+    if match and match.group(1) != '0' * 32 and match.group(2) != '0' * 16:
+        trace_id, parent_span_id = match.group(1), match.group(2)
+    else:
+        trace_id, parent_span_id = os.urandom(16).hex(), None
+    return {
+        'trace_id': trace_id,
+        'parent_span_id': parent_span_id,
+        'span_id': os.urandom(8).hex(),
+        'received': time.time()
+    }
+
+
+def fork_trace(trace):
+    """Same trace and parent with a new root span, for each entry of a batch"""
+    return dict(trace, span_id=os.urandom(8).hex())
+
+
+def traceparent(trace):
+    """traceparent header value pointing at the request's root span"""
+    return f"00-{trace['trace_id']}-{trace['span_id']}-01"
+
+
+def trace_attrs(trace):
+    """The trace context as attributes of the 'received' event"""
+    attrs = {'trace_id': trace['trace_id'], 'span_id': trace['span_id']}
+    if trace['parent_span_id']:
+        attrs['parent_span_id'] = trace['parent_span_id']
+    return attrs
+
+
+def stage_durations(events):
+    """Seconds spent in each part of the pipeline, from a timeline"""
+    first = {}
+    last = {}
+    for event in events:
+        first.setdefault(event['stage'], event['at'])
+        last[event['stage']] = event['at']
+
+    def between(start, end, starts=first, ends=first):
+        if start in starts and end in ends:
+            return ends[end] - starts[start]
+        return None
+    return {
+        # Enqueue until a worker first polled the message
+        'queued': between('enqueued', 'dequeued'),
+        # Last delivery until the worker typed the prompt into Grok
+        'worker_pickup': between('dequeued', 'worker_sent', starts=last),
+        'generating': between('worker_sent', 'response_stored'),
+        'awaiting_fetch': between('response_stored', 'delivered'),
+        'total': between('received', 'delivered')
+    }
+
+
+def _attributes(values):
+    attributes = []
+    for key, value in values.items():
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': str(value)}
+        attributes.append({'key': key, 'value': typed})
+    return attributes
+
+
+def _span(trace_id, span_id, parent_span_id, name, kind, start, end, attributes=None, error=None):
+    span = {
+        'traceId': trace_id,
+        'spanId': span_id,
+        'name': name,
+        'kind': kind,
+        'startTimeUnixNano': str(int(start * 1e9)),
+        'endTimeUnixNano': str(int(max(end, start) * 1e9)),
+        'attributes': _attributes(attributes or {}),
+        'status': {'code': STATUS_ERROR, 'message': error} if error else {'code': STATUS_OK}
+    }
+    if parent_span_id:
+        span['parentSpanId'] = parent_span_id
+    return span
+
+
+def build_spans(request_id, events):
+    """OTLP span dicts for a finished request's timeline, or [] without a 'received' event"""
+    received = next((event for event in events if event['stage'] == 'received'), None)
+    if received is None:
+        return []
+    trace_id = received.get('trace_id') or os.urandom(16).hex()
+    root_id = received.get('span_id') or os.urandom(8).hex()
+    end_event = next((event for event in events if event['stage'] in FINAL_STAGES), events[-1])
+    error = end_event.get('reason') if end_event['stage'] != 'delivered' else None
+
+    def child(name, start, end, attributes=None, child_error=None):
+        return _span(trace_id, os.urandom(8).hex(), root_id, name, SPAN_KIND_INTERNAL,
+                     start['at'], end['at'], dict(attributes or {}, **{'request.id': request_id}), child_error)
+
+    spans = [_span(trace_id, root_id, received.get('parent_span_id'), 'chat.request', SPAN_KIND_SERVER,
+                   received['at'], end_event['at'],
+                   {'request.id': request_id, 'request.outcome': end_event['stage']}, error)]
+    by_stage = {}
+    for event in events:
+        by_stage.setdefault(event['stage'], event)
+    if 'enqueued' in by_stage:
+        picked = by_stage.get('dequeued') or by_stage.get('expired') or end_event
+        spans.append(child('queue.wait', by_stage['enqueued'], picked,
+                           {'lane': by_stage['enqueued'].get('lane', '')}))
+    # One span per delivery attempt, ending when it was answered or taken back
+    attempt = None
+    for event in events:
+        if event['stage'] == 'dequeued':
+            attempt = event
+        elif attempt is not None and event['stage'] in ('requeued', 'failed', 'cancelled', 'response_stored'):
+            failed = event['stage'] != 'response_stored'
+            spans.append(child('worker.attempt', attempt, event,
+                               {'worker': attempt.get('worker') or '', 'delivery': attempt.get('delivery', 1)},
+                               event.get('reason', 'lease expired') if failed else None))
+            attempt = None
+    if 'worker_sent' in by_stage and 'response_stored' in by_stage:
+        spans.append(child('grok.generate', by_stage['worker_sent'], by_stage['response_stored']))
+    if 'response_stored' in by_stage and 'delivered' in by_stage:
+        spans.append(child('response.retrieval', by_stage['response_stored'], by_stage['delivered'],
+                           {'delivery.via': by_stage['delivered'].get('via', '')}))
+    return spans
+
+
+class SpanExporter:
+    """Ships spans to a JSONL file or an OTLP/HTTP endpoint from a background thread"""
+
+    def __init__(self, target, service_name=SERVICE_NAME):
+        self.target = target
+        self.service_name = service_name
+        # Each queued item is one trace's spans; traces that piled up during
+        # the previous export share one request
+        self._writer = BackgroundWriter(self._send, 'span-exporter', batch=EXPORT_BATCH, count=len)
+
+    @property
+    def enabled(self):
+        return bool(self.target)
+
+    def export(self, spans):
+        """Queue one trace's spans without blocking"""
+        if not self.enabled or not spans:
+            return
+        self._writer.put(spans)
+
+    def _document(self, spans):
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': _attributes({'service.name': self.service_name})},
+                'scopeSpans': [{'scope': {'name': self.service_name}, 'spans': spans}]
+            }]
+        }
+
+    def _send(self, traces):
+        spans = [span for trace in traces for span in trace]
+        body = json.dumps(self._document(spans), separators=(',', ':')).encode('utf-8')
+        if self.target.startswith(('http://', 'https://')):
+            request = urllib.request.Request(self.target, data=body, method='POST',
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+        else:
+            with open(self.target, 'ab') as f:
+                f.write(body + b'\n')
+
+    def stats(self):
+        stats = self._writer.stats()
+        stats['exported'] = stats.pop('written')
+        return dict(stats, enabled=self.enabled, target=self.target)